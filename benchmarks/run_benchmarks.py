@@ -0,0 +1,296 @@
+
+"""
+Times the pipeline on synthetic layers (see synthetic_wav.py) and writes the
+results as json, so a change can be compared against an earlier commit.
+
+Every case runs in its own process, the peak memory of one case doesn't leak
+into the next. Measured: ingest (raw and z-order layout), aggregation of one
+and of all layers for mean/max and several nth, histograms and the upload of
+the aggregated points into an offscreen OpenGL context.
+
+    python benchmarks/run_benchmarks.py --layers 10 --samplerate 1000000 --duration 2
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/abc1234.json benchmarks/results/def5678.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+ROOT = HERE.parent
+
+
+# ---------- cases, run inside the worker process ----------
+
+def _collect_stages():
+    """Turns on profiling and returns the list every stage record ends up in"""
+    import profiling
+
+    records = []
+    profiling.set_enabled(True)
+    profiling.signals.stageFinished.connect(records.append)
+    return records
+
+
+def case_ingest(case):
+    import helperfunctions as helpers
+
+    out = Path(case["out"])
+    files = sorted(Path(case["wav"]).glob("Layer_*.wav"), key=lambda p: int(p.stem.split("_")[1]))
+    for i, file in enumerate(files, start=1):
+        helpers.create_arrow_from_wav(file, i, out, layout=case["layout"])
+    return dict(files=len(files), bytes_read=sum(f.stat().st_size for f in files))
+
+
+def case_aggregate(case):
+    import helperfunctions as helpers
+
+    files = helpers.get_arrow_files(case["arrow"])[:case["layers"]]
+    result = dict()
+    worker = helpers.DataWorker(case["nth"], "mean", files, case["strategy"],
+                                all_channels=case.get("all_channels", False), histogram=case.get("histogram", False))
+    worker.carrier.finished.connect(lambda arr, values: result.update(rows=len(arr)))
+    worker.run()
+    return dict(files=len(files), bytes_on_disk=sum(os.path.getsize(f) for f in files), **result)
+
+
+def case_histogram(case):
+    import helperfunctions as helpers
+
+    files = helpers.get_arrow_files(case["arrow"])[:case["layers"]]
+    result = dict()
+    task = helpers.HistogramFilterTask("mean", files)
+    task.signals.filteredHistogram.connect(lambda hist: result.update(rows=len(hist)))
+    task.run()
+    return dict(files=len(files), bytes_on_disk=sum(os.path.getsize(f) for f in files), **result)
+
+
+_gpu = dict()
+
+def case_gpu_upload(case):
+    import numpy as np
+    from OpenGL.GL import glFinish
+    import helperfunctions as helpers
+
+    if not _gpu:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PySide6.QtGui import QGuiApplication, QSurfaceFormat
+        import offscreen
+
+        QSurfaceFormat.setDefaultFormat(offscreen.default_format())
+        _gpu["app"] = QGuiApplication([])
+        _gpu["offscreen"] = offscreen.OffscreenRenderer(case["size"], case["size"])
+
+        # the points are prepared once and not part of the timing
+        files = helpers.get_arrow_files(case["arrow"])[:case["layers"]]
+        result = dict()
+        worker = helpers.DataWorker(case["nth"], "mean", files, all_channels=case["all_channels"], histogram=False)
+        worker.carrier.finished.connect(lambda arr, values: result.update(arr=np.ascontiguousarray(arr), values=values))
+        worker.run()
+        _gpu["points"] = result
+
+    off = _gpu["offscreen"]
+    points = _gpu["points"]
+    off.make_current()
+    start = time.perf_counter()
+    off.renderer.set_points(points["arr"], points["values"])
+    glFinish()
+    upload_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    off.render()
+    frame_s = time.perf_counter() - start
+    return dict(rows=len(points["arr"]), bytes_uploaded=off.renderer.data.nbytes, upload_s=upload_s, frame_s=frame_s)
+
+
+CASES = dict(ingest=case_ingest, aggregate=case_aggregate, histogram=case_histogram, gpu_upload=case_gpu_upload)
+
+
+def run_case(case):
+    """Runs case["repeat"] times in this process, returns the result record"""
+    sys.path.insert(0, str(ROOT))
+    # keep the profile log of the benchmark away from the one of the app
+    os.environ["EBM_PROFILE_LOG"] = str(Path(case["data"]) / "profile_log.jsonl")
+    import profiling
+
+    stages = _collect_stages()
+    walls = []
+    info = dict()
+    for _ in range(case["repeat"]):
+        stages.clear()
+        start = time.perf_counter()
+        info = CASES[case["kind"]](case)
+        walls.append(time.perf_counter() - start)
+
+    best = min(walls)
+    record = dict(name=case["name"], kind=case["kind"], params=case["params"],
+                  wall_s=walls, best_s=best, median_s=statistics.median(walls),
+                  peak_rss_mb=profiling.peak_rss_mb(), **info)
+    if info.get("rows"):
+        record["rows_per_s"] = info["rows"] / best
+    # ingest reads every byte of the wavs, the queries only the columns and batches they need
+    size = info.get("bytes_read") or info.get("bytes_on_disk")
+    if size:
+        record["mb_per_s"] = size / 2**20 / best
+    # stage breakdown of the last repeat
+    record["stages"] = [
+        {k: v for k, v in r.items() if k in ("stage", "wall_s", "rows", "bytes_read", "bytes_on_disk", "peak_rss_mb")}
+        for r in stages
+    ]
+    return record
+
+
+# ---------- driver ----------
+
+def build_cases(args, data):
+    wav = data / "wav"
+    raw = data / "arrow_raw"
+    common = dict(data=str(data), repeat=args.repeat)
+
+    cases = []
+    for layout, out in (("raw", raw), ("zorder", data / "arrow_zorder")):
+        # one repeat is enough and the files are needed by the cases after this one
+        cases.append(dict(common, kind="ingest", name=f"ingest_{layout}", repeat=1,
+                          wav=str(wav), out=str(out), layout=layout,
+                          params=dict(layout=layout, layers=args.layers)))
+
+    for layers in sorted({1, args.layers}):
+        for strategy in ("mean", "max", "p95"):
+            for nth in args.nth:
+                cases.append(dict(common, kind="aggregate", name=f"aggregate_{layers}layers_{strategy}_nth{nth}",
+                                  arrow=str(raw), layers=layers, strategy=strategy, nth=nth,
+                                  params=dict(layers=layers, strategy=strategy, nth=nth)))
+        cases.append(dict(common, kind="aggregate", name=f"aggregate_{layers}layers_all_channels_histogram",
+                          arrow=str(raw), layers=layers, strategy="mean", nth=1, all_channels=True, histogram=True,
+                          params=dict(layers=layers, strategy="mean", nth=1, all_channels=True, histogram=True)))
+        cases.append(dict(common, kind="histogram", name=f"histogram_filter_{layers}layers",
+                          arrow=str(raw), layers=layers, params=dict(layers=layers)))
+
+    if not args.no_gpu:
+        for all_channels in (False, True):
+            name = "gpu_upload_all_channels" if all_channels else "gpu_upload"
+            cases.append(dict(common, kind="gpu_upload", name=name, arrow=str(raw), layers=args.layers, nth=1,
+                              all_channels=all_channels, size=1024,
+                              params=dict(layers=args.layers, nth=1, all_channels=all_channels)))
+    return cases
+
+
+def prepare_data(args, data):
+    """Generates the wav layers unless the folder already holds the same configuration"""
+    sys.path.insert(0, str(HERE))
+    import synthetic_wav
+
+    config = dict(layers=args.layers, samplerate=args.samplerate, duration=args.duration, seed=args.seed)
+    config_file = data / "config.json"
+    if config_file.exists() and json.loads(config_file.read_text()) == config:
+        print(f"Using existing layers in {data}")
+        return config
+
+    print(f"Generating {args.layers} layers in {data}")
+    synthetic_wav.write_layers(data / "wav", args.layers, args.samplerate, args.duration, seed=args.seed)
+    config_file.write_text(json.dumps(config))
+    return config
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True)
+    except OSError:
+        return None
+    if out.returncode != 0:
+        return None
+    return out.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+
+
+def spawn_case(case, polars_threads):
+    env = dict(os.environ)
+    if polars_threads:
+        env["POLARS_MAX_THREADS"] = str(polars_threads)
+    proc = subprocess.run([sys.executable, __file__, "--case", json.dumps(case)],
+                          cwd=ROOT, env=env, capture_output=True, text=True)
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        return dict(name=case["name"], kind=case["kind"], params=case["params"], error=proc.stderr.strip()[-2000:])
+    # the case itself prints too, the record is the last line
+    return json.loads(lines[-1])
+
+
+def compare(base_file, new_file):
+    base = {r["name"]: r for r in json.loads(Path(base_file).read_text())["results"]}
+    new = json.loads(Path(new_file).read_text())["results"]
+    print(f"{'case':<48}{'base s':>10}{'new s':>10}{'ratio':>8}{'base MB':>10}{'new MB':>10}")
+    for r in new:
+        b = base.get(r["name"])
+        if b is None or "best_s" not in b or "best_s" not in r:
+            continue
+        print(f"{r['name']:<48}{b['best_s']:>10.3f}{r['best_s']:>10.3f}{r['best_s'] / b['best_s']:>8.2f}"
+              f"{b['peak_rss_mb'] or 0:>10.0f}{r['peak_rss_mb'] or 0:>10.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ingest, aggregation, histograms and upload on synthetic layers")
+    parser.add_argument("--data", default="bench_data", help="folder for the generated wav and arrow files")
+    parser.add_argument("--out", default=None, help="result json, defaults to benchmarks/results/<commit>.json")
+    parser.add_argument("--layers", type=int, default=10)
+    parser.add_argument("--samplerate", type=int, default=1_000_000)
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds of scanning per layer")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--nth", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--polars-threads", type=int, default=None, help="POLARS_MAX_THREADS for the cases")
+    parser.add_argument("--only", default=None, help="only run cases whose name contains this")
+    parser.add_argument("--no-gpu", action="store_true", help="skip the OpenGL upload cases")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="print two result files side by side")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case)), default=str))
+        return 0
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    data = Path(args.data).resolve()
+    config = prepare_data(args, data)
+    commit = git_commit()
+
+    results = []
+    for case in build_cases(args, data):
+        # ingest always runs, the other cases need its arrow files
+        if args.only and args.only not in case["name"] and case["kind"] != "ingest":
+            continue
+        print(f"Running {case['name']}")
+        record = spawn_case(case, args.polars_threads)
+        if "error" in record:
+            print(f"  failed: {record['error'].splitlines()[-1] if record['error'] else 'no output'}")
+        else:
+            print(f"  {record['best_s']:.3f} s, peak {record['peak_rss_mb'] or 0:.0f} MB")
+        results.append(record)
+
+    out = Path(args.out) if args.out else HERE / "results" / f"{commit or 'unknown'}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(dict(
+        commit=commit,
+        time=time.strftime("%Y-%m-%d %H:%M:%S"),
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        polars_threads=args.polars_threads,
+        data=config,
+        results=results,
+    ), indent=2, default=str))
+    print(f"Results written to {out}")
+    return 1 if any("error" in r for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+
+"""
+Synthetic EBM layers in the wav layout the machine writes: int16, 8 channels,
+0-3 the electron sensors, 4 and 5 the beam x, y deflection, 6 and 7 unused.
+
+Every layer is a serpentine hatch over the build plate, rotated by 67 degrees
+from layer to layer like the real melt strategy. The sensors see a brighter
+signal on the melted parts than on the powder, every sensor a bit brighter on
+the side it faces, plus noise and a few hot spots per layer.
+The same seed always gives the same files.
+
+    python benchmarks/synthetic_wav.py bench_data/wav --layers 20 --samplerate 1000000 --duration 2
+"""
+import argparse
+from pathlib import Path
+
+import numpy as np
+from scipy.io import wavfile
+
+
+DAC_MAX = 32767
+HATCH_ROTATION = 67.0
+
+# (x, y, radius) of round parts and (x, y, half width) of square ones, in -1..1 plate coordinates
+ROUND_PARTS = [(-0.4, 0.4, 0.25), (0.4, -0.4, 0.2)]
+SQUARE_PARTS = [(0.4, 0.4, 0.2), (-0.4, -0.4, 0.25)]
+
+# direction every sensor looks from, the side facing it appears brighter
+SENSOR_DIRECTIONS = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+
+POWDER_LEVEL = 1200
+MELT_LEVEL = 2600
+HOTSPOT_LEVEL = 3800
+NOISE = 150
+
+
+def scan_path(samples, layer, lines):
+    """Beam position of every sample as float -1..1, a serpentine hatch rotated per layer"""
+    pos = np.arange(samples, dtype=np.float64) * (lines / samples)
+    line = np.floor(pos)
+    along = pos - line
+    # every second line runs backwards
+    along = np.where(line % 2 == 1, 1.0 - along, along)
+
+    u = 2.0 * along - 1.0
+    v = 2.0 * (line + 0.5) / lines - 1.0
+
+    angle = np.deg2rad(HATCH_ROTATION * layer)
+    # scaled so the rotated square stays on the plate
+    scale = 1.0 / np.sqrt(2.0)
+    x = (u * np.cos(angle) - v * np.sin(angle)) * scale
+    y = (u * np.sin(angle) + v * np.cos(angle)) * scale
+    return x, y
+
+
+def part_mask(x, y):
+    mask = np.zeros(len(x), dtype=bool)
+    for cx, cy, r in ROUND_PARTS:
+        mask |= (x - cx) ** 2 + (y - cy) ** 2 < r ** 2
+    for cx, cy, h in SQUARE_PARTS:
+        mask |= (np.abs(x - cx) < h) & (np.abs(y - cy) < h)
+    return mask
+
+
+def sensor_signals(x, y, rng, hotspots):
+    base = np.where(part_mask(x, y), MELT_LEVEL, POWDER_LEVEL).astype(np.float32)
+
+    for hx, hy, r in hotspots:
+        base[(x - hx) ** 2 + (y - hy) ** 2 < r ** 2] = HOTSPOT_LEVEL
+
+    sensors = []
+    for dx, dy in SENSOR_DIRECTIONS:
+        gain = 1.0 + 0.15 * (x * dx + y * dy)
+        signal = base * gain + rng.normal(0.0, NOISE, len(x))
+        sensors.append(np.clip(signal, -DAC_MAX, DAC_MAX))
+    return sensors
+
+
+def generate_layer(layer, samplerate=1_000_000, duration=1.0, lines=400, hotspots=5, seed=0):
+    """(samples, 8) int16 of one layer"""
+    rng = np.random.default_rng((seed, layer))
+    samples = int(samplerate * duration)
+
+    x, y = scan_path(samples, layer, lines)
+    spots = [(rng.uniform(-0.6, 0.6), rng.uniform(-0.6, 0.6), rng.uniform(0.005, 0.02)) for _ in range(hotspots)]
+
+    data = np.zeros((samples, 8), dtype=np.int16)
+    for i, signal in enumerate(sensor_signals(x, y, rng, spots)):
+        data[:, i] = signal.astype(np.int16)
+    data[:, 4] = np.round(x * DAC_MAX).astype(np.int16)
+    data[:, 5] = np.round(y * DAC_MAX).astype(np.int16)
+    return data
+
+
+def write_layers(out_folder, layers=10, samplerate=1_000_000, duration=1.0, lines=400, hotspots=5, seed=0):
+    """Writes Layer_1.wav ... Layer_N.wav and returns their paths"""
+    out_dir = Path(out_folder)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    files = []
+    for layer in range(1, layers + 1):
+        path = out_dir / f"Layer_{layer}.wav"
+        data = generate_layer(layer, samplerate, duration, lines, hotspots, seed)
+        wavfile.write(path, samplerate, data)
+        del data
+        files.append(path)
+    return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic EBM wav layers")
+    parser.add_argument("out", help="folder for the wav files")
+    parser.add_argument("--layers", type=int, default=10)
+    parser.add_argument("--samplerate", type=int, default=1_000_000)
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds of scanning per layer")
+    parser.add_argument("--lines", type=int, default=400, help="hatch lines per layer")
+    parser.add_argument("--hotspots", type=int, default=5, help="bright spots per layer")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    files = write_layers(args.out, args.layers, args.samplerate, args.duration, args.lines, args.hotspots, args.seed)
+    print(f"Wrote {len(files)} layers to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
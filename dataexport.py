@@ -0,0 +1,207 @@
+
+"""
+Export of the aggregated values for analysis in other tools, instead of the
+png of the picture. Every row is one point (x, y in dac values) or one cell
+(ix, iy with --cells) with the aggregated value columns and the sample count.
+The aggregation is streamed into the file, it is never held in memory as a
+whole next to the view:
+
+    parquet   row groups of ROW_GROUP_ROWS
+    arrow     arrow ipc file
+    npz       a folder of tiles, NPZ_TILES x NPZ_TILES over the dac range,
+              tile_<ty>_<tx>.npz with one array per column
+
+Cells cover the full dac range rather than the extent of the data like the
+image view does, so the windows of one build line up cell by cell. Next to
+every export goes <name>.json with the layer range, files and query.
+
+    python dataexport.py build_a/arrow_files --out exports --window 10 --format parquet
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+import helperfunctions as helpers
+import profiling
+import startup
+from render_cli import build_folder, layer_windows
+
+pl = startup.lazy("polars")
+
+
+FORMATS = ["parquet", "arrow", "npz"]
+SUFFIXES = {"parquet": ".parquet", "arrow": ".arrow", "npz": "_npz"}
+
+# rows per parquet row group, readers can skip whole groups by their statistics
+ROW_GROUP_ROWS = 1 << 20
+# tiles per side of the dac range in npz exports
+NPZ_TILES = 8
+
+
+def export_plan(files, ch="mean", nth=1, strategy="mean", all_channels=False, cells=None, energy=None, noise=None):
+    """LazyFrame of the aggregate with its key and value columns, count is the samples per row"""
+    columns = helpers.aggregate_columns(ch, all_channels)
+    energy = None if energy is None else (ch, *energy)
+    plans = [helpers.get_df_from_arrow(file, columns, nth, energy=energy) for file in files]
+    ldf = pl.concat(plans) if len(plans) > 1 else plans[0]
+
+    if noise is not None:
+        # the histogram over the whole layers, like DataWorker does for a zoomed region
+        hist_plans = [helpers.get_df_from_arrow(file, ch, nth) for file in files]
+        hist_ldf = pl.concat(hist_plans) if len(hist_plans) > 1 else hist_plans[0]
+        histogram = hist_ldf.group_by(ch).agg(pl.len().alias("amount"))
+        ldf = ldf.join(helpers.noise_filter(histogram, ch, *noise), on=ch, how="semi")
+
+    if all_channels:
+        values = columns
+    else:
+        ldf = ldf.select(pl.col("x"), pl.col("y"), pl.col(ch).alias("value"))
+        values = ["value"]
+
+    keys = ["x", "y"]
+    if cells:
+        cell = lambda c: ((pl.col(c) + 32768) * cells // 65536).clip(0, cells - 1).cast(pl.Int32)
+        ldf = ldf.with_columns(cell("x").alias("ix"), cell("y").alias("iy"))
+        keys = ["ix", "iy"]
+
+    ldf = helpers.aggregate_strategy(ldf, keys, values, strategy, [pl.len().alias("count")])
+    return ldf, keys, values
+
+
+def export_path(out, first, last, ch, fmt):
+    return Path(out) / f"layers_{first}-{last}_{ch.replace(' ', '_')}{SUFFIXES[fmt]}"
+
+
+def write_npz_tiles(ldf, folder, keys, cells=None):
+    """
+    One npz per tile that holds data. The aggregate is streamed to a scratch
+    arrow file first and every tile is read from it memory mapped. Tiles of an
+    earlier export into folder are removed first.
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    for old in folder.glob("tile_*.npz"):
+        old.unlink()
+    if cells:
+        tile = lambda c: (pl.col(c) * NPZ_TILES // cells).cast(pl.Int32)
+    else:
+        tile = lambda c: ((pl.col(c) + 32768) * NPZ_TILES // 65536).clip(0, NPZ_TILES - 1).cast(pl.Int32)
+
+    scratch = folder / "aggregate.arrow.tmp"
+    try:
+        ldf.with_columns(tile(keys[0]).alias("tx"), tile(keys[1]).alias("ty")).sink_ipc(scratch)
+        scan = pl.scan_ipc(scratch)
+        tiles = scan.select("tx", "ty").unique().sort(["ty", "tx"]).collect()
+        for tx, ty in tiles.iter_rows():
+            df = scan.filter((pl.col("tx") == tx) & (pl.col("ty") == ty)).drop(["tx", "ty"]).collect()
+            with helpers.replace_when_done(folder / f"tile_{ty}_{tx}.npz") as tmp:
+                with open(tmp, "wb") as f:
+                    np.savez_compressed(f, **{c: df[c].to_numpy() for c in df.columns})
+        return len(tiles)
+    finally:
+        scratch.unlink(missing_ok=True)
+
+
+def export_aggregate(path, files, fmt="parquet", ch="mean", nth=1, strategy="mean", all_channels=False,
+                     cells=None, energy=None, noise=None):
+    """Writes the aggregate of files to path in fmt and the metadata next to it, returns the path"""
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown export format {fmt!r}, one of {FORMATS}")
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    ldf, keys, values = export_plan(files, ch, nth, strategy, all_channels, cells, energy, noise)
+
+    with profiling.stage("export", format=fmt, files=len(files), strategy=strategy,
+                         bytes_on_disk=profiling.bytes_on_disk(files)) as st:
+        st.plan(ldf)
+        if fmt == "parquet":
+            with helpers.replace_when_done(path) as tmp:
+                ldf.sink_parquet(tmp, row_group_size=ROW_GROUP_ROWS)
+        elif fmt == "arrow":
+            with helpers.replace_when_done(path) as tmp:
+                ldf.sink_ipc(tmp)
+        else:
+            st.set(tiles=write_npz_tiles(ldf, path, keys, cells))
+
+    numbers = [helpers.layer_number(f) for f in files]
+    meta = dict(
+        layers=[min(numbers), max(numbers)],
+        files=[Path(f).name for f in files],
+        channel=ch,
+        strategy=strategy,
+        nth=nth,
+        all_channels=all_channels,
+        energy=energy,
+        noise=noise,
+        keys=keys,
+        values=values,
+        cells=cells,
+        format=fmt,
+        created=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+    with helpers.replace_when_done(path.with_name(path.name + ".json")) as tmp:
+        tmp.write_text(json.dumps(meta, indent=1))
+    return path
+
+
+class ExportSignals(QObject):
+    finished = Signal(str, bool)
+
+class ExportTask(QRunnable):
+    """export_aggregate in the background, query takes its keyword arguments"""
+
+    def __init__(self, path, files, fmt, **query):
+        super().__init__()
+        self.path = path
+        self.files = files
+        self.fmt = fmt
+        self.query = query
+        self.signals = ExportSignals()
+
+    def run(self):
+        try:
+            export_aggregate(self.path, self.files, self.fmt, **self.query)
+        except Exception as e:
+            print(f"Exporting {self.path} failed: {e}")
+            self.signals.finished.emit(str(self.path), False)
+            return
+        self.signals.finished.emit(str(self.path), True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the aggregated values of every layer window of arrow folders")
+    parser.add_argument("folders", nargs="+", help="arrow folders, one per build")
+    parser.add_argument("--out", default="exports", help="output folder, one subfolder per build")
+    parser.add_argument("--format", default="parquet", choices=FORMATS)
+    parser.add_argument("--window", type=int, default=10, help="layers aggregated per export")
+    parser.add_argument("--step", type=int, default=None, help="layers between two windows, defaults to --window")
+    parser.add_argument("--channel", default="mean")
+    parser.add_argument("--all-channels", action="store_true", help="one value column per sensor channel")
+    parser.add_argument("--strategy", default="mean", choices=helpers.STRATEGIES)
+    parser.add_argument("--nth", type=int, default=1, help="only take every nth sample")
+    parser.add_argument("--cells", type=int, default=None, help="aggregate into this many cells per side instead of points")
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for folder in args.folders:
+        files = helpers.get_arrow_files(folder)
+        out_dir = build_folder(args.out, folder)
+        for first, last in layer_windows(len(files), args.window, args.step or args.window):
+            path = export_path(out_dir, first, last, args.channel, args.format)
+            try:
+                export_aggregate(path, files[first - 1:last], args.format, args.channel, args.nth, args.strategy,
+                                 args.all_channels, args.cells)
+                print(f"Exported {path}")
+            except Exception as e:
+                failed += 1
+                print(f"Exporting {path} failed: {e}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,37 +1,55 @@
 from os.path import dirname, join as pjoin
-from scipy.io import wavfile
-import scipy.io
 #from collections import Counter
 import os
+import json
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
 from pathlib import Path
 import numpy as np
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
 from PySide6.QtCore import Signal, QThread, QRunnable, QThreadPool, QObject
 from PySide6.QtWidgets import QApplication
-import pyarrow
-import polars as pl
 from natsort import natsorted
-from watchdog.events import FileSystemEventHandler, FileClosedEvent
 import time
+import profiling
+import startup
 
+# imported on first use, see startup.py
+pl = startup.lazy("polars")
+wavfile = startup.lazy("scipy.io.wavfile")
 
-from OpenGL.GL import (
-    glClearColor, glClear, GL_COLOR_BUFFER_BIT,
-    glUseProgram, glUniformMatrix4fv, glUniform1f, glUniform1i,
-    glBindVertexArray, glGenVertexArrays,
-    glBufferData, glGenBuffers, glBindBuffer, GL_ARRAY_BUFFER, GL_STATIC_DRAW,
-    glVertexAttribPointer, glEnableVertexAttribArray,
-    glDrawArrays, GL_POINTS, GL_FALSE, GL_TRUE,
-    glCreateProgram, glAttachShader, glLinkProgram, glGetProgramiv,
-    GL_LINK_STATUS, glGetProgramInfoLog, glDeleteShader,
-    glGetUniformLocation, glViewport,
-    glGenTextures, glBindTexture, glTexImage1D, glTexParameteri,
-    GL_TEXTURE_1D, GL_RGBA32F, GL_RGBA, GL_FLOAT, GL_LINEAR,
-    GL_VERTEX_SHADER, GL_FRAGMENT_SHADER,
-    glCreateShader,glShaderSource,glCompileShader,
-    glGetShaderiv,GL_COMPILE_STATUS,glGetShaderInfoLog
-)
+# sensor columns every arrow layer carries next to x and y
+CHANNELS = ["channel 1", "channel 2", "channel 3", "channel 4", "mean"]
+
+# rows per record batch in z-order sorted layers, every batch gets its own min/max entry
+ZORDER_BATCH_ROWS = 65536
+
+# cells per side of the per layer profile over the full dac range of x and y,
+# every cell holds mean, max and sample count of each channel in CHANNELS
+PROFILE_CELLS = 128
+PROFILE_STATS = ["mean", "max", "count"]
+
+# bytes of arrow files the prefetcher keeps warm at most
+PREFETCH_BUDGET = 1 << 30
+
+# per layer summary written at ingest, percentiles as (name, quantile)
+LAYER_PERCENTILES = [("p5", 0.05), ("p50", 0.5), ("p95", 0.95)]
+
+# quantile strategies, read from a histogram sketch per cell (see aggregate_quantile)
+QUANTILES = {"median": 0.5, "p90": 0.9, "p95": 0.95, "p99": 0.99}
+STRATEGIES = ["mean", "max", *QUANTILES]
+# the sketches cut the 16 bit dac range of the samples into fixed buckets, the
+# same for every query, layer and session, so two sketches merge by adding counts
+QUANTILE_RANGE = (-32768, 32768)
+QUANTILE_BUCKETS = 4096
+
+def aggregate_columns(ch, all_channels=False):
+    """Columns DataWorker reads for ch, every channel in CHANNELS with all_channels"""
+    if all_channels:
+        return CHANNELS if ch in CHANNELS else CHANNELS + [ch]
+    return [ch]
 
 def get_wav_files(directory):
     base_path = Path(str(directory).strip())
@@ -41,6 +59,10 @@ def get_wav_files(directory):
         return []
     return natsorted(list(base_path.glob("*.wav")))
 
+def layer_number(file):
+    """Layer_12.arrow -> 12"""
+    return int(Path(file).stem.split(".")[0].split("_")[-1])
+
 def get_arrow_files(directory):
     """Returns a list of all .arrow files in the specified directory."""
     base_path = Path(str(directory).strip())
@@ -66,17 +88,353 @@ def create_histogram_from_arrow_folder(folder_path, ch="mean"):
     return hist_df
 
 
+def morton_key(x, y):
+    """Z-order key of two coordinate arrays, each one scaled to 16 bit and bit interleaved into an uint32"""
+    def spread(v):
+        v = np.asarray(v, dtype=np.float64)
+        span = v.max() - v.min()
+        v = ((v - v.min()) / (span if span > 0 else 1.0) * 65535).astype(np.uint32)
+        v = (v | (v << 8)) & 0x00FF00FF
+        v = (v | (v << 4)) & 0x0F0F0F0F
+        v = (v | (v << 2)) & 0x33333333
+        v = (v | (v << 1)) & 0x55555555
+        return v
+    return spread(x) | (spread(y) << 1)
+
+
+@contextmanager
+def replace_when_done(path):
+    """
+    Yields a temporary path next to path that replaces it once the block finished,
+    a crash midway leaves the old file (or none) instead of a truncated one.
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def zorder_index_path(file):
+    return Path(file).with_suffix(".zidx")
+
+
+def write_zorder_layer(df, out_file, index_file=None):
+    """
+    Writes df sorted by the z-order key of (x, y) in record batches of ZORDER_BATCH_ROWS.
+    Next to it goes a small index with the row count and the min/max of every column per batch,
+    index_file when out_file is only a temporary name.
+    """
+    import pyarrow.ipc
+    df = df[np.argsort(morton_key(df["x"].to_numpy(), df["y"].to_numpy()), kind="stable")]
+
+    # one chunk, else to_batches splits at the chunk borders as well and the
+    # batches would not line up with the index below
+    table = df.to_arrow().combine_chunks()
+    with pyarrow.ipc.new_file(str(out_file), table.schema) as writer:
+        for batch in table.to_batches(max_chunksize=ZORDER_BATCH_ROWS):
+            writer.write_batch(batch)
+
+    stats = []
+    for c in df.columns:
+        stats += [pl.col(c).min().alias(f"{c}_min"), pl.col(c).max().alias(f"{c}_max")]
+    index = (
+        df.with_columns((pl.int_range(pl.len()) // ZORDER_BATCH_ROWS).alias("batch"))
+        .group_by("batch", maintain_order=True)
+        .agg([pl.len().alias("rows"), *stats])
+    )
+    with replace_when_done(index_file or zorder_index_path(out_file)) as tmp:
+        index.write_ipc(tmp)
+
+
+def read_pruned_batches(file, ranges):
+    """
+    Returns a LazyFrame of only the record batches whose min/max overlap every
+    (column, low, high) in ranges, None if the layer has no z-order index or one
+    that doesn't describe this file.
+    """
+    import pyarrow.ipc
+    index_path = zorder_index_path(file)
+    if not index_path.exists():
+        return None
+
+    index = pl.read_ipc(index_path)
+    # memory mapped, so only the pages of the kept batches are ever read
+    reader = pyarrow.ipc.open_file(pyarrow.memory_map(str(file), "r"))
+    if len(index) != reader.num_record_batches:
+        # the layer is being rewritten, a full scan is right where the index may not be
+        return None
+
+    keep = pl.lit(True)
+    for col, low, high in ranges:
+        if f"{col}_min" in index.columns:
+            keep = keep & (pl.col(f"{col}_max") >= low) & (pl.col(f"{col}_min") <= high)
+    batches = index.filter(keep)["batch"].to_list()
+
+    if batches:
+        table = pyarrow.Table.from_batches([reader.get_batch(i) for i in batches])
+    else:
+        table = reader.schema.empty_table()
+    return pl.from_arrow(table).lazy()
+
+
+def layer_profile_path(file):
+    return Path(file).with_suffix(".profile.npy")
+
+
+def profile_cell(v):
+    """dac value of x or y -> cell index of the layer profile"""
+    return int(np.clip((int(v) + 32768) * PROFILE_CELLS // 65536, 0, PROFILE_CELLS - 1))
+
+
+def write_layer_profile(df, out_file):
+    """
+    Aggregates the layer into PROFILE_CELLS x PROFILE_CELLS cells and stores them next to
+    it as (cy, cx, channel, stat) float32. One cell is 60 contiguous bytes, a probe
+    reads a single page of every layer.
+    """
+    cell = lambda c: ((pl.col(c) + 32768) * PROFILE_CELLS // 65536).clip(0, PROFILE_CELLS - 1).cast(pl.Int32)
+    agg = (
+        df.lazy()
+        .with_columns(cell("x").alias("cx"), cell("y").alias("cy"))
+        .group_by(["cy", "cx"])
+        .agg([pl.len().alias("count")]
+             + [pl.col(c).mean().alias(f"{c} mean") for c in CHANNELS]
+             + [pl.col(c).max().cast(pl.Float32).alias(f"{c} max") for c in CHANNELS])
+        .collect()
+    )
+
+    profile = np.full((PROFILE_CELLS, PROFILE_CELLS, len(CHANNELS), len(PROFILE_STATS)), np.nan, dtype=np.float32)
+    profile[..., 2] = 0
+    cy = agg["cy"].to_numpy()
+    cx = agg["cx"].to_numpy()
+    count = agg["count"].to_numpy()
+    for i, c in enumerate(CHANNELS):
+        profile[cy, cx, i, 0] = agg[f"{c} mean"].to_numpy()
+        profile[cy, cx, i, 1] = agg[f"{c} max"].to_numpy()
+        profile[cy, cx, i, 2] = count
+    with replace_when_done(layer_profile_path(out_file)) as tmp:
+        # through a file object, np.save would append .npy to the name
+        with open(tmp, "wb") as f:
+            np.save(f, profile)
+
+
+def has_layer_profile(file):
+    """Whether the layer has a profile that is newer than the layer itself"""
+    path = layer_profile_path(file)
+    return path.exists() and path.stat().st_mtime >= Path(file).stat().st_mtime
+
+
+def load_layer_profile(file):
+    """Memory mapped profile of an arrow layer, built from the layer first if it has none yet"""
+    path = layer_profile_path(file)
+    if not has_layer_profile(file):
+        df = pl.read_ipc(file, columns=["x", "y", *CHANNELS], memory_map=True)
+        write_layer_profile(df, file)
+        del df
+    return np.load(path, mmap_mode="r")
+
+
+def layer_stats_path(file):
+    return Path(file).with_suffix(".stats.json")
+
+
+def write_layer_stats(df, out_file):
+    """
+    Summary of one layer for the build timeline: sample count, coverage (share of the
+    layer profile cells that got samples) and mean, std, min, max and LAYER_PERCENTILES
+    of every channel. Small enough to read hundreds of them when the timeline opens.
+    """
+    cell = lambda c: ((pl.col(c) + 32768) * PROFILE_CELLS // 65536).clip(0, PROFILE_CELLS - 1).cast(pl.Int32)
+    exprs = [
+        pl.len().alias("rows"),
+        (cell("y") * PROFILE_CELLS + cell("x")).n_unique().alias("cells"),
+    ]
+    for c in CHANNELS:
+        exprs += [
+            pl.col(c).mean().alias(f"{c}|mean"),
+            pl.col(c).std().alias(f"{c}|std"),
+            pl.col(c).min().cast(pl.Float64).alias(f"{c}|min"),
+            pl.col(c).max().cast(pl.Float64).alias(f"{c}|max"),
+        ]
+        exprs += [pl.col(c).quantile(q).alias(f"{c}|{name}") for name, q in LAYER_PERCENTILES]
+    row = df.lazy().select(exprs).collect().row(0, named=True)
+
+    channels = {c: dict() for c in CHANNELS}
+    for key, value in row.items():
+        if "|" in key:
+            c, stat = key.split("|")
+            channels[c][stat] = value
+    stats = dict(
+        layer=layer_number(out_file),
+        rows=row["rows"],
+        coverage=row["cells"] / PROFILE_CELLS**2 if row["rows"] else 0.0,
+        channels=channels,
+    )
+    with replace_when_done(layer_stats_path(out_file)) as tmp:
+        tmp.write_text(json.dumps(stats))
+    return stats
+
+
+def load_layer_stats(file, build=True):
+    """
+    Statistics of an arrow layer, computed from the layer first if it has none yet.
+    Without build a missing file gives None, for layers that may still be written.
+    """
+    path = layer_stats_path(file)
+    if path.exists() and path.stat().st_mtime >= Path(file).stat().st_mtime:
+        return json.loads(path.read_text())
+    if not build:
+        return None
+    df = pl.read_ipc(file, columns=["x", "y", *CHANNELS], memory_map=True)
+    return write_layer_stats(df, file)
+
+
+def probe_layers(files, x, y, radius=0):
+    """
+    (layers, channels, stats) for the profile cell under the dac position x, y, with
+    radius > 0 over the (2 * radius + 1)^2 cells around it. Mean is count weighted.
+    """
+    cx, cy = profile_cell(x), profile_cell(y)
+    x0, x1 = max(cx - radius, 0), min(cx + radius + 1, PROFILE_CELLS)
+    y0, y1 = max(cy - radius, 0), min(cy + radius + 1, PROFILE_CELLS)
+
+    result = np.full((len(files), len(CHANNELS), len(PROFILE_STATS)), np.nan, dtype=np.float32)
+    for i, file in enumerate(files):
+        cells = np.asarray(load_layer_profile(file)[y0:y1, x0:x1])
+        count = cells[..., 2]
+        total = count.sum(axis=(0, 1))
+        hit = total > 0
+        sums = np.where(count > 0, cells[..., 0] * count, 0).sum(axis=(0, 1))
+        result[i, :, 0] = np.where(hit, sums / np.maximum(total, 1), np.nan)
+        result[i, :, 1] = np.where(hit, np.where(count > 0, cells[..., 1], -np.inf).max(axis=(0, 1)), np.nan)
+        result[i, :, 2] = total
+    return result
+
+
 #need to create them sorted after mesh and then x and y
-def create_arrow_from_wav(file_path, number, out_folder="arrow_files", stride=1):
+def create_arrow_from_wav(file_path, number, out_folder="arrow_files", stride=1, layout="raw"):
+    """layout "raw" keeps the beam order, "zorder" sorts spatially and writes a batch index"""
     out_dir = Path(out_folder)
     out_dir.mkdir(parents=True, exist_ok=True)
     out_file = out_dir / f"Layer_{number}.arrow"
 
-    samplerate, data = wavfile.read(file_path)
+    with profiling.stage("create_arrow_from_wav", file=str(file_path), layer=number, layout=layout) as st:
+        samplerate, data = wavfile.read(file_path)
+
+        df = frames_to_df(data, stride)
+
+        # the layer only takes its place once the sidecars are there, which are
+        # written after it so they count as up to date
+        index_path = zorder_index_path(out_file)
+        index_tmp = index_path.with_name(index_path.name + ".new")
+        try:
+            with replace_when_done(out_file) as tmp:
+                if layout == "zorder":
+                    write_zorder_layer(df, tmp, index_tmp)
+                else:
+                    df.write_ipc(tmp)
+                write_layer_profile(df, out_file)
+                write_layer_stats(df, out_file)
+                # the old index goes before the new layer takes its place, until the new
+                # index follows the layer is scanned in full instead of pruned by wrong batches
+                index_path.unlink(missing_ok=True)
+            if layout == "zorder":
+                os.replace(index_tmp, index_path)
+        finally:
+            index_tmp.unlink(missing_ok=True)
+
+        st.set(rows=len(df), bytes_read=os.path.getsize(file_path), bytes_written=os.path.getsize(out_file))
+
+        del data
+        
+        del df
     
+    print(f"Exported to {out_file}")
+    return out_file
+
+
+MANIFEST_NAME = "ingest_manifest.json"
+# bytes of the start of a wav that go into its fingerprint
+FINGERPRINT_BYTES = 65536
+
+
+def wav_fingerprint(path):
+    """size, mtime and a hash of the header and first samples, enough to tell a rewritten file"""
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        head = hashlib.sha1(f.read(FINGERPRINT_BYTES)).hexdigest()
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, header=head)
+
+
+class IngestManifest:
+    """
+    Which wav became which layer of an arrow folder, with the fingerprint of the wav
+    at conversion time. Batch conversion and the watchdog share it, so a layer keeps
+    its number and unchanged files are not converted again.
+    Use IngestManifest.open(folder), all users of a folder get the same instance.
+    """
+
+    _open = dict()
+    _open_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, folder):
+        key = str(Path(folder).resolve())
+        with cls._open_lock:
+            if key not in cls._open:
+                cls._open[key] = cls(folder)
+            return cls._open[key]
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.path = self.folder / MANIFEST_NAME
+        self.lock = threading.Lock()
+        self.entries = dict()
+        if self.path.exists():
+            try:
+                self.entries = json.loads(self.path.read_text())["layers"]
+            except (ValueError, KeyError) as e:
+                print(f"Ignoring broken {self.path}: {e}")
+
+    def layer_for(self, wav):
+        """Layer number of wav, a new file gets the next free one right away"""
+        key = str(Path(wav).resolve())
+        with self.lock:
+            if key not in self.entries:
+                number = max((e["layer"] for e in self.entries.values()), default=0) + 1
+                # reserved until record, so two new files never share a number
+                self.entries[key] = dict(layer=number)
+            return self.entries[key]["layer"]
+
+    def needs_conversion(self, wav, layout="raw"):
+        key = str(Path(wav).resolve())
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or "fingerprint" not in entry or entry.get("layout") != layout:
+            return True
+        if not (self.folder / f"Layer_{entry['layer']}.arrow").exists():
+            return True
+        return wav_fingerprint(wav) != entry["fingerprint"]
+
+    def record(self, wav, layer, fingerprint, layout="raw"):
+        key = str(Path(wav).resolve())
+        with self.lock:
+            self.entries[key] = dict(layer=layer, fingerprint=fingerprint, layout=layout)
+            done = {k: e for k, e in self.entries.items() if "fingerprint" in e}
+            self.folder.mkdir(parents=True, exist_ok=True)
+            with replace_when_done(self.path) as tmp:
+                tmp.write_text(json.dumps(dict(layers=done), indent=1))
+
+
+def frames_to_df(data, stride=1):
+    """(frames, channels) of a wav -> the columns of an arrow layer"""
     values = np.mean([data[::stride,0],data[::stride,1],data[::stride,2],data[::stride,3]],axis=0).astype(np.float32)
 
-    df = pl.DataFrame({
+    return pl.DataFrame({
         "x": data[::stride, -4].astype(np.float32),
         "y": data[::stride, -3].astype(np.float32),
         "channel 1" :data[::stride,0],
@@ -86,35 +444,215 @@ def create_arrow_from_wav(file_path, number, out_folder="arrow_files", stride=1)
         "mean" : values
         })
 
-    df.write_ipc(out_file)
-
-    del data
-    
-    del df
-    
-    print(f"Exported to {out_file}")
-    return out_file
 
+class WavTail:
+    """
+    Reads the sample frames of a wav file while it is still being written.
+    The header is parsed once, every read_new returns the whole frames
+    appended since the last call.
+    """
 
-def get_df_from_arrow(file, ch="mean", nth=4):
+    def __init__(self, path):
+        self.path = path
+        self.data_offset = None
+        self.channels = 0
+        self.block_align = 0
+        self.samplerate = 0
+        self.dtype = None
+        # bytes of the data chunk handed out so far
+        self.position = 0
+
+    def _parse_header(self):
+        with open(self.path, "rb") as f:
+            head = f.read(4096)
+        if len(head) < 12 or head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+            return False
+
+        pos = 12
+        while pos + 8 <= len(head):
+            kind = head[pos:pos + 4]
+            size = struct.unpack("<I", head[pos + 4:pos + 8])[0]
+            if kind == b"fmt ":
+                if pos + 24 > len(head):
+                    return False
+                fmt, self.channels, self.samplerate, _, self.block_align, bits = \
+                    struct.unpack("<HHIIHH", head[pos + 8:pos + 24])
+                # 3 is ieee float, 1 and 0xFFFE (extensible) are taken as integer pcm
+                if fmt == 3:
+                    self.dtype = np.dtype(f"<f{bits // 8}")
+                elif bits == 8:
+                    self.dtype = np.dtype(np.uint8)
+                else:
+                    self.dtype = np.dtype(f"<i{bits // 8}")
+            elif kind == b"data":
+                if self.dtype is None:
+                    return False
+                self.data_offset = pos + 8
+                return True
+            pos += 8 + size + (size & 1)
+        return False
+
+    def _data_size(self, file_size):
+        available = file_size - self.data_offset
+        with open(self.path, "rb") as f:
+            f.seek(self.data_offset - 4)
+            declared = struct.unpack("<I", f.read(4))[0]
+        # writers put 0 or 0xFFFFFFFF there until the file is closed
+        if 0 < declared < available:
+            return declared
+        return available
+
+    def read_new(self):
+        """(frames, channels) appended since the last call, None if there is nothing new yet"""
+        if self.data_offset is None and not self._parse_header():
+            return None
+
+        size = self._data_size(os.path.getsize(self.path))
+        frames = (size - self.position) // self.block_align
+        if frames <= 0:
+            return None
+
+        with open(self.path, "rb") as f:
+            f.seek(self.data_offset + self.position)
+            buffer = f.read(frames * self.block_align)
+        frames = len(buffer) // self.block_align
+        self.position += frames * self.block_align
+        return np.frombuffer(buffer, dtype=self.dtype, count=frames * self.channels).reshape(frames, self.channels)
+
+
+def get_df_from_arrow(file, ch="mean", nth=4, roi=None, energy=None):
+    """
+    ch can be a single column name or a list of them, roi = (x_min, x_max, y_min, y_max)
+    and energy = (column, low, high) only keep the rows inside them
+    """
     
     file_path = Path(file).absolute()
-    
-    ldf = pl.scan_ipc(file_path)
+
+    ranges = []
+    if roi is not None:
+        ranges += [("x", roi[0], roi[1]), ("y", roi[2], roi[3])]
+    if energy is not None:
+        ranges.append(energy)
+
+    ldf = None
+    if ranges:
+        # z-order layers can skip every batch outside the ranges
+        ldf = read_pruned_batches(file_path, ranges)
+    if ldf is None:
+        ldf = pl.scan_ipc(file_path)
+
+    # has to come before gather_every, otherwise polars can't push it into the scan
+    for col, low, high in ranges:
+        ldf = ldf.filter(pl.col(col).is_between(low, high))
     
     if nth > 1:
         ldf = ldf.gather_every(nth)
     
-    ldf = ldf.select(["x", "y", ch])
+    columns = [ch] if isinstance(ch, str) else list(ch)
+    ldf = ldf.select(["x", "y", *columns])
     
     return ldf
 
-def normalize_data(ldf, ch):
-    # Compute min/max lazily
-    x_min = pl.col("x").min()
-    x_max = pl.col("x").max()
-    y_min = pl.col("y").min()
-    y_max = pl.col("y").max()
+def sketch_path(aggregate, v):
+    """Where the sketch of value column v goes next to a kept aggregate"""
+    aggregate = Path(aggregate)
+    return aggregate.with_name(f"{aggregate.stem}.{v.replace(' ', '_')}.sketch.arrow")
+
+
+def quantile_sketch(ldf, keys, v, buckets=QUANTILE_BUCKETS):
+    """
+    (keys, bucket, count) of column v: how many samples of a group fall into each
+    of the fixed buckets over QUANTILE_RANGE. Values outside go to the end buckets.
+    """
+    lo, hi = QUANTILE_RANGE
+    width = (hi - lo) / buckets
+    bucket = ((pl.col(v) - lo) / width).floor().clip(0, buckets - 1).cast(pl.Int32).alias("bucket")
+    return ldf.select(*keys, bucket).group_by([*keys, "bucket"]).agg(pl.len().cast(pl.UInt32).alias("count"))
+
+
+def merge_sketches(sketches, keys):
+    """Sketches of further samples just add to the counts"""
+    return (pl.concat([s.lazy() for s in sketches], how="vertical_relaxed")
+            .group_by([*keys, "bucket"]).agg(pl.col("count").sum()))
+
+
+def sketch_quantile(sketch, keys, v, q, buckets=QUANTILE_BUCKETS):
+    """
+    Quantile q per group of a sketch, the center of the bucket the cumulative
+    count crosses q in, off by at most half a bucket (16 dac steps).
+    """
+    lo, hi = QUANTILE_RANGE
+    width = (hi - lo) / buckets
+    return (
+        sketch.lazy()
+        .sort([*keys, "bucket"])
+        .with_columns(
+            pl.col("count").cum_sum().over(keys).alias("below"),
+            pl.col("count").sum().over(keys).alias("total"),
+        )
+        .filter(pl.col("below") >= q * pl.col("total"))
+        .group_by(keys)
+        .agg(pl.col("bucket").min())
+        .select(*keys, (lo + (pl.col("bucket") + 0.5) * width).alias(v))
+    )
+
+
+def quantiles_from_sketches(sketches, keys, q):
+    """One column per value of sketches (value -> sketch), joined on keys"""
+    result = None
+    for v, sketch in sketches.items():
+        quantile = sketch_quantile(sketch, keys, v, q)
+        result = quantile if result is None else result.join(quantile, on=keys, how="left")
+    return result
+
+
+def aggregate_quantile(ldf, keys, values, q, extras=(), buckets=QUANTILE_BUCKETS):
+    """
+    Quantile q of every column in values per group of keys without holding every
+    sample of a cell: a cell only keeps a count per bucket of the value range
+    (quantile_sketch), so it never grows past buckets entries however many layers
+    are stacked, the samples of every layer just add to the same buckets.
+    """
+    sketches = {v: quantile_sketch(ldf, keys, v, buckets) for v in values}
+    result = quantiles_from_sketches(sketches, keys, q)
+    if extras:
+        result = result.join(ldf.group_by(keys).agg(list(extras)), on=keys, how="left")
+    return result
+
+
+def aggregate_strategy(ldf, keys, values, strategy, extras=()):
+    """Groups by keys and reduces every column in values with one of STRATEGIES"""
+    if strategy in QUANTILES:
+        return aggregate_quantile(ldf, keys, values, QUANTILES[strategy], extras)
+    if strategy == "max":
+        return ldf.group_by(keys).agg([pl.col(v).max() for v in values] + list(extras))
+    return ldf.group_by(keys).agg([pl.col(v).mean() for v in values] + list(extras))
+
+
+def noise_filter(histogram, ch, min_share=0.0, trim=0.0):
+    """
+    Values of ch worth keeping from a (ch, amount) histogram, lazy or not. A value
+    has to make up at least min_share of all samples and lie between the trim and
+    1 - trim quantiles of them. Shares instead of counts, so nth doesn't matter.
+    """
+    total = pl.col("amount").sum()
+    keep = pl.col("amount") >= min_share * total
+    if trim > 0:
+        below = pl.col("amount").cum_sum()
+        keep = keep & (below > trim * total) & (below - pl.col("amount") < (1 - trim) * total)
+    return histogram.lazy().sort(ch).filter(keep).select(ch)
+
+
+def normalize_data(ldf, ch, extent=None):
+    """ch can be a single value column or a list of them, extent = (x_min, x_max, y_min, y_max)"""
+    if extent is None:
+        # Compute min/max lazily
+        x_min = pl.col("x").min()
+        x_max = pl.col("x").max()
+        y_min = pl.col("y").min()
+        y_max = pl.col("y").max()
+    else:
+        x_min, x_max, y_min, y_max = [pl.lit(v) for v in extent]
 
     # Add normalized columns lazily
     ldf = ldf.with_columns([
@@ -123,7 +661,8 @@ def normalize_data(ldf, ch):
     ])
 
     # Select only relevant columns
-    ldf = ldf.select(["x_norm", "y_norm", ch])
+    columns = [ch] if isinstance(ch, str) else list(ch)
+    ldf = ldf.select(["x_norm", "y_norm", *columns])
     return ldf
 
 
@@ -186,37 +725,94 @@ class HistogramFilterTask(QRunnable):
                 on="bin"
             ).sort("count",descending=True)
 
-            hist = final_histogram.collect()
-            histogram = hist.to_numpy()
+            with profiling.stage("HistogramFilterTask", files=len(self.files),
+                                 bytes_on_disk=profiling.bytes_on_disk(self.files)) as st:
+                st.plan(final_histogram)
+                hist = final_histogram.collect()
+                histogram = hist.to_numpy()
+                st.set(rows=len(hist))
 
             self.signals.filteredHistogram.emit(histogram)
             print(histogram)
     
 
 
+def grid_from_aggregate(df, values, size):
+    """Scatters an aggregate with ix, iy cell columns into a (C, size, size) float32 grid, empty cells are NaN"""
+    grid = np.full((len(values), size, size), np.nan, dtype=np.float32)
+    ix = df["ix"].to_numpy()
+    iy = df["iy"].to_numpy()
+    for c, v in enumerate(values):
+        grid[c, iy, ix] = df[v].to_numpy()
+    return grid
+
+
 class DataCarriage(QObject):
-    finished = Signal(object)
+    finished = Signal(object, object)
+    grid_finished = Signal(object, object)
+    extent_finished = Signal(object)
     histogram_finished = Signal(object)
+    channel_histograms_finished = Signal(object)
+    # with keep: the aggregate before normalizing and the sketches per value column
+    kept = Signal(object, object)
+    # the run ended without a result, with a message for the user
+    failed = Signal(str)
 
 class DataWorker(QRunnable):
+    """
+    Aggregates the given layers per (x, y). With all_channels every channel in
+    CHANNELS is aggregated in the same scan, so the view can switch between
+    them without another run.
+    With grid_size the points are binned into a grid_size x grid_size image
+    instead, which is emitted through grid_finished.
+    With roi only the rows inside (x_min, x_max, y_min, y_max) are read and
+    normalized with the given extent of the full view, no histogram is emitted.
+    With energy = (low, high) only samples of ch inside the window are aggregated,
+    the histogram still covers every sample so the window can be widened again.
+    With noise = (min_share, trim) samples whose value of ch is rare or in the
+    outer trim of the histogram are dropped before the aggregation (see noise_filter),
+    with all_channels the whole row goes. Without a histogram of its own (roi, or
+    histogram=False) the filter takes known_histogram, the (value, amount) array
+    of ch over files the view already has, and only counts the layers without one.
+    With keep the points before normalizing (x, y, the values and their sample
+    count) go out through kept once they are shown, with the quantile sketches,
+    the session writes them in the background. Such a file can come back as
+    base = dict(aggregate=path, histogram=array) for a later run over further
+    layers, files then only holds the new layers. Mean and max are merged by
+    count, the quantile strategies merge the sketches next to the file (sketch_path).
+    """
 
-    def __init__(self, nth, ch, files, strategy="mean"):
+    def __init__(self, nth, ch, files, strategy="mean", all_channels=False, grid_size=None, roi=None, extent=None,
+                 energy=None, histogram=True, noise=None, keep=False, base=None, known_histogram=None):
         super().__init__()
         self.nth = nth
         self.ch = ch
         self.files = files
         self.carrier = DataCarriage()
         self.strategy = strategy
+        self.all_channels = all_channels
+        self.grid_size = grid_size
+        self.roi = roi
+        self.extent = extent
+        self.energy = energy
+        self.histogram = histogram
+        self.noise = noise
+        self.keep = keep
+        self.base = base
+        self.known_histogram = known_histogram
 
     def run(self):
             
             if len(self.files) < 1:
                 return
+
+            columns = aggregate_columns(self.ch, self.all_channels)
             
             # 1. Create a list of all LazyFrames
             # This just stores the "instructions" for each file, using almost no RAM
+            energy = None if self.energy is None else (self.ch, *self.energy)
             lazy_plans = [
-                get_df_from_arrow(file, self.ch, self.nth) 
+                get_df_from_arrow(file, columns, self.nth, self.roi, energy) 
                 for file in self.files
             ]
             
@@ -228,85 +824,432 @@ class DataWorker(QRunnable):
             
             ldf = pl.concat(lazy_plans,rechunk=True) if n > 1 else lazy_plans[0]
 
-            histogram = (
-                ldf.group_by(self.ch)
-                .agg(pl.len().alias("amount")) # pl.len() is the most efficient way to count rows
-                .sort(self.ch)
-            )
-            
+            noise_histogram = None
+            if self.roi is None and self.histogram:
+                hist_ldf = ldf
+                if energy is not None:
+                    hist_plans = [get_df_from_arrow(file, columns, self.nth) for file in self.files]
+                    hist_ldf = pl.concat(hist_plans,rechunk=True) if n > 1 else hist_plans[0]
+
+                histograms = [
+                    hist_ldf.group_by(c)
+                    .agg(pl.len().alias("amount")) # pl.len() is the most efficient way to count rows
+                    .sort(c)
+                    for c in columns
+                ]
+
+                # all histograms are collected together so the scan is shared
+                with profiling.stage("DataWorker.histogram", files=n, columns=len(columns),
+                                     bytes_on_disk=profiling.bytes_on_disk(self.files)) as st:
+                    histdfs = pl.collect_all(histograms)
+                    st.set(rows=sum(len(h) for h in histdfs))
+                if self.base is not None and self.base.get("histogram") is not None:
+                    # counts of the layers the base already holds
+                    i = columns.index(self.ch)
+                    h = histdfs[i]
+                    prev = pl.from_numpy(np.asarray(self.base["histogram"]), schema=[self.ch, "amount"], orient="row")
+                    histdfs[i] = (pl.concat([h, prev.cast(h.schema)])
+                                  .group_by(self.ch).agg(pl.col("amount").sum()).sort(self.ch))
+                # Convert to 2D numpy array: [[energy1, count1], [energy2, count2], ...]
+                hists = {c: h.to_numpy() for c, h in zip(columns, histdfs)}
+                noise_histogram = histdfs[columns.index(self.ch)]
+                self.carrier.histogram_finished.emit(hists[self.ch])
+                if self.all_channels:
+                    self.carrier.channel_histograms_finished.emit(hists)
+
+            if self.noise is not None:
+                if noise_histogram is None and self.known_histogram is not None:
+                    noise_histogram = (pl.from_numpy(np.asarray(self.known_histogram), schema=[self.ch, "amount"], orient="row")
+                                       .cast({self.ch: ldf.collect_schema()[self.ch]}))
+                if noise_histogram is None:
+                    # zoomed region or a kept histogram, the counts of the whole layers become part of the plan
+                    noise_plans = [get_df_from_arrow(file, self.ch, self.nth) for file in self.files]
+                    noise_ldf = pl.concat(noise_plans,rechunk=True) if n > 1 else noise_plans[0]
+                    noise_histogram = noise_ldf.group_by(self.ch).agg(pl.len().alias("amount"))
+                # before the group_by, noisy samples are never aggregated or uploaded
+                ldf = ldf.join(noise_filter(noise_histogram, self.ch, *self.noise), on=self.ch, how="semi")
+
+            if self.all_channels:
+                values = columns
+            else:
+                ldf = ldf.select(
+                        pl.col("x"),
+                        pl.col("y"),
+                        (pl.col(self.ch)).alias("value"))
+                values = ["value"]
+
+            keys = ["x", "y"]
+            extras = []
+            if self.grid_size:
+                # bin the coordinates into image cells before aggregating
+                last = self.grid_size - 1
+                # a single row or column of points would divide by zero, it lands in cell 0
+                span = lambda c: pl.when(pl.col(c).max() == pl.col(c).min()).then(1) \
+                    .otherwise(pl.col(c).max() - pl.col(c).min())
+                ldf = ldf.with_columns([
+                    ((pl.col("x") - pl.col("x").min()) / span("x") * last).round().cast(pl.Int32).alias("ix"),
+                    ((pl.col("y") - pl.col("y").min()) / span("y") * last).round().cast(pl.Int32).alias("iy"),
+                ])
+                keys = ["ix", "iy"]
+                # keeps the raw extent around, the view needs it to map zoomed regions back
+                extras = [pl.col("x").min(), pl.col("x").max().alias("x_hi"),
+                          pl.col("y").min(), pl.col("y").max().alias("y_hi")]
+
+            # no sort here, overlapping points are ordered by the depth test in PointCloud2D
+            if self.keep or self.base is not None:
+                extras = extras + [pl.len().alias("count")]
+            sketches = None
+            if self.strategy in QUANTILES and not self.grid_size and (self.keep or self.base is not None):
+                # the sketches are kept, further layers add to their counts
+                sketches = {v: quantile_sketch(ldf, keys, v) for v in values}
+                if self.base is not None:
+                    sketches = {v: merge_sketches([s, pl.scan_ipc(sketch_path(self.base["aggregate"], v))], keys)
+                                for v, s in sketches.items()}
+                with profiling.stage("DataWorker.sketch", files=n, strategy=self.strategy, nth=self.nth):
+                    sketches = dict(zip(values, pl.collect_all(list(sketches.values()))))
+                counts = next(iter(sketches.values())).lazy().group_by(keys).agg(pl.col("count").sum())
+                ldf = quantiles_from_sketches(sketches, keys, QUANTILES[self.strategy]).join(counts, on=keys, how="left")
+            else:
+                ldf = aggregate_strategy(ldf, keys, values, self.strategy, extras)
+                if self.base is not None:
+                    order = [*keys, *values, "count"]
+                    prev = pl.scan_ipc(self.base["aggregate"]).select(order)
+                    if self.strategy == "max":
+                        merged = [pl.col(v).max() for v in values]
+                    else:
+                        merged = [((pl.col(v) * pl.col("count")).sum() / pl.col("count").sum()).alias(v) for v in values]
+                    ldf = (pl.concat([ldf.select(order), prev], how="vertical_relaxed")
+                           .group_by(keys).agg(merged + [pl.col("count").sum()]))
+
+            with profiling.stage("DataWorker.aggregate", files=n, strategy=self.strategy, nth=self.nth,
+                                 bytes_on_disk=profiling.bytes_on_disk(self.files)) as st:
+                st.plan(ldf)
+                df = ldf.collect()
+                st.set(rows=len(df))
+            if len(df) == 0:
+                # nothing matched (empty region, narrow energy window, strict noise filter),
+                # the view still has to hear the run is over
+                self.carrier.finished.emit(np.empty((0, 2 + len(values)), dtype=np.float32), values)
+                return
 
-            #noise_reduced = histogram.select(
-            #        (pl.col("amount") > 1000).alias("reduced"),
-            #        pl.col(self.ch)
-            #        )
+            if self.grid_size:
+                self.carrier.extent_finished.emit(
+                    (df["x"].min(), df["x_hi"].max(), df["y"].min(), df["y_hi"].max()))
+                with profiling.stage("DataWorker.grid", rows=len(df), grid_size=self.grid_size):
+                    grid = grid_from_aggregate(df, values, self.grid_size)
+                self.carrier.grid_finished.emit(grid, values)
+                return
 
-            ldf = ldf.join(histogram, on=self.ch,how="semi")
-    
-            histdf = histogram.collect()
-            # Convert to 2D numpy array: [[energy1, count1], [energy2, count2], ...]
-            hist = histdf.to_numpy()
-            self.carrier.histogram_finished.emit(hist)
+            extent = self.extent
+            if extent is None:
+                extent = (df["x"].min(), df["x"].max(), df["y"].min(), df["y"].max())
+                self.carrier.extent_finished.emit(extent)
 
-            temp = ldf.select(pl.col(self.ch)).collect()
+            with profiling.stage("DataWorker.normalize", rows=len(df)):
+                points = normalize_data(df.lazy(), values, extent).collect()
 
-            ldf = ldf.select(
-                    pl.col("x"),
-                    pl.col("y"),
-                    (pl.col(self.ch)).alias("value"))
-            
-            if self.strategy == "max":
-                ldf = ldf.group_by(["x", "y"]).agg([pl.col("value").max()]).sort("value",descending=True)
-            else:
-                ldf = ldf.group_by(["x", "y"]).agg([pl.col("value").mean()]).sort("value",descending=True)
+            with profiling.stage("DataWorker.to_numpy", rows=len(points)):
+                arr = points.to_numpy()
 
-            ldf = normalize_data(ldf,"value")
+            self.carrier.finished.emit(arr, values)
 
-            df = ldf.collect()
+            if self.keep and self.roi is None:
+                # written by a background task, the next recalculation doesn't wait for the disk
+                self.carrier.kept.emit(df, sketches or dict())
+
+
+class ProbeSignals(QObject):
+    # dict with layers, channels, values (layers, channels, stats), position and radius
+    finished = Signal(object)
+
+class ProbeTask(QRunnable):
+    """
+    Layer by layer mean / max / count of the cell under the dac position x, y.
+    Only layers that have a profile are probed, the others come back as missing
+    for a LayerProfileTask, reading whole layers has no place on an interactive slot.
+    """
+
+    def __init__(self, files, x, y, radius=0):
+        super().__init__()
+        self.files = files
+        self.x = x
+        self.y = y
+        self.radius = radius
+        self.signals = ProbeSignals()
+
+    def run(self):
+        ready, missing = [], []
+        for file in self.files:
+            (ready if has_layer_profile(file) else missing).append(file)
+        with profiling.stage("ProbeTask", files=len(ready), missing=len(missing), radius=self.radius):
+            values = probe_layers(ready, self.x, self.y, self.radius)
+        self.signals.finished.emit(dict(
+            layers=[layer_number(f) for f in ready],
+            channels=CHANNELS,
+            values=values,
+            position=(self.x, self.y),
+            radius=self.radius,
+            missing=missing,
+        ))
+
+
+class LayerProfileSignals(QObject):
+    finished = Signal()
+
+class LayerProfileTask(QRunnable):
+    """Builds the profiles the given layers don't have yet"""
+
+    def __init__(self, files):
+        super().__init__()
+        self.files = files
+        self.signals = LayerProfileSignals()
+
+    def run(self):
+        with profiling.stage("LayerProfileTask", files=len(self.files)):
+            for file in self.files:
+                try:
+                    load_layer_profile(file)
+                except Exception as e:
+                    print(f"No profile for {file}: {e}")
+        self.signals.finished.emit()
+
+
+class LayerStatsSignals(QObject):
+    # layer number -> statistics dict, only the layers this task loaded
+    finished = Signal(object)
 
-            arr = df.to_numpy()
+class LayerStatsTask(QRunnable):
+    """Loads the statistics of the given layers, the timeline only asks for the ones it doesn't have"""
 
-            self.carrier.finished.emit(arr)
+    def __init__(self, files, build=True):
+        super().__init__()
+        self.files = files
+        self.build = build
+        self.signals = LayerStatsSignals()
+
+    def run(self):
+        stats = dict()
+        with profiling.stage("LayerStatsTask", files=len(self.files)):
+            for file in self.files:
+                try:
+                    layer = load_layer_stats(file, self.build)
+                    if layer is not None:
+                        stats[layer_number(file)] = layer
+                except Exception as e:
+                    print(f"No statistics for {file}: {e}")
+        self.signals.finished.emit(stats)
+
+
+def arrow_columns(file):
+    """Column names of an arrow layer, only the schema is read"""
+    return pl.scan_ipc(file).collect_schema().names()
+
+class ColumnsSignals(QObject):
+    # file, its column names
+    finished = Signal(str, object)
+
+class ColumnsTask(QRunnable):
+    """Reads the columns of a layer off the GUI thread, choosing a folder doesn't wait for polars"""
+
+    def __init__(self, file):
+        super().__init__()
+        self.file = file
+        self.signals = ColumnsSignals()
+
+    def run(self):
+        try:
+            columns = arrow_columns(self.file)
+        except Exception as e:
+            print(f"Could not read the columns of {self.file}: {e}")
+            return
+        self.signals.finished.emit(str(self.file), columns)
+
+
+def warm_file(path, chunk=1 << 22):
+    """Gets path into the page cache, the next scan of it doesn't wait for the disk"""
+    with open(path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            # the kernel reads ahead on its own, nothing passes through python
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            return
+        while f.read(chunk):
+            pass
+
+
+class LayerPrefetcher:
+    """
+    Guesses which layers the user looks at next from how the last two layer ranges
+    moved: the next one or two steps in the same direction, both neighbours while
+    there is no direction yet. Remembers what PrefetchTask reported as warmed
+    (warmed), up to budget bytes. A task that was dropped from the queue before
+    it ran didn't warm anything, its layers are chosen again next time.
+    """
+
+    def __init__(self, budget=PREFETCH_BUDGET):
+        self.budget = budget
+        self.previous = None
+        # path -> size of what was warmed, oldest first
+        self.warm = OrderedDict()
+
+    def predict(self, layer, files):
+        """layer = (first, last) as in the sidebar, files = every arrow file of the build"""
+        lo, hi = layer
+        width = max(hi - lo, 1)
+        if self.previous is None or self.previous == tuple(layer):
+            steps = [width, -width]
+        else:
+            step = (hi - self.previous[1]) or (lo - self.previous[0])
+            steps = [step, 2 * step]
+        self.previous = tuple(layer)
+
+        current = set(range(lo - 1, max(hi - 1, lo)))
+        ahead = []
+        for step in steps:
+            for i in range(lo - 1 + step, max(hi - 1, lo) + step):
+                if 0 <= i < len(files) and i not in current and files[i] not in ahead:
+                    ahead.append(files[i])
+        return self._take(ahead)
+
+    def _take(self, files):
+        chosen = []
+        chosen_bytes = 0
+        total = sum(self.warm.values())
+        for file in files:
+            if file in self.warm:
+                self.warm.move_to_end(file)
+                continue
+            size = os.path.getsize(file)
+            # one task never warms more than the budget, a wide range just gets its nearest layers
+            if chosen_bytes + size > self.budget:
+                break
+            chosen.append(file)
+            chosen_bytes += size
+        return chosen
+
+    def warmed(self, file, size):
+        self.warm[file] = size
+        self.warm.move_to_end(file)
+        total = sum(self.warm.values())
+        # the page cache drops old files on its own, they only leave the bookkeeping here
+        while total > self.budget and len(self.warm) > 1:
+            total -= self.warm.popitem(last=False)[1]
+
+    def reset(self):
+        self.previous = None
+        self.warm.clear()
+
+
+class PrefetchSignals(QObject):
+    # path as it was given and size of a file that is in the page cache now
+    warmed = Signal(object, int)
+
+class PrefetchTask(QRunnable):
+    def __init__(self, files):
+        super().__init__()
+        self.files = files
+        self.signals = PrefetchSignals()
+
+    def run(self):
+        with profiling.stage("PrefetchTask", files=len(self.files), bytes_on_disk=profiling.bytes_on_disk(self.files)):
+            for file in self.files:
+                try:
+                    warm_file(file)
+                    self.signals.warmed.emit(file, os.path.getsize(file))
+                except OSError as e:
+                    print(f"Could not prefetch {file}: {e}")
 
 
 class ArrowFileCreatorSignals(QObject):
     finishedTask = Signal()
 
 class CreateArrowFile(QRunnable):
-    def __init__(self,file,number,out_path):
+    """Converts one wav and notes it in the ingest manifest of out_path"""
+    def __init__(self,file,number,out_path,layout="raw"):
         super().__init__()
         self.file = file
         self.number = number
         self.out_path = out_path
+        self.layout = layout
         self.signal = ArrowFileCreatorSignals()
 
     def run(self):
-            
-        create_arrow_from_wav(self.file,self.number,self.out_path)
+        # taken before reading, a file that changes meanwhile counts as changed next time
+        fingerprint = wav_fingerprint(self.file)
+        create_arrow_from_wav(self.file,self.number,self.out_path,layout=self.layout)
+        IngestManifest.open(self.out_path).record(self.file, self.number, fingerprint, self.layout)
         print(f"Layer {self.number} created")
         self.signal.finishedTask.emit()
             
 
+class WavTailSignals(QObject):
+    # path, aggregated rows (x, y, *columns) as a polars DataFrame, names of the value columns
+    chunk = Signal(str, object, object)
+    finished = Signal(str)
+
+class WavTailTask(QRunnable):
+    """
+    Follows a wav file the machine is still writing. Every interval the new
+    frames are aggregated per (x, y) like DataWorker does and sent as a chunk.
+    Runs until stop(), which the watchdog calls once the file is closed, or
+    until the file stopped growing for idle_timeout seconds.
+    """
+
+    def __init__(self, path, ch="mean", all_channels=False, strategy="mean", interval=0.5, idle_timeout=60):
+        super().__init__()
+        self.path = path
+        self.ch = ch
+        self.all_channels = all_channels
+        self.strategy = strategy
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.signals = WavTailSignals()
+        self._keep_running = True
+
+    def run(self):
+        tail = WavTail(self.path)
+        idle = 0.0
+        try:
+            while self._keep_running and idle < self.idle_timeout:
+                if self._read(tail):
+                    idle = 0.0
+                else:
+                    time.sleep(self.interval)
+                    idle += self.interval
+            # whatever was written right before the close
+            self._read(tail)
+        except (OSError, ValueError) as e:
+            print(f"Tailing {self.path} failed: {e}")
+        self.signals.finished.emit(self.path)
+
+    def _read(self, tail):
+        data = tail.read_new()
+        if data is None or len(data) == 0:
+            return False
+
+        columns = aggregate_columns(self.ch, self.all_channels)
+        values = columns if self.all_channels else ["value"]
+        with profiling.stage("WavTailTask.chunk", frames=len(data)) as st:
+            ldf = frames_to_df(data).lazy().select(["x", "y", *columns])
+            if not self.all_channels:
+                ldf = ldf.rename({self.ch: "value"})
+            ldf = aggregate_strategy(ldf, ["x", "y"], values, self.strategy)
+            df = ldf.collect()
+            st.set(rows=len(df))
+        self.signals.chunk.emit(self.path, df, values)
+        return True
+
+    def stop(self):
+        self._keep_running = False
+
+
 class WatchdogSignals(QObject):
     startWatching = Signal(str)
     stopWatching = Signal()
     file_ready = Signal(str)
+    # first write to a new wav, the file is still open
+    file_growing = Signal(str)
     error = Signal(str)
 
-class WatchdogObserver(FileSystemEventHandler):
-    def __init__(self, signals):
-        super().__init__()
-        self.signals = signals
-
-    def on_closed(self, event):
-        # IN_CLOSE_WRITE: The file descriptor is released after writing.
-        if not event.is_directory and event.src_path.lower().endswith('.wav'):
-            self.signals.file_ready.emit(event.src_path)
-
-    def on_moved(self, event):
-        # Handle 'Atomic Saves': Temp file is moved to final destination.
-        if not event.is_directory and event.src_path.lower().endswith('.wav'):
-            self.signals.file_ready.emit(event.src_path)
-
 class AsyncWatchdogTask(QRunnable):
     """
     The background task managed by QThreadPool.
@@ -315,12 +1258,15 @@ class AsyncWatchdogTask(QRunnable):
         super().__init__()
         self.watch_path = watch_path
         self.signals = WatchdogSignals()
-        self.observer = Observer()
+        self.observer = None
         self._keep_running = True
 
     def run(self):
         try:
-            handler = WatchdogObserver(self.signals)
+            # watchdog is only imported once it is deployed
+            import watcher
+            self.observer = watcher.Observer()
+            handler = watcher.WatchdogObserver(self.signals)
             self.observer.schedule(handler, self.watch_path, recursive=False)
             self.observer.start()
 
@@ -343,33 +1289,9 @@ class AsyncWatchdogTask(QRunnable):
         self._keep_running = False
 
 
-class WavHandler(FileSystemEventHandler):
-    def __init__(self, signal):
-        self.signal = signal
-
-    def on_created(self, event):
-        if not event.is_directory and event.src_path.endswith('.wav'):
-            self.signal.emit(event.src_path)
-
-class FolderWatcher(object):
-    file_detected = Signal(str)
-
-    def __init__(self, folder_path):
-        super().__init__()
-        self.folder_path = folder_path
-        self.observer = Observer()
-
-    def start_watching(self):
-            event_handler = WavHandler(self.file_detected)
-            self.observer.schedule(event_handler, self.folder_path, recursive=False)
-            self.observer.start()
-
-    def stop_watching(self):
-        self.observer.stop()
-        self.observer.join()
-
-
 def compile_shader(src, stype):
+    from OpenGL.GL import (glCreateShader, glShaderSource, glCompileShader, glGetShaderiv,
+                           GL_COMPILE_STATUS, glGetShaderInfoLog)
     s = glCreateShader(stype)
     glShaderSource(s, src)
     glCompileShader(s)
@@ -5,9 +5,14 @@ from __future__ import annotations
 
 
 import sys
-from PySide6.QtCore import Qt, Signal, QThread, QThreadPool
+# first, so the imports below are timed against the startup budget
+import startup
+startup.profile_imports()
+# sets the polars thread count, has to come before anything that imports polars
+import scheduler
+from PySide6.QtCore import Qt, Signal, QThread, QTimer
 from PySide6.QtGui import QSurfaceFormat
-from PySide6.QtWidgets import QApplication,QSlider, QHBoxLayout,QVBoxLayout, QWidget, QLabel, QPushButton, QSpinBox, QComboBox, QFileDialog, QTabWidget, QTextEdit
+from PySide6.QtWidgets import QApplication,QSlider, QHBoxLayout,QVBoxLayout, QWidget, QLabel, QPushButton, QSpinBox, QComboBox, QFileDialog, QTabWidget, QTextEdit, QMessageBox
 
 from PySide6.QtOpenGLWidgets import QOpenGLWidget
 
@@ -16,6 +21,12 @@ from pathlib import Path
 import helperfunctions as helpers
 import numpy as np
 import openglwidget as glw
+import offscreen
+import dataexport
+import render_cli
+import service
+import session
+import volume
 import sidebar as sidebar
 import faulthandler
 
@@ -23,6 +34,16 @@ import faulthandler
 faulthandler.enable(file=sys.stderr, all_threads=True)
 
 
+# x, y range of the beam deflection, live points use it until there is a calculated extent
+LIVE_EXTENT = (-32768, 32767, -32768, 32767)
+
+
+def files_for(arrow_files, layer):
+    if layer[0] == layer[1]:
+        return [arrow_files[layer[0]-1]]
+    return arrow_files[layer[0]-1:layer[1]-1]
+
+
 class VisualizerTab(QWidget):
 
     def __init__(self, parent=None):
@@ -35,24 +56,69 @@ class VisualizerTab(QWidget):
         self.glwidget.setMinimumSize(700, 700)
         self.glwidget.set_point_size(3.0)
         self.glwidget.set_value_range((0,2**15))
+        self.volumewidget = glw.VolumeWidget(parent=self)
+        self.volumewidget.set_value_range((0,2**15))
+
+        self.views = QTabWidget()
+        self.views.addTab(self.glwidget, "2D")
+        self.views.addTab(self.volumewidget, "3D volume")
 
-        mainLayout.addWidget(self.glwidget)
+        mainLayout.addWidget(self.views)
         mainLayout.addWidget(self.sidebar)
         
         '''Draw Connections'''
         self.sidebar.energyChanged.connect(self.glwidget.set_value_range)
+        self.sidebar.energyChanged.connect(self.volumewidget.set_value_range)
         self.sidebar.pointsizeChanged.connect(self.glwidget.set_point_size)
+        self.sidebar.channelChanged.connect(self.glwidget.set_channel)
+        self.sidebar.timingToggled.connect(self.glwidget.set_show_timing)
+        self.sidebar.timingToggled.connect(self.volumewidget.set_show_timing)
+        self.sidebar.adaptiveToggled.connect(self.glwidget.set_adaptive)
+        self.sidebar.packedToggled.connect(self.glwidget.set_packed)
+        self.sidebar.serviceToggled.connect(self.toggle_service)
+        self.glwidget.viewSettled.connect(self.handle_view_settled)
+        self.glwidget.pointProbed.connect(self.handle_probe)
+        self.sidebar.liveChunk.connect(self.on_live_chunk)
+        self.sidebar.liveFinished.connect(self.on_live_finished)
+        self.views.currentChanged.connect(self.update_volume)
+        self.sidebar.layersChanged.connect(self.update_volume)
         '''Calculation Connections'''
         self.sidebar.begincalculation.connect(self.handle_array_update)
         self.sidebar.export.connect(self.export)
+        self.sidebar.exportData.connect(self.export_data)
         self.setWindowTitle(self.tr("Ebm Visualisation"))
 
+        # what the current picture was calculated from, the zoomed region recompute reuses it
+        self.last_request = None
+        self.last_histogram = None
+        self.extent = None
+        self.roi = None
+        # surface of the running png export, held until it is done, one export at a time
+        self.export_surface = None
+        self.scheduler = scheduler.instance()
+        # warms the layers the slider is likely to move to next
+        self.prefetcher = helpers.LayerPrefetcher()
+        self.prefetch_folder = None
+
+        # wav that is shown live and whether its arrow layer exists by now
+        self.live_path = None
+        self.live_done = False
+        # layer number of the finished live wav, set with live_done
+        self.live_layer = None
+        self.clear_live_on_result = False
+        # dac position of the last probe, a late profile build only probes it again if it is still current
+        self.probe_position = None
+
     def handle_array_update(self):
         nth = self.sidebar.getResolution()
         ch = self.sidebar.getChannel()
         layer = self.sidebar.getLayer()
         folder = self.sidebar.getArrowFolder()
         strategy = self.sidebar.getStrategy()
+        all_channels = self.sidebar.getAllChannels()
+        grid_size = self.sidebar.getGridSize() if self.sidebar.getRenderMode() == "image" else None
+        energy = self.sidebar.getEnergyFilter()
+        noise = self.sidebar.getNoiseFilter()
 
         arrow_files = helpers.get_arrow_files(folder.absolutePath())
         if layer[1]-1 not in range(len(arrow_files)):
@@ -61,44 +127,339 @@ class VisualizerTab(QWidget):
         #worker = helpers.DataWorker(nth, ch, [arrow_files[layer[1]-1]])
 
         #print(layer)
-        if layer[0] == layer[1]:
-            worker = helpers.DataWorker(nth, ch, [arrow_files[layer[0]-1]], strategy)
-        else :
-            worker = helpers.DataWorker(nth, ch, arrow_files[layer[0]-1:layer[1]-1], strategy)
+        files = files_for(arrow_files, layer)
+        # points before normalizing go to the session, the snapshot of an image is the grid itself
+        keep = grid_size is None
+        keep_histogram = self.sidebar.getKeepHistogram()
+        # the noise filter counts with the kept histogram instead of scanning the layers for it again
+        worker = self.worker_class()(nth, ch, files, strategy, all_channels, grid_size,
+                                     energy=energy, histogram=not keep_histogram, noise=noise, keep=keep,
+                                     known_histogram=self.last_histogram if keep_histogram else None)
 
-        self.pool = QThreadPool.globalInstance()
+        self.last_request = dict(ch=ch, files=files, strategy=strategy, all_channels=all_channels, energy=energy,
+                                 noise=noise, nth=nth, layer=layer, follow=layer[1] == len(arrow_files),
+                                 grid_size=grid_size)
+        self.extent = None
+        self.roi = None
+        # only a result that includes the finished live layer replaces its live points,
+        # the newest layer is left out by the slicing above
+        self.clear_live_on_result = self.live_done and any(
+            helpers.layer_number(f) == self.live_layer for f in files)
 
-        worker.carrier.finished.connect(self.on_data_received)
-        worker.carrier.histogram_finished.connect(self.sidebar.updateHistogram)
-        self.pool.start(worker)
+        self.connect_view_worker(worker)
+        # a newer request replaces one that is still queued
+        self.scheduler.submit(worker, scheduler.INTERACTIVE, key="view")
+
+        if folder.absolutePath() != self.prefetch_folder:
+            self.prefetcher.reset()
+            self.prefetch_folder = folder.absolutePath()
+        ahead = self.prefetcher.predict(layer, arrow_files)
+        if ahead:
+            # background, so it starts once the recalculation above is done
+            task = helpers.PrefetchTask(ahead)
+            task.signals.warmed.connect(self.prefetcher.warmed)
+            self.scheduler.submit(task, scheduler.BACKGROUND, key="prefetch")
+        # the channel may have changed
+        self.update_volume()
 
         self.sidebar.startCalculation()
 
-    def on_data_received(self, arr):
+    def connect_view_worker(self, worker):
+        request = self.last_request
+        worker.carrier.finished.connect(self.on_data_received)
+        worker.carrier.grid_finished.connect(self.on_grid_received)
+        worker.carrier.extent_finished.connect(self.set_extent)
+        worker.carrier.histogram_finished.connect(self.sidebar.updateHistogram)
+        worker.carrier.histogram_finished.connect(self.set_histogram)
+        worker.carrier.channel_histograms_finished.connect(self.sidebar.setChannelHistograms)
+        worker.carrier.failed.connect(self.on_calculation_failed)
+        worker.carrier.kept.connect(lambda df, sketches: self.save_session(request, aggregate=df, sketches=sketches))
+        worker.carrier.grid_finished.connect(lambda grid, values: self.save_session(request, grid=grid))
+
+    def on_data_received(self, arr, channels):
         arr = np.ascontiguousarray(arr)
-        self.glwidget.set_points(arr)
+        self.glwidget.set_channel(self.sidebar.getChannel())
+        self.glwidget.set_points(arr, channels)
+        self.finish_live()
+        self.sidebar.finishCalculation()
+
+    def on_grid_received(self, grid, channels):
+        self.glwidget.set_channel(self.sidebar.getChannel())
+        self.glwidget.set_grid(grid, channels)
+        self.finish_live()
+        self.sidebar.finishCalculation()
+
+    def on_calculation_failed(self, message):
         self.sidebar.finishCalculation()
+        QMessageBox.warning(self, "Calculation failed", message)
+
+    def on_live_chunk(self, path, df, values):
+        if path != self.live_path:
+            # the next layer started
+            self.glwidget.clear_live()
+            self.live_path = path
+            self.live_done = False
+        # normalized like the calculated view, before the first calculation the whole dac range
+        extent = self.extent if self.extent is not None else LIVE_EXTENT
+        arr = helpers.normalize_data(df.lazy(), values, extent).collect().to_numpy()
+        self.glwidget.append_live(arr)
+
+    def on_live_finished(self, path):
+        if path == self.live_path:
+            self.live_done = True
+            folder = self.sidebar.getArrowFolder().absolutePath()
+            self.live_layer = helpers.IngestManifest.open(folder).layer_for(path)
+
+    def finish_live(self):
+        if self.clear_live_on_result:
+            self.glwidget.clear_live()
+            self.live_path = None
+            self.live_done = False
+            self.live_layer = None
+            self.clear_live_on_result = False
+
+    def set_extent(self, extent):
+        self.extent = extent
+
+    def set_histogram(self, hist):
+        self.last_histogram = hist
+
+    def save_session(self, request, aggregate=None, sketches=None, grid=None):
+        """Snapshot of the view request produced, in the background so the view stays responsive"""
+        # a newer view went out in the meantime
+        if request is not self.last_request:
+            return
+        path = None if aggregate is None else session.new_aggregate_path()
+        values = helpers.aggregate_columns(request["ch"], True) if request["all_channels"] else ["value"]
+        settings = dict(
+            self.sidebar.getSessionSettings(),
+            layer=list(request["layer"]),
+            channel=request["ch"],
+            strategy=request["strategy"],
+            nth=request["nth"],
+            all_channels=request["all_channels"],
+            energy_filter=request["energy"],
+            noise=request["noise"],
+            files=session.file_state(request["files"]),
+            follow=request["follow"],
+            extent=self.extent,
+            values=values,
+            view=[self.glwidget.zoom, self.glwidget.pan_x, self.glwidget.pan_y],
+            aggregate=None if path is None else path.name,
+        )
+        task = session.SessionSaveTask(settings, self.last_histogram, grid, aggregate, sketches)
+        self.scheduler.submit(task, scheduler.BACKGROUND, key="session")
+
+    def restore_session(self):
+        """Shows the view of the last session right away and brings it up to date"""
+        task = session.SessionLoadTask()
+        task.signals.loaded.connect(self.on_session_loaded)
+        self.scheduler.submit(task, scheduler.INTERACTIVE, key="session load")
+
+    def on_session_loaded(self, snapshot):
+        settings = snapshot["settings"]
+        if not Path(settings["arrow_folder"]).exists():
+            return
+
+        # the histogram sets the range of the energy slider, the settings then its value
+        if snapshot["histogram"] is not None:
+            self.last_histogram = np.array(snapshot["histogram"])
+            self.sidebar.updateHistogram(self.last_histogram)
+        self.sidebar.applySessionSettings(settings)
+        self.extent = None if settings["extent"] is None else tuple(settings["extent"])
+        self.glwidget.set_channel(settings["channel"])
+        if settings["render_mode"] == "image" and snapshot["grid"] is not None:
+            self.glwidget.set_grid(np.array(snapshot["grid"]), settings["values"])
+        elif snapshot["points"] is not None:
+            self.glwidget.set_points(np.ascontiguousarray(snapshot["points"]), settings["values"])
+        self.glwidget.set_view(*settings["view"])
+
+        tuple_or_none = lambda v: None if v is None else tuple(v)
+        self.last_request = dict(ch=settings["channel"], files=[f for f, _ in settings["files"]],
+                                 strategy=settings["strategy"], all_channels=settings["all_channels"],
+                                 energy=tuple_or_none(settings["energy_filter"]),
+                                 noise=tuple_or_none(settings["noise"]), nth=settings["nth"],
+                                 layer=tuple(settings["layer"]), follow=settings["follow"],
+                                 grid_size=settings["grid_size"] if settings["render_mode"] == "image" else None)
+        self.refresh_session(snapshot)
+
+    def refresh_session(self, snapshot):
+        """Layers written while the viewer was down: merged into the snapshot where that works, else a full run"""
+        settings = snapshot["settings"]
+        if not session.unchanged(settings):
+            print("Layers changed since the session was saved, calculating again")
+            self.handle_array_update()
+            return
+        if not settings["follow"]:
+            return
+
+        arrow_files = helpers.get_arrow_files(settings["arrow_folder"])
+        layer = (settings["layer"][0], len(arrow_files))
+        files = files_for(arrow_files, layer)
+        known = {f for f, _ in settings["files"]}
+        added = [f for f in files if str(f) not in known]
+        if not added:
+            return
+        self.sidebar.showLayers(layer)
+        if not session.can_merge(settings) or len(files) != len(known) + len(added):
+            self.handle_array_update()
+            return
+
+        print(f"Merging {len(added)} new layers into the session")
+        base = dict(aggregate=str(snapshot["aggregate"]), histogram=self.last_histogram)
+        worker = self.worker_class()(settings["nth"], settings["channel"], added, settings["strategy"],
+                                     histogram=self.last_histogram is not None, keep=True, base=base)
+        self.last_request = dict(self.last_request, files=files, layer=layer)
+        self.extent = None
+        self.connect_view_worker(worker)
+        self.scheduler.submit(worker, scheduler.INTERACTIVE, key="view")
+        self.sidebar.startCalculation()
+
+    def handle_view_settled(self, bounds):
+        """Recomputes the visible region with every sample once the user zoomed in"""
+        if not self.sidebar.getRoiMode() or self.last_request is None or self.extent is None:
+            return
+        if self.glwidget.zoom <= 1.0:
+            self.roi = None
+            self.glwidget.clear_overlay()
+            return
+
+        # visible bounds are in the normalized -1..1 space, the files in raw dac values
+        x_min, x_max, y_min, y_max = self.extent
+        to_x = lambda v: x_min + (v + 1.0) * 0.5 * (x_max - x_min)
+        to_y = lambda v: y_min + (v + 1.0) * 0.5 * (y_max - y_min)
+        roi = (to_x(bounds[0]), to_x(bounds[1]), to_y(bounds[2]), to_y(bounds[3]))
+        self.roi = roi
+
+        request = self.last_request
+        worker = self.worker_class()(1, request["ch"], request["files"], request["strategy"],
+                                     request["all_channels"], roi=roi, extent=self.extent,
+                                     energy=request["energy"], noise=request["noise"],
+                                     known_histogram=self.last_histogram)
+        worker.carrier.finished.connect(
+            lambda arr, channels: self.on_roi_received(arr, roi, bounds))
+        self.scheduler.submit(worker, scheduler.INTERACTIVE, key="roi")
+
+    def handle_probe(self, x, y):
+        """Layer by layer statistics of the clicked spot over the whole build"""
+        if self.extent is None:
+            return
+        x_min, x_max, y_min, y_max = self.extent
+        x = x_min + (x + 1.0) * 0.5 * (x_max - x_min)
+        y = y_min + (y + 1.0) * 0.5 * (y_max - y_min)
+        self.probe(x, y)
+
+    def probe(self, x, y, build_missing=True):
+        """Probes the layers that have a profile, the missing ones are built in the background and probed after"""
+        files = helpers.get_arrow_files(self.sidebar.getArrowFolder().absolutePath())
+        if not files:
+            return
+        self.probe_position = (x, y)
+        task = helpers.ProbeTask(files, x, y, self.sidebar.getProbeRadius())
+        task.signals.finished.connect(self.sidebar.showProbe)
+        if build_missing:
+            task.signals.finished.connect(self.build_missing_profiles)
+        self.scheduler.submit(task, scheduler.INTERACTIVE, key="probe")
+        self.sidebar.startProbe(x, y)
+
+    def build_missing_profiles(self, probe):
+        if not probe["missing"]:
+            return
+        position = probe["position"]
+        task = helpers.LayerProfileTask(probe["missing"])
+        # probed again with every layer, unless the user clicked somewhere else meanwhile
+        task.signals.finished.connect(
+            lambda: position == self.probe_position and self.probe(*position, build_missing=False))
+        self.scheduler.submit(task, scheduler.BACKFILL, key="layer profiles")
+
+    def worker_class(self):
+        """RemoteDataWorker takes the same arguments and emits the same signals as DataWorker"""
+        return service.RemoteDataWorker if self.sidebar.getUseService() else helpers.DataWorker
+
+    def toggle_service(self, on):
+        if on and service.start_service():
+            print("Started the aggregation service, requests until it listens are aggregated here")
+
+    def update_volume(self):
+        """Adds the layers the volume of the shown channel lacks, only while the 3D view is open"""
+        if self.views.currentWidget() is not self.volumewidget:
+            return
+        folder = self.sidebar.getArrowFolder().absolutePath()
+        if not helpers.get_arrow_files(folder):
+            return
+        # the sensor columns only, the volume has no use for derived ones
+        channel = self.sidebar.getChannel() if self.sidebar.getChannel() in helpers.CHANNELS else "mean"
+        self.volumewidget.set_volume(volume.volume_path(folder, channel))
+        task = volume.VolumeBuildTask(folder, channel)
+        task.signals.progress.connect(lambda layers: self.volumewidget.volume_changed())
+        self.scheduler.submit(task, scheduler.BACKFILL, key="volume")
+
+    def on_roi_received(self, arr, roi, bounds):
+        # the user may have moved on in the meantime
+        if roi != self.roi:
+            return
+        self.glwidget.set_overlay(np.ascontiguousarray(arr), bounds)
 
     def export(self):
-        image = self.glwidget.grabFramebuffer()
-        
-        success = image.save("output_capture.png", "PNG")
-        
+        """Renders the current view at the export width in tiles on a background thread"""
+        if self.export_surface is not None:
+            # its context still uses the surface, and both would write the same png
+            return
+        width = self.sidebar.getExportWidth()
+        height = max(1, round(width * self.glwidget.height() / max(1, self.glwidget.width())))
+        scale = width / max(1, self.glwidget.width() * self.glwidget.devicePixelRatio())
+
+        # the surface has to be created here in the GUI thread, the task makes its own context on it
+        self.export_surface = offscreen.create_surface()
+        view = (self.glwidget.zoom, self.glwidget.pan_x, self.glwidget.pan_y)
+        task = offscreen.TiledExportTask(self.export_surface, self.glwidget.renderer, view,
+                                         width, height, "output_capture.png", point_scale=scale)
+        task.signals.finished.connect(self.on_export_finished)
+        self.scheduler.submit(task, scheduler.BACKGROUND)
+        self.sidebar.startExport()
+
+    def export_data(self):
+        """Streams the aggregate of the shown view to a file in exports, on a background thread"""
+        request = self.last_request
+        if request is None:
+            return
+        fmt = self.sidebar.getExportFormat()
+        files = request["files"]
+        first, last = helpers.layer_number(files[0]), helpers.layer_number(files[-1])
+        # one folder per build, like the command line export
+        out_dir = render_cli.build_folder("exports", Path(files[0]).parent)
+        path = dataexport.export_path(out_dir, first, last, request["ch"], fmt)
+        task = dataexport.ExportTask(path, files, fmt, ch=request["ch"], nth=request["nth"],
+                                     strategy=request["strategy"], all_channels=request["all_channels"],
+                                     cells=request["grid_size"], energy=request["energy"], noise=request["noise"])
+        task.signals.finished.connect(self.on_data_export_finished)
+        self.scheduler.submit(task, scheduler.BACKGROUND)
+        self.sidebar.startDataExport()
+
+    def on_data_export_finished(self, path, success):
+        if success:
+            print(f"Exported the values to {path}")
+        self.sidebar.finishDataExport()
+
+    def on_export_finished(self, path, success):
         if success:
             print("Export successful!")
         else:
             print("Export failed.")
+        self.export_surface = None
+        self.sidebar.finishExport()
 
     def closeEvent(self, event):
             """
-            Wait for all threads in the global pool to finish 
+            Wait for the running tasks to finish
             before allowing the window to close.
             """
-            pool = QThreadPool.globalInstance()
-            
-            # This tells the pool not to start any NEW tasks
-            # and waits for current ones to finish.
-            pool.waitForDone() 
+            if self.sidebar.watchdog.isRunning():
+                self.sidebar.flip_watchdog()
+
+            # This drops queued recalculations and waits for the rest,
+            # pending layers of the melt are still written.
+            self.scheduler.wait_for_done()
             
             event.accept()
 
@@ -117,10 +478,15 @@ if __name__ == "__main__":
     fmt = QSurfaceFormat()
     fmt.setVersion(3, 3)
     fmt.setProfile(QSurfaceFormat.CoreProfile)
+    # PointCloud2D orders overlapping points with the depth test
+    fmt.setDepthBufferSize(24)
     QSurfaceFormat.setDefaultFormat(fmt)
     
     visualizerTab = VisualizerTab()
     visualizerTab.show()
+    # once the window is up, the last session and the heavy modules follow
+    QTimer.singleShot(0, startup.window_shown)
+    QTimer.singleShot(0, visualizerTab.restore_session)
     sys.exit(app.exec())
 
 
@@ -0,0 +1,221 @@
+
+"""
+Rendering of the 2D view without a window. Uses the same PointRenderer
+(and therefore the same shaders) as PointCloud2D, only on a QOffscreenSurface
+with a framebuffer object as target.
+"""
+import struct
+import zlib
+
+import numpy as np
+from PySide6.QtCore import QObject, QRunnable, Signal
+from PySide6.QtGui import QOffscreenSurface, QOpenGLContext, QSurfaceFormat, QImage
+from PySide6.QtOpenGL import QOpenGLFramebufferObject, QOpenGLFramebufferObjectFormat
+
+from OpenGL.GL import glViewport, glReadPixels, glFinish, GL_RGBA, GL_UNSIGNED_BYTE
+
+import openglwidget as glw
+
+
+def default_format():
+    fmt = QSurfaceFormat()
+    fmt.setVersion(3, 3)
+    fmt.setProfile(QSurfaceFormat.CoreProfile)
+    fmt.setDepthBufferSize(24)
+    return fmt
+
+
+def create_surface(fmt=None):
+    """Has to be called from the GUI thread, the context using it can live in any thread"""
+    surface = QOffscreenSurface()
+    surface.setFormat(fmt or default_format())
+    surface.create()
+    return surface
+
+
+def image_from_array(rgba):
+    """(H, W, 4) uint8 -> QImage, copied so it doesn't depend on the numpy buffer"""
+    rgba = np.ascontiguousarray(rgba)
+    h, w = rgba.shape[:2]
+    return QImage(rgba.data, w, h, 4 * w, QImage.Format_RGBA8888).copy()
+
+
+class OffscreenRenderer:
+    """Own GL context + fbo of width x height pixels with a PointRenderer on it"""
+
+    def __init__(self, width, height, surface=None):
+        self.surface = surface if surface is not None else create_surface()
+
+        self.context = QOpenGLContext()
+        self.context.setFormat(self.surface.format())
+        if not self.context.create():
+            raise RuntimeError("could not create an offscreen OpenGL context")
+        self.make_current()
+
+        self.renderer = glw.PointRenderer()
+        self.renderer.initialize()
+
+        self.fbo = None
+        self.resize(width, height)
+
+    def make_current(self):
+        if not self.context.makeCurrent(self.surface):
+            raise RuntimeError("could not make the offscreen OpenGL context current")
+
+    def resize(self, width, height):
+        self.make_current()
+        self.width = int(width)
+        self.height = int(height)
+        fbo_format = QOpenGLFramebufferObjectFormat()
+        fbo_format.setAttachment(QOpenGLFramebufferObject.CombinedDepthStencil)
+        self.fbo = QOpenGLFramebufferObject(self.width, self.height, fbo_format)
+
+    def render(self, transform=None):
+        """Returns the frame as (H, W, 4) uint8, first row is the top of the image"""
+        if transform is None:
+            transform = glw.make_transform(1.0, 0.0, 0.0)
+
+        self.make_current()
+        self.fbo.bind()
+        glViewport(0, 0, self.width, self.height)
+        self.renderer.paint(transform, self.width, self.height)
+        glFinish()
+        pixels = glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE)
+        self.fbo.release()
+
+        # OpenGL starts at the bottom row
+        return np.frombuffer(pixels, dtype=np.uint8).reshape(self.height, self.width, 4)[::-1]
+
+    def release(self):
+        self.context.doneCurrent()
+
+    def destroy(self):
+        # the fbo has to go while its context is still current
+        self.make_current()
+        self.renderer.cleanup()
+        self.fbo = None
+        self.context.doneCurrent()
+
+
+class PngStreamWriter:
+    """Writes an RGB png row band by row band, only the current band is ever in memory"""
+
+    def __init__(self, path, width, height):
+        self.width = width
+        self.height = height
+        self.file = open(path, "wb")
+        self.compressor = zlib.compressobj(6)
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bit, color type 2 (RGB), no interlacing
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def write_rows(self, rows):
+        """rows: (N, width, 3) uint8, top to bottom"""
+        raw = np.zeros((len(rows), 1 + self.width * 3), dtype=np.uint8)
+        # first byte of every row is the filter type, 0 = none
+        raw[:, 1:] = rows.reshape(len(rows), -1)
+        data = self.compressor.compress(raw.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def close(self):
+        self._chunk(b"IDAT", self.compressor.flush())
+        self._chunk(b"IEND", b"")
+        self.file.close()
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+
+def render_tiled(offscreen, view, width, height, writer):
+    """
+    Renders view = (zoom, pan_x, pan_y) at width x height pixels in tiles of the
+    offscreen fbo size and hands the image to writer one band of tile rows at a time.
+    """
+    zoom, pan_x, pan_y = view
+    tile_w, tile_h = offscreen.width, offscreen.height
+    # every tile sees the full -1..1 view stretched so its part fills the fbo
+    scale_x = width / tile_w
+    scale_y = height / tile_h
+
+    for top in range(0, height, tile_h):
+        band_h = min(tile_h, height - top)
+        band = np.empty((band_h, width, 3), dtype=np.uint8)
+        # OpenGL counts rows from the bottom
+        y0 = height - top - tile_h
+        center_y = -1.0 + (2.0 * y0 + tile_h) / height
+
+        for x0 in range(0, width, tile_w):
+            center_x = -1.0 + (2.0 * x0 + tile_w) / width
+            transform = glw.make_transform(
+                zoom * scale_x, (pan_x - center_x) * scale_x, (pan_y - center_y) * scale_y,
+                zoom_y=zoom * scale_y,
+            )
+            pixels = offscreen.render(transform)
+            part_w = min(tile_w, width - x0)
+            band[:, x0:x0 + part_w] = pixels[:band_h, :part_w, :3]
+
+        writer.write_rows(band)
+        yield top + band_h
+
+
+class ExportSignals(QObject):
+    progress = Signal(int)
+    finished = Signal(str, bool)
+
+
+class TiledExportTask(QRunnable):
+    """
+    Renders a copy of the given PointRenderer state in its own context and streams it into a png.
+    The surface has to come from the GUI thread, see create_surface.
+    """
+
+    def __init__(self, surface, source, view, width, height, path, tile=2048, point_scale=1.0):
+        super().__init__()
+        self.surface = surface
+        self.source = source
+        self.view = view
+        self.width = width
+        self.height = height
+        self.path = path
+        self.tile = tile
+        self.point_scale = point_scale
+        self.signals = ExportSignals()
+
+    def run(self):
+        offscreen = None
+        try:
+            offscreen = OffscreenRenderer(self.tile, self.tile, self.surface)
+            self._copy_state(offscreen.renderer)
+
+            writer = PngStreamWriter(self.path, self.width, self.height)
+            for rows in render_tiled(offscreen, self.view, self.width, self.height, writer):
+                self.signals.progress.emit(int(100 * rows / self.height))
+            writer.close()
+            self.signals.finished.emit(self.path, True)
+        except Exception as e:
+            print(f"Export failed: {e}")
+            self.signals.finished.emit(self.path, False)
+        finally:
+            if offscreen is not None:
+                offscreen.destroy()
+
+    def _copy_state(self, renderer):
+        source = self.source
+        renderer.vmin = source.vmin
+        renderer.vmax = source.vmax
+        renderer.channel = source.channel
+        renderer.packed = source.packed
+        # points keep their look relative to the image size
+        renderer.point_size = source.point_size * self.point_scale
+        if source.render_mode == "image" and source.grid is not None:
+            renderer.set_grid(source.grid, source.channels)
+        elif source.data is not None:
+            renderer.set_points(source.data, source.channels)
+        if source.live_chunks:
+            renderer.append_live(np.concatenate(source.live_chunks))
+        if source.overlay is not None:
+            renderer.set_overlay(source.overlay, source.overlay_bounds)
@@ -1,27 +1,44 @@
 
 import helperfunctions as helpers
+import profiling
+import volume
 import sys
-from PySide6.QtCore import Qt, Signal
-from PySide6.QtGui import QSurfaceFormat
+import heapq
+from collections import OrderedDict
+import math
+from PySide6.QtCore import Qt, Signal, QTimer
+from PySide6.QtGui import QSurfaceFormat, QPainter, QColor
 from PySide6.QtWidgets import QApplication, QHBoxLayout,QVBoxLayout, QWidget, QLabel, QPushButton
 
 from threading import Lock
+import time
 from PySide6.QtOpenGLWidgets import QOpenGLWidget
 import numpy as np
 import ctypes
 from OpenGL.GL import (
-    glClearColor, glClear, GL_COLOR_BUFFER_BIT,
+    glClearColor, glClear, GL_COLOR_BUFFER_BIT, GL_DEPTH_BUFFER_BIT,
+    GL_DEPTH_TEST, GL_LESS, glDepthFunc,
     glUseProgram, glUniformMatrix4fv, glUniform1f, glUniform1i,
     glBindVertexArray, glGenVertexArrays,
     glBufferData, glGenBuffers, glBindBuffer, GL_ARRAY_BUFFER, GL_STATIC_DRAW,
-    glVertexAttribPointer, glEnableVertexAttribArray,
+    glBufferSubData, GL_DYNAMIC_DRAW, GL_SHORT, GL_HALF_FLOAT,
+    glVertexAttribPointer, glEnableVertexAttribArray, glDisableVertexAttribArray,
     glDrawArrays, GL_POINTS, GL_FALSE, GL_TRUE,
     glCreateProgram, glAttachShader, glLinkProgram, glGetProgramiv,
     GL_LINK_STATUS, glGetProgramInfoLog, glDeleteShader,
     glGetUniformLocation, glViewport,
     glGenTextures, glBindTexture, glTexImage1D, glTexParameteri,
     GL_TEXTURE_1D, GL_RGBA32F, GL_RGBA, GL_FLOAT, GL_LINEAR,
-    GL_VERTEX_SHADER, GL_FRAGMENT_SHADER, glGetString,GL_VERSION,GL_PROGRAM_POINT_SIZE, glEnable, GL_TEXTURE_MIN_FILTER, GL_TEXTURE_MAG_FILTER
+    GL_VERTEX_SHADER, GL_FRAGMENT_SHADER, glGetString,GL_VERSION,GL_PROGRAM_POINT_SIZE, glEnable, GL_TEXTURE_MIN_FILTER, GL_TEXTURE_MAG_FILTER,
+    glTexImage3D, glActiveTexture, glDeleteTextures, glGetIntegerv, GL_TEXTURE0, GL_TEXTURE1,
+    GL_TEXTURE_2D_ARRAY, GL_R32F, GL_RED, GL_NEAREST, GL_TRIANGLES, GL_MAX_TEXTURE_SIZE,
+    GL_TEXTURE_WRAP_S, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE,
+    glScissor, GL_SCISSOR_TEST, glDisable, glDepthMask,
+    glGenQueries, glBeginQuery, glEndQuery, glGetQueryObjectiv, glGetQueryObjectui64v,
+    GL_TIME_ELAPSED, GL_QUERY_RESULT, GL_QUERY_RESULT_AVAILABLE,
+    GL_TEXTURE_3D, GL_TEXTURE_2D, GL_R16F, GL_TEXTURE_WRAP_R, glTexImage2D, glUniform3f,
+    GL_BLEND, GL_MAX, glBlendEquation, GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0,
+    glGenFramebuffers, glBindFramebuffer, glFramebufferTexture2D
 )
 
 
@@ -31,18 +48,30 @@ VERTEX_SHADER = """
 #version 330 core
 
 layout (location = 0) in vec2 in_pos;
-layout (location = 1) in float in_value;
+// up to 8 aggregated channels per point, unused components stay at the
+// attribute defaults
+layout (location = 1) in vec4 in_values_a;
+layout (location = 2) in vec4 in_values_b;
 
 uniform mat4 u_transform;
 uniform float u_pointSize;
+uniform int u_channel;
+uniform float vmin;
+uniform float vmax;
 
 out float v_value;
 
 void main()
 {
-    gl_Position = u_transform * vec4(in_pos, 0.0, 1.0);
+    v_value = u_channel < 4 ? in_values_a[u_channel] : in_values_b[u_channel - 4];
+
+    // overlapping points are ordered by the depth test instead of the upload order,
+    // lower values end up in front. Scaled by 0.999 so t == 1 still passes GL_LESS
+    float t = clamp((v_value - vmin) / (vmax - vmin), 0.0, 1.0);
+    float depth = (2.0 * t - 1.0) * 0.999;
+
+    gl_Position = u_transform * vec4(in_pos, depth, 1.0);
     gl_PointSize = u_pointSize;
-    v_value = in_value;
 
 // Bypass the transform matrix for a moment
 //    gl_Position = vec4(in_pos, 0.0, 1.0);
@@ -73,6 +102,54 @@ void main()
 }
 """
 
+# image mode: the aggregated grid is drawn as textured quads, one per tile
+IMAGE_VERTEX_SHADER = """
+#version 330 core
+
+layout (location = 0) in vec2 in_pos;
+layout (location = 1) in vec2 in_uv;
+
+uniform mat4 u_transform;
+
+out vec2 v_uv;
+
+void main()
+{
+    gl_Position = u_transform * vec4(in_pos, 0.0, 1.0);
+    v_uv = in_uv;
+}
+"""
+IMAGE_FRAGMENT_SHADER = """
+#version 330 core
+
+in vec2 v_uv;
+
+uniform sampler2DArray grid;
+uniform int u_channel;
+uniform float vmin;
+uniform float vmax;
+uniform sampler1D colormap;
+
+out vec4 fragColor;
+
+void main()
+{
+    float value = texture(grid, vec3(v_uv, float(u_channel))).r;
+
+    // empty cells are NaN
+    if (isnan(value)) {
+        discard;
+    }
+
+    float t = clamp((value - vmin) / (vmax - vmin), 0.0, 1.0);
+
+    if (t < 0.001 || t > 0.999) {
+        fragColor = vec4(0.0, 0.0, 0.0, 1.0);
+    } else {
+        fragColor = texture(colormap, t);
+    }
+}
+"""
 
 
 def viridis_colormap(n=256):
@@ -90,12 +167,578 @@ def viridis_colormap(n=256):
 
 
 
+def make_transform(zoom, pan_x, pan_y, zoom_y=None):
+    # This is a standard 4x4 Identity matrix modified for 2D pan/zoom
+    # We use Column-Major layout here so we can use GL_FALSE
+    zoom_y = zoom if zoom_y is None else zoom_y
+    return np.array([
+        [zoom,  0,     0, 0],
+        [0,     zoom_y, 0, 0],
+        [0,     0,     1, 0],
+        [pan_x, pan_y, 0, 1]
+    ], dtype=np.float32)
+
+
+# above this many points a decimated copy is kept for drawing while the view moves
+PREVIEW_POINTS = 1_000_000
+
+
+def pack_points(data):
+    """
+    (N, 2 + C) float -> compact vertices: x, y as int16 normalized to -1..1, the values
+    as half floats. 4 + 2 C bytes instead of 8 + 4 C, 6 for a single channel.
+    Half floats keep 11 significant bits, steps of 1 below 2048 and 16 near 32767.
+    """
+    columns = data.shape[1]
+    vertex = np.dtype([("pos", "<i2", (2,)), ("values", "<f2", (columns - 2,))])
+    packed = np.empty(len(data), dtype=vertex)
+    packed["pos"] = np.round(data[:, :2] * 32767)
+    packed["values"] = data[:, 2:]
+    return packed
+
+
+def fits_packed(data):
+    """Whether every position is inside -1..1, points outside can't go into int16 without moving them"""
+    return len(data) == 0 or bool(np.abs(data[:, :2]).max() <= 1.0)
+
+
+def vertex_bytes(columns, packed):
+    return 4 + 2 * (columns - 2) if packed else 4 * columns
+
+
+class PointRenderer:
+    """
+    Everything that lives on the GPU for the 2D view: programs, point buffers,
+    image tiles and the colormap. It doesn't own a context, every GL call expects
+    the caller to have one current. PointCloud2D uses it on screen, offscreen.py
+    for headless and tiled rendering.
+    """
+    def __init__(self):
+        self.initialized = False
+
+        self.data = None
+        self.point_count = 0
+        # names of the value columns in self.data, the shown one is picked by u_channel
+        self.channels = ["value"]
+        self.channel = "value"
+
+        # image mode, grid shape: (C, H, W)
+        self.render_mode = "points"
+        self.grid = None
+        self.grid_tiles = []
+        self.max_texture_size = 4096
+        self.image_program = 0
+        self.image_vao = 0
+        self.image_vbo = 0
+
+        # full resolution recompute of a zoomed region, drawn over the normal view
+        self.overlay = None
+        self.overlay_count = 0
+        self.overlay_bounds = None
+        self.overlay_vao = 0
+        self.overlay_vbo = 0
+
+        # points of the layer that is still being written, the buffer grows as chunks come in
+        self.live_chunks = []
+        self.live_count = 0
+        self.live_columns = 0
+        self.live_capacity = 0
+        # layout of the live buffer, float32 as soon as a chunk lies beyond the extent
+        self.live_packed = False
+        self.live_vao = 0
+        self.live_vbo = 0
+
+        # every nth point of data, drawn instead of the full set while interactive is set
+        self.interactive = False
+        self.preview_count = 0
+        self.preview_vao = 0
+        self.preview_vbo = 0
+
+        # upload vertices as pack_points instead of float32, buffers with points
+        # outside the normalized extent (see fits_packed) stay float32
+        self.packed = False
+
+        # last uniform values per program, so unchanged ones aren't sent again every frame
+        self._uniform_state = dict()
+        self._image_uniforms = dict()
+
+        # rendering options
+        self.point_size = 1.0
+        self.vmin = 0.0
+        self.vmax = 32767.0
+        self.program = 0
+        self.u_transform = None
+        self.vao = 0
+        self.vbo = 0
+
+    # ---------- data ----------
+
+    def set_points(self, data: np.ndarray, channels=None):
+        """data shape: (N, 2 + C) -> x, y, value per channel"""
+        # no copy if it already is float32
+        self.data = np.ascontiguousarray(data, dtype=np.float32)
+        self.point_count = len(data)
+        self.channels = list(channels) if channels else ["value"]
+        self.render_mode = "points"
+        self.clear_overlay()
+
+        if self.initialized:
+            self._upload_data()
+
+    def set_grid(self, grid: np.ndarray, channels=None):
+        """grid shape: (C, H, W) -> one image per channel, NaN for empty cells"""
+        self.grid = np.ascontiguousarray(grid, dtype=np.float32)
+        self.channels = list(channels) if channels else ["value"]
+        self.render_mode = "image"
+        self.clear_overlay()
+
+        if self.initialized:
+            self._upload_grid()
+
+    def set_overlay(self, data: np.ndarray, bounds):
+        """Points of the region bounds = (x_min, x_max, y_min, y_max), in the same layout as set_points"""
+        self.overlay = data.astype(np.float32)
+        self.overlay_count = len(data)
+        self.overlay_bounds = bounds
+
+        if self.initialized:
+            self._upload_points(self.overlay_vao, self.overlay_vbo, self.overlay)
+
+    def clear_overlay(self):
+        self.overlay = None
+        self.overlay_count = 0
+
+    def append_live(self, data: np.ndarray):
+        """Adds points in the layout of set_points to the live layer, only the new ones are uploaded"""
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        if len(data) == 0:
+            return
+        if self.live_chunks and data.shape[1] != self.live_columns:
+            self.clear_live()
+        self.live_columns = data.shape[1]
+        self.live_chunks.append(data)
+        self.live_count += len(data)
+
+        if self.initialized:
+            self._upload_live()
+
+    def clear_live(self):
+        self.live_chunks = []
+        self.live_count = 0
+        # the next chunk may have another layout, the buffer is allocated again
+        self.live_capacity = 0
+
+    def set_packed(self, packed: bool):
+        """Switches the vertex layout, everything on the GPU is uploaded again"""
+        if bool(packed) == self.packed:
+            return
+        self.packed = bool(packed)
+        if self.initialized:
+            self._upload_data()
+            if self.overlay is not None:
+                self._upload_points(self.overlay_vao, self.overlay_vbo, self.overlay)
+            if self.live_chunks:
+                self.live_capacity = 0
+                self._upload_live()
+
+    def channel_index(self):
+        if self.channel in self.channels:
+            return self.channels.index(self.channel)
+        return 0
+
+    # ---------- OpenGL ----------
+
+    def initialize(self):
+        glEnable(GL_PROGRAM_POINT_SIZE)
+        glEnable(GL_DEPTH_TEST)
+        glDepthFunc(GL_LESS)
+        self.vao = glGenVertexArrays(1)
+        self.vbo = glGenBuffers(1)
+        self.overlay_vao = glGenVertexArrays(1)
+        self.overlay_vbo = glGenBuffers(1)
+        self.preview_vao = glGenVertexArrays(1)
+        self.preview_vbo = glGenBuffers(1)
+        self.live_vao = glGenVertexArrays(1)
+        self.live_vbo = glGenBuffers(1)
+        self._uniform_state = dict()
+
+        # CRITICAL: If these are 0, the driver failed to provide a buffer
+
+        glClearColor(0, 0, 0, 1)
+        self.program = self._create_program()
+        self._get_uniforms()
+
+
+        self._create_colormap()
+
+        self.max_texture_size = int(glGetIntegerv(GL_MAX_TEXTURE_SIZE))
+        self.image_program = self._create_program(IMAGE_VERTEX_SHADER, IMAGE_FRAGMENT_SHADER)
+        self.image_vao = glGenVertexArrays(1)
+        self.image_vbo = glGenBuffers(1)
+        glUseProgram(self.image_program)
+        glUniform1i(glGetUniformLocation(self.image_program, "colormap"), 0)
+        glUniform1i(glGetUniformLocation(self.image_program, "grid"), 1)
+        self._image_uniforms = {
+            name: glGetUniformLocation(self.image_program, name)
+            for name in ("u_transform", "vmin", "vmax", "u_channel")
+        }
+
+        self.initialized = True
+
+        self._upload_data()
+        self._upload_grid()
+        if self.overlay is not None:
+            self._upload_points(self.overlay_vao, self.overlay_vbo, self.overlay)
+        if self.live_chunks:
+            self.live_capacity = 0
+            self._upload_live()
+
+    def paint(self, transform, width, height):
+        """Draws the current data with transform into a width x height pixel viewport"""
+        # a QPainter on the same context (the timing overlay) leaves its own state behind
+        glViewport(0, 0, int(width), int(height))
+        glEnable(GL_PROGRAM_POINT_SIZE)
+        glEnable(GL_DEPTH_TEST)
+        glDepthFunc(GL_LESS)
+        glDepthMask(GL_TRUE)
+        glClearColor(0, 0, 0, 1)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+
+        if self.render_mode == "image":
+            self._paint_grid(transform)
+        elif self.interactive and self.preview_count > 0:
+            self._paint_points(self.preview_vao, self.preview_count, transform)
+        else:
+            self._paint_points(self.vao, self.point_count, transform)
+
+        if self.live_count > 0:
+            self._paint_points(self.live_vao, self.live_count, transform)
+
+        if self.overlay_count > 0:
+            self._paint_overlay(transform, width, height)
+
+    def _paint_points(self, vao, count, transform):
+        if self.program is None or count == 0 or self.u_transform is None or vao is None:
+            return
+
+
+        glUseProgram(self.program)
+        glBindVertexArray(vao)
+        state = (transform.tobytes(), self.point_size, self.vmin, self.vmax, self.channel_index())
+        if self._uniform_state.get(self.program) != state:
+            glUniformMatrix4fv(self.u_transform, 1, GL_FALSE, transform)
+            glUniform1f(self.u_pointSize, self.point_size)
+            glUniform1f(self.u_vmin, self.vmin)
+            glUniform1f(self.u_vmax, self.vmax)
+            glUniform1i(self.u_channel, self.channel_index())
+            self._uniform_state[self.program] = state
+
+        glDrawArrays(GL_POINTS, 0, count)
+
+    def _paint_overlay(self, transform, width, height):
+        # wipe the coarse points inside the region so only the detailed ones are visible there
+        x_min, x_max, y_min, y_max = self.overlay_bounds
+        scale_x, pan_x = transform[0][0], transform[3][0]
+        scale_y, pan_y = transform[1][1], transform[3][1]
+        left = int(((x_min * scale_x + pan_x) + 1.0) * 0.5 * width)
+        right = int(((x_max * scale_x + pan_x) + 1.0) * 0.5 * width)
+        bottom = int(((y_min * scale_y + pan_y) + 1.0) * 0.5 * height)
+        top = int(((y_max * scale_y + pan_y) + 1.0) * 0.5 * height)
+        if right <= left or top <= bottom:
+            return
+
+        glEnable(GL_SCISSOR_TEST)
+        glScissor(left, bottom, right - left, top - bottom)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        self._paint_points(self.overlay_vao, self.overlay_count, transform)
+        glDisable(GL_SCISSOR_TEST)
+
+    def _paint_grid(self, transform):
+        if not self.image_program or not self.grid_tiles:
+            return
+
+        prog = self.image_program
+        glUseProgram(prog)
+        glBindVertexArray(self.image_vao)
+        state = (transform.tobytes(), self.vmin, self.vmax, self.channel_index())
+        if self._uniform_state.get(prog) != state:
+            u = self._image_uniforms
+            glUniformMatrix4fv(u["u_transform"], 1, GL_FALSE, transform)
+            glUniform1f(u["vmin"], self.vmin)
+            glUniform1f(u["vmax"], self.vmax)
+            glUniform1i(u["u_channel"], self.channel_index())
+            self._uniform_state[prog] = state
+
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_1D, self.cmap_tex)
+        glActiveTexture(GL_TEXTURE1)
+        for i, tex in enumerate(self.grid_tiles):
+            glBindTexture(GL_TEXTURE_2D_ARRAY, tex)
+            glDrawArrays(GL_TRIANGLES, 6 * i, 6)
+        glActiveTexture(GL_TEXTURE0)
+
+    def _upload_data(self):
+        if self.data is None:
+            return
+        packed = self.packed and fits_packed(self.data)
+        size = self.point_count * vertex_bytes(self.data.shape[1], packed)
+        with profiling.stage("PointRenderer._upload_data", rows=self.point_count, bytes=size, packed=packed):
+            self._upload_points(self.vao, self.vbo, self.data, packed)
+
+            self.preview_count = 0
+            if self.point_count > PREVIEW_POINTS:
+                step = -(-self.point_count // PREVIEW_POINTS)
+                preview = np.ascontiguousarray(self.data[::step])
+                self._upload_points(self.preview_vao, self.preview_vbo, preview, packed)
+                self.preview_count = len(preview)
+
+    def _vertices(self, data, packed):
+        """data as it goes into a buffer in the given layout"""
+        if packed:
+            # as plain bytes, PyOpenGL doesn't take structured arrays
+            return pack_points(data).view(np.uint8)
+        return data
+
+    def _upload_points(self, vao, vbo, data, packed=None):
+        if packed is None:
+            packed = self.packed and fits_packed(data)
+        vertices = self._vertices(data, packed)
+        glBindBuffer(GL_ARRAY_BUFFER, vbo)
+        glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL_STATIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        self._set_point_attributes(vao, vbo, data.shape[1], packed)
+
+    def _upload_live(self):
+        data = self.live_chunks[-1]
+        if self.live_packed and not fits_packed(data):
+            # the layer outgrew the extent of the view, the buffer goes up again as float32
+            self.live_capacity = 0
+        glBindBuffer(GL_ARRAY_BUFFER, self.live_vbo)
+        if self.live_count > self.live_capacity:
+            # doubled so a growing layer only reallocates a few times, everything so far goes up again
+            self.live_chunks = [np.concatenate(self.live_chunks)]
+            self.live_packed = self.packed and fits_packed(self.live_chunks[0])
+            stride = vertex_bytes(self.live_columns, self.live_packed)
+            self.live_capacity = max(self.live_count, 2 * self.live_capacity, 65536)
+            glBufferData(GL_ARRAY_BUFFER, self.live_capacity * stride, None, GL_DYNAMIC_DRAW)
+            vertices = self._vertices(self.live_chunks[0], self.live_packed)
+            glBufferSubData(GL_ARRAY_BUFFER, 0, vertices.nbytes, vertices)
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+            self._set_point_attributes(self.live_vao, self.live_vbo, self.live_columns, self.live_packed)
+        else:
+            stride = vertex_bytes(self.live_columns, self.live_packed)
+            vertices = self._vertices(data, self.live_packed)
+            glBufferSubData(GL_ARRAY_BUFFER, (self.live_count - len(data)) * stride, vertices.nbytes, vertices)
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def _set_point_attributes(self, vao, vbo, columns, packed):
+        glBindVertexArray(vao)
+        glBindBuffer(GL_ARRAY_BUFFER, vbo)
+
+        values = columns - 2
+        stride = vertex_bytes(columns, packed)
+        if packed:
+            # [x(2), y(2), val(2) * channels], normalized shorts come out as -1..1 in the shader
+            pos_type, pos_normalized, value_type, value_size = GL_SHORT, GL_TRUE, GL_HALF_FLOAT, 2
+        else:
+            # Stride is 4 bytes per column: [x(4), y(4), val(4) * channels]
+            pos_type, pos_normalized, value_type, value_size = GL_FLOAT, GL_FALSE, GL_FLOAT, 4
+        first_value = 2 * value_size
+
+        # Location 0: x, y
+        glVertexAttribPointer(0, 2, pos_type, pos_normalized, stride, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(0)
+
+        # Location 1: channels 0-3
+        glVertexAttribPointer(1, min(values, 4), value_type, GL_FALSE, stride, ctypes.c_void_p(first_value))
+        glEnableVertexAttribArray(1)
+
+        # Location 2: channels 4-7
+        if values > 4:
+            glVertexAttribPointer(2, values - 4, value_type, GL_FALSE, stride,
+                                  ctypes.c_void_p(first_value + 4 * value_size))
+            glEnableVertexAttribArray(2)
+        else:
+            glDisableVertexAttribArray(2)
+        
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindVertexArray(0)
+
+    def _upload_grid(self):
+        if self.grid is None:
+            return
+
+        if self.grid_tiles:
+            glDeleteTextures(self.grid_tiles)
+        self.grid_tiles = []
+
+        channels, height, width = self.grid.shape
+        tile = self.max_texture_size
+        quads = []
+
+        # grids larger than the texture limit are split into tiles, each one its own quad
+        for y0 in range(0, height, tile):
+            for x0 in range(0, width, tile):
+                y1 = min(y0 + tile, height)
+                x1 = min(x0 + tile, width)
+                block = np.ascontiguousarray(self.grid[:, y0:y1, x0:x1])
+
+                tex = glGenTextures(1)
+                glBindTexture(GL_TEXTURE_2D_ARRAY, tex)
+                glTexImage3D(
+                    GL_TEXTURE_2D_ARRAY, 0, GL_R32F,
+                    x1 - x0, y1 - y0, channels, 0, GL_RED, GL_FLOAT, block
+                )
+                glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+                glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+                glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+                glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+                self.grid_tiles.append(tex)
+
+                # tile corners in the same -1..1 space the points are normalized to
+                left = 2.0 * x0 / width - 1.0
+                right = 2.0 * x1 / width - 1.0
+                bottom = 2.0 * y0 / height - 1.0
+                top = 2.0 * y1 / height - 1.0
+                quads += [
+                    [left, bottom, 0, 0], [right, bottom, 1, 0], [right, top, 1, 1],
+                    [left, bottom, 0, 0], [right, top, 1, 1], [left, top, 0, 1],
+                ]
+        glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+
+        quads = np.array(quads, dtype=np.float32)
+        glBindVertexArray(self.image_vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.image_vbo)
+        glBufferData(GL_ARRAY_BUFFER, quads.nbytes, quads, GL_STATIC_DRAW)
+
+        # Stride is 16 bytes: [x(4), y(4), u(4), v(4)]
+        glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 16, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(0)
+        glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, 16, ctypes.c_void_p(8))
+        glEnableVertexAttribArray(1)
+
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindVertexArray(0)
+
+    def _create_colormap(self):
+        self.cmap_tex = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_1D, self.cmap_tex)
+
+        cmap = viridis_colormap(256)
+
+        glTexImage1D(
+            GL_TEXTURE_1D, 0, GL_RGBA32F,
+            256, 0, GL_RGBA, GL_FLOAT, cmap
+        )
+
+        glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+
+        glUseProgram(self.program)
+        glUniform1i(glGetUniformLocation(self.program, "colormap"), 0)
+
+    def _create_program(self, vertex_src=VERTEX_SHADER, fragment_src=FRAGMENT_SHADER):
+
+        vs = helpers.compile_shader(vertex_src, GL_VERTEX_SHADER)
+        fs = helpers.compile_shader(fragment_src, GL_FRAGMENT_SHADER)
+        prog = glCreateProgram()
+        glAttachShader(prog, vs)
+        glAttachShader(prog, fs)
+        glLinkProgram(prog)
+
+        if not glGetProgramiv(prog, GL_LINK_STATUS):
+            raise RuntimeError(glGetProgramInfoLog(prog).decode())
+
+        glDeleteShader(vs)
+        glDeleteShader(fs)
+
+        return prog
+
+    def _get_uniforms(self):
+        self.u_transform = glGetUniformLocation(self.program, "u_transform")
+        self.u_pointSize = glGetUniformLocation(self.program, "u_pointSize")
+        self.u_vmin = glGetUniformLocation(self.program, "vmin")
+        self.u_vmax = glGetUniformLocation(self.program, "vmax")
+        self.u_channel = glGetUniformLocation(self.program, "u_channel")
+
+    def cleanup(self):
+        self.initialized = False
+        if self.program:
+            # glDeleteProgram(self.program) # Optional, but safer to just nullify
+            self.program = 0
+        if self.vbo:
+            # glDeleteBuffers(1, [self.vbo])
+            self.vbo = 0
+        if self.vao:
+            # glDeleteVertexArrays(1, [self.vao])
+            self.vao = 0
+        self.image_program = 0
+        self.image_vao = 0
+        self.image_vbo = 0
+        self.grid_tiles = []
+        self.overlay_vao = 0
+        self.overlay_vbo = 0
+        self.preview_vao = 0
+        self.preview_vbo = 0
+        self.preview_count = 0
+        self.live_vao = 0
+        self.live_vbo = 0
+        self.live_capacity = 0
+        self._uniform_state = dict()
+
+
+class GpuFrameTimer:
+    """
+    GL_TIME_ELAPSED queries around a frame. Two queries take turns so the result
+    is read a frame later, once it is available, instead of stalling on it.
+    """
+    def __init__(self):
+        self.queries = [int(q) for q in glGenQueries(2)]
+        # what the frame in flight on each query was drawn with, None if unused
+        self.tags = [None, None]
+        self.current = 0
+        self.last_ms = None
+        self.last_tag = None
+
+    def begin(self, tag=None):
+        query = self.queries[self.current]
+        if self.tags[self.current] is not None:
+            self._collect(self.current)
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        self.tags[self.current] = tag
+
+    def end(self):
+        glEndQuery(GL_TIME_ELAPSED)
+        self.current = 1 - self.current
+        # the other query is a frame old by now, usually done
+        if self.tags[self.current] is not None:
+            self._collect(self.current)
+
+    def _collect(self, i):
+        available = np.zeros(1, dtype=np.int32)
+        glGetQueryObjectiv(self.queries[i], GL_QUERY_RESULT_AVAILABLE, available)
+        if available[0]:
+            elapsed = np.zeros(1, dtype=np.uint64)
+            glGetQueryObjectui64v(self.queries[i], GL_QUERY_RESULT, elapsed)
+            self.last_ms = int(elapsed[0]) / 1e6
+            self.last_tag = self.tags[i]
+            self.tags[i] = None
+        # otherwise begin() tries once more before reusing the query, after that the frame is dropped
+
+
 class PointCloud2D(QOpenGLWidget):
+    # visible (x_min, x_max, y_min, y_max) in the normalized -1..1 data space,
+    # sent once the view stopped moving
+    viewSettled = Signal(object)
+    # right click, position in the normalized -1..1 data space
+    pointProbed = Signal(float, float)
+
     def __init__(self, parent=None):
         super().__init__(parent)
 
-        self.data = None
-        self.point_count = 0
+        self.renderer = PointRenderer()
 
         # view state
         self.zoom = 1.0
@@ -104,78 +747,194 @@ class PointCloud2D(QOpenGLWidget):
         self.last_pos = None
 
         # rendering options
-        self.point_size = 1.0
         self.resolution = 10
-        self.vmin = 0.0
-        self.vmax = 32767.0
-        self.program = 0
-        self.u_transform = None
-        self.vao = 0
-        self.vbo = 0
         self.lock = Lock()
 
+        self.settle_timer = QTimer(self)
+        self.settle_timer.setSingleShot(True)
+        self.settle_timer.setInterval(300)
+        self.settle_timer.timeout.connect(self._emit_view)
+        self.settle_timer.timeout.connect(self._end_interaction)
+
+        # at most one frame in flight, input arriving meanwhile only marks the view dirty
+        self._transform = None
+        self._frame_pending = False
+        self._dirty = False
+        self.frameSwapped.connect(self._on_frame_swapped)
+
+        # frame timing, cpu from paintGL, gpu from timer queries
+        self.gpu_timer = None
+        self.show_timing = False
+        self.frame_cpu_ms = None
+        self.frame_gpu_ms = None
+        self.full_frame_ms = 0.0
+        # draw the decimated points while moving once a full frame takes longer than this
+        self.adaptive = True
+        self.frame_budget_ms = 1000 / 60
+
     # ---------- public API ----------
 
-    def set_points(self, data: np.ndarray):
-        """data shape: (N, 3) -> x, y, value"""
+    def set_points(self, data: np.ndarray, channels=None):
+        """data shape: (N, 2 + C) -> x, y, value per channel"""
+        with self.lock:
+            if self.isValid():
+                self.makeCurrent()
+            self.renderer.set_points(data, channels)
+
+            self.update()
+
+    def set_grid(self, grid: np.ndarray, channels=None):
+        """grid shape: (C, H, W) -> one image per channel, NaN for empty cells"""
+        with self.lock:
+            if self.isValid():
+                self.makeCurrent()
+            self.renderer.set_grid(grid, channels)
+
+            self.update()
+
+    def set_overlay(self, data: np.ndarray, bounds):
+        """Points of the region bounds = (x_min, x_max, y_min, y_max), in the same layout as set_points"""
         with self.lock:
-            self.data = data.astype(np.float32)
-            self.point_count = len(data)
+            if self.isValid():
+                self.makeCurrent()
+            self.renderer.set_overlay(data, bounds)
+
+            self.update()
+
+    def clear_overlay(self):
+        self.renderer.clear_overlay()
+        self.update()
 
+    def append_live(self, data: np.ndarray):
+        """Points of the layer that is being written, same layout as set_points"""
+        with self.lock:
             if self.isValid():
-                self._upload_data()
+                self.makeCurrent()
+            self.renderer.append_live(data)
 
             self.update()
 
+    def clear_live(self):
+        self.renderer.clear_live()
+        self.update()
+
+    def set_packed(self, packed: bool):
+        """Compact vertices (pack_points), about half the GPU memory and upload time"""
+        with self.lock:
+            if self.isValid():
+                self.makeCurrent()
+            self.renderer.set_packed(packed)
+
+            self.update()
+
+    def visible_bounds(self):
+        """Inverse of the transform for the corners of the viewport, clamped to the data"""
+        x_min = max(-1.0, (-1.0 - self.pan_x) / self.zoom)
+        x_max = min(1.0, (1.0 - self.pan_x) / self.zoom)
+        y_min = max(-1.0, (-1.0 - self.pan_y) / self.zoom)
+        y_max = min(1.0, (1.0 - self.pan_y) / self.zoom)
+        return (x_min, x_max, y_min, y_max)
+
+    def set_view(self, zoom, pan_x, pan_y):
+        """Zoom and pan as a restored session had them"""
+        self.zoom = float(zoom)
+        self.pan_x = float(pan_x)
+        self.pan_y = float(pan_y)
+        self._view_changed()
+
+    def _emit_view(self):
+        self.viewSettled.emit(self.visible_bounds())
+
     def set_point_size(self, size: float):
-        self.point_size = float(size)
+        self.renderer.point_size = float(size)
+        self.update()
+
+    def set_channel(self, channel: str):
+        """Only switches the shown column, the buffer stays as it is"""
+        self.renderer.channel = channel
         self.update()
 
     def set_value_range(self, value_range):
-        self.vmin = float(value_range[0])
-        self.vmax = float(value_range[1])
+        self.renderer.vmin = float(value_range[0])
+        self.renderer.vmax = float(value_range[1])
         self.update()
 
+    def set_show_timing(self, on: bool):
+        self.show_timing = bool(on)
+        self.update()
+
+    def set_adaptive(self, on: bool):
+        self.adaptive = bool(on)
+        if not on:
+            self._end_interaction()
+
     # ---------- Qt / OpenGL ----------
 
     def initializeGL(self):
         self.context().aboutToBeDestroyed.connect(self.cleanup)
-        glEnable(GL_PROGRAM_POINT_SIZE)
         self.makeCurrent()
-        self.vao = glGenVertexArrays(1)
-        self.vbo = glGenBuffers(1)
-
-        # CRITICAL: If these are 0, the driver failed to provide a buffer
-
-        glClearColor(0, 0, 0, 1)
-        self.program = self._create_program()
-        self._get_uniforms()
-
-
-        self._create_colormap()
-
-        self._upload_data()
+        self.renderer.initialize()
+        self.gpu_timer = GpuFrameTimer()
 
     def resizeGL(self, w, h):
         glViewport(0, 0, w, h)
 
     def paintGL(self):
-        glClear(GL_COLOR_BUFFER_BIT)
-
-
-        if self.program is None or self.point_count == 0 or self.u_transform is None or self.vao is None or self.vbo is None:
+        ratio = self.devicePixelRatio()
+        preview = self.renderer.interactive and self.renderer.preview_count > 0
+        start = time.perf_counter()
+        with profiling.stage("PointCloud2D.paintGL", rows=self.renderer.point_count, preview=preview):
+            self.gpu_timer.begin(preview)
+            self.renderer.paint(self._make_transform(), self.width() * ratio, self.height() * ratio)
+            self.gpu_timer.end()
+        self.frame_cpu_ms = (time.perf_counter() - start) * 1000
+
+        # the gpu result belongs to an earlier frame, only full ones count for the budget
+        self.frame_gpu_ms = self.gpu_timer.last_ms
+        if not preview:
+            self.full_frame_ms = self.frame_cpu_ms
+        if self.gpu_timer.last_tag is False:
+            self.full_frame_ms = max(self.full_frame_ms, self.frame_gpu_ms)
+
+        if self.show_timing:
+            self._paint_timing(preview)
+
+    def _paint_timing(self, preview):
+        gpu = "-" if self.frame_gpu_ms is None else f"{self.frame_gpu_ms:.2f}"
+        text = f"cpu {self.frame_cpu_ms:.2f} ms   gpu {gpu} ms"
+        if preview:
+            text += f"   preview {self.renderer.preview_count:,} of {self.renderer.point_count:,}"
+        painter = QPainter(self)
+        painter.setPen(QColor("white"))
+        painter.drawText(8, 16, text)
+        painter.end()
+
+    def _on_frame_swapped(self):
+        self._frame_pending = False
+        if self._dirty:
+            self._dirty = False
+            self._schedule_update()
+
+    def _schedule_update(self):
+        """update() for the view changing under the mouse, coalesced to one frame per swap"""
+        if self._frame_pending:
+            self._dirty = True
             return
+        self._frame_pending = True
+        self.update()
 
+    def _view_changed(self):
+        self._transform = None
+        if self.adaptive and self.full_frame_ms > self.frame_budget_ms:
+            self.renderer.interactive = True
+        self._schedule_update()
 
-        glUseProgram(self.program)
-        glBindVertexArray(self.vao)
-        transform = self._make_transform()
-        glUniformMatrix4fv(self.u_transform, 1, GL_FALSE, transform)
-        glUniform1f(self.u_pointSize, self.point_size)
-        glUniform1f(self.u_vmin, self.vmin)
-        glUniform1f(self.u_vmax, self.vmax)
-
-        glDrawArrays(GL_POINTS, 0, self.point_count)
+    def _end_interaction(self):
+        # a wheel step during a drag ends with the drag
+        if self.last_pos is not None or not self.renderer.interactive:
+            return
+        self.renderer.interactive = False
+        self.update()
 
     # ---------- mouse interaction ----------
 
@@ -198,11 +957,17 @@ class PointCloud2D(QOpenGLWidget):
         self.pan_x = ndc_x - (ndc_x - self.pan_x) * zoom_step
         self.pan_y = ndc_y - (ndc_y - self.pan_y) * zoom_step
 
-        self.update()
+        self.settle_timer.start()
+        self._view_changed()
 
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
             self.last_pos = event.position()
+        elif event.button() == Qt.RightButton:
+            pos = event.position()
+            ndc_x = (2.0 * pos.x() / self.width()) - 1.0
+            ndc_y = 1.0 - (2.0 * pos.y() / self.height())
+            self.pointProbed.emit((ndc_x - self.pan_x) / self.zoom, (ndc_y - self.pan_y) / self.zoom)
 
     def mouseMoveEvent(self, event):
         if self.last_pos is None:
@@ -215,65 +980,465 @@ class PointCloud2D(QOpenGLWidget):
         self.pan_y -= 2.0 * dy / self.height()
 
         self.last_pos = event.position()
-        self.update()
+        self._view_changed()
 
     def mouseReleaseEvent(self, event):
+        if self.last_pos is not None:
+            self.settle_timer.start()
         self.last_pos = None
+        self._end_interaction()
 
     # ---------- internal helpers ----------
     def _make_transform(self):
-        # This is a standard 4x4 Identity matrix modified for 2D pan/zoom
-        # We use Column-Major layout here so we can use GL_FALSE
+        if self._transform is None:
+            self._transform = make_transform(self.zoom, self.pan_x, self.pan_y)
+        return self._transform
+
+    def __del__(self):
+        # This "empty" destructor prevents PyOpenGL from 
+        # trying to call glDelete* during Python shutdown.
+        pass
+
+
+    def cleanup(self):
+        """Call this manually or on the aboutToQuit signal."""
+        self.makeCurrent()
+        self.renderer.cleanup()
+        self.doneCurrent()
+
+
+
+# 3D view: every brick is drawn as a box, the fragment shader marches through it and
+# keeps the brightest sample. GL_MAX blending merges the bricks in any order
+BRICK_VERTEX_SHADER = """
+#version 330 core
+
+// corner of the unit cube
+layout (location = 0) in vec3 in_pos;
+
+uniform mat4 u_mvp;
+uniform vec3 u_origin;
+uniform vec3 u_size;
+
+out vec3 v_local;
+
+void main()
+{
+    v_local = in_pos;
+    gl_Position = u_mvp * vec4(u_origin + in_pos * u_size, 1.0);
+}
+"""
+BRICK_FRAGMENT_SHADER = """
+#version 330 core
+
+in vec3 v_local;
+
+uniform sampler3D brick;
+// camera in the 0..1 space of the brick
+uniform vec3 u_camera;
+// samples per unit of the brick space, about 1.5 per voxel
+uniform float u_samples;
+uniform float vmin;
+uniform float vmax;
+
+out vec4 fragColor;
+
+void main()
+{
+    // from the face towards the camera until the ray leaves the brick, a front
+    // face leaves right away so no face culling is needed, also with the camera inside
+    vec3 dir = u_camera - v_local;
+    float to_camera = length(dir);
+    dir /= to_camera;
+    vec3 safe = mix(vec3(1e-6), dir, greaterThan(abs(dir), vec3(1e-6)));
+    vec3 bound = (step(0.0, safe) - v_local) / safe;
+    float t_end = min(min(min(bound.x, bound.y), bound.z), to_camera);
+    if (t_end <= 1e-4) {
+        discard;
+    }
+
+    int steps = int(ceil(t_end * u_samples));
+    float step_length = t_end / float(steps);
+    float brightest = 0.0;
+    for (int i = 0; i < steps; i++) {
+        float value = texture(brick, v_local + dir * (step_length * (float(i) + 0.5))).r;
+        brightest = max(brightest, clamp((value - vmin) / (vmax - vmin), 0.0, 1.0));
+    }
+    fragColor = vec4(brightest, 0.0, 0.0, 1.0);
+}
+"""
+# the projection into colors, one triangle over the whole viewport
+COMPOSITE_VERTEX_SHADER = """
+#version 330 core
+
+out vec2 v_uv;
+
+void main()
+{
+    vec2 pos = vec2((gl_VertexID << 1) & 2, gl_VertexID & 2);
+    v_uv = pos;
+    gl_Position = vec4(pos * 2.0 - 1.0, 0.0, 1.0);
+}
+"""
+COMPOSITE_FRAGMENT_SHADER = """
+#version 330 core
+
+in vec2 v_uv;
+
+uniform sampler2D projection;
+uniform sampler1D colormap;
+
+out vec4 fragColor;
+
+void main()
+{
+    float t = texture(projection, v_uv).r;
+
+    // same as the 2D view, outside the energy range is black
+    if (t < 0.001 || t > 0.999) {
+        fragColor = vec4(0.0, 0.0, 0.0, 1.0);
+    } else {
+        fragColor = texture(colormap, t);
+    }
+}
+"""
+
+# bricks resident on the GPU at most, 512 KB each in R16F
+VOLUME_GPU_BYTES = 256 << 20
+# bricks read and uploaded per frame, the rest follows in the next frames
+BRICK_UPLOADS_PER_FRAME = 16
+# a brick is replaced by its finer children while one of its voxels covers more pixels
+LOD_PIXELS = 1.5
+
+
+def perspective(fov_y, aspect, near, far):
+    f = 1.0 / math.tan(math.radians(fov_y) / 2)
+    return np.array([
+        [f / aspect, 0, 0, 0],
+        [0, f, 0, 0],
+        [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+        [0, 0, -1, 0],
+    ], dtype=np.float32)
+
+
+def look_at(eye, target, up=(0.0, 0.0, 1.0)):
+    eye, target, up = (np.asarray(v, dtype=np.float32) for v in (eye, target, up))
+    forward = target - eye
+    forward /= np.linalg.norm(forward)
+    side = np.cross(forward, up)
+    side /= np.linalg.norm(side)
+    up = np.cross(side, forward)
+    view = np.identity(4, dtype=np.float32)
+    view[0, :3], view[1, :3], view[2, :3] = side, up, -forward
+    view[:3, 3] = -view[:3, :3] @ eye
+    return view
+
+
+def unit_cube():
+    """36 vertices of the 0..1 cube, 12 triangles"""
+    corners = np.array([[x, y, z] for z in (0, 1) for y in (0, 1) for x in (0, 1)], dtype=np.float32)
+    faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+    indices = [i for a, b, c, d in faces for i in (a, b, c, a, c, d)]
+    return np.ascontiguousarray(corners[indices])
+
+
+class VolumeRenderer:
+    """
+    Maximum intensity projection of a volume.BrickStore. Every frame picks the
+    bricks in view at the level of detail the distance asks for, coarse ones far
+    away, as many as VOLUME_GPU_BYTES allows, and draws them into a float texture
+    with GL_MAX blending, which the composite pass maps through the colormap.
+    Like PointRenderer it expects the caller to have the context current.
+    """
+    def __init__(self):
+        self.initialized = False
+        self.store = None
+
+        # orbit camera around the middle of the volume
+        self.yaw = 30.0
+        self.pitch = 30.0
+        self.distance = 3.5
+        self.fov = 40.0
+        # height of a layer relative to a cell, real layers are far too thin to see anything
+        self.z_scale = 4.0
+
+        self.vmin = 0.0
+        self.vmax = 32767.0
+        self.gpu_budget = VOLUME_GPU_BYTES
+
+        # key -> (texture, version) of the resident bricks, least recently drawn first
+        self.textures = OrderedDict()
+        # set when a frame could not upload everything it wanted
+        self.incomplete = False
+        self.drawn = 0
+
+        self.brick_program = 0
+        self.composite_program = 0
+        self.cube_vao = 0
+        self.cube_vbo = 0
+        self.empty_vao = 0
+        self.fbo = 0
+        self.projection_tex = 0
+        self.fbo_size = (0, 0)
+        self.cmap_tex = 0
+        self._brick_uniforms = dict()
+
+    # ---------- data ----------
+
+    def set_store(self, store):
+        if store is self.store:
+            return
+        self.store = store
+        self._drop_textures()
+
+    # ---------- geometry ----------
+
+    def layer_height(self):
+        return 2.0 / volume.VOLUME_CELLS * self.z_scale
+
+    def brick_box(self, key):
+        """(origin, size) of a brick in world space, x and y -1..1, z centered on 0"""
+        level, bz, by, bx = key
+        f = 2 ** level
+        cell = 2.0 / volume.VOLUME_CELLS * f
+        layer = self.layer_height() * f
+        bottom = -0.5 * self.store.depth() * self.layer_height()
+        edge = volume.BRICK
+        origin = np.array([-1.0 + bx * edge * cell, -1.0 + by * edge * cell, bottom + bz * edge * layer], np.float32)
+        size = np.array([edge * cell, edge * cell, edge * layer], np.float32)
+        return origin, size
+
+    def camera(self):
+        yaw, pitch = math.radians(self.yaw), math.radians(self.pitch)
         return np.array([
-            [self.zoom, 0,         0, 0],
-            [0,         self.zoom, 0, 0],
-            [0,         0,         1, 0],
-            [self.pan_x, self.pan_y, 0, 1]
+            self.distance * math.cos(pitch) * math.cos(yaw),
+            self.distance * math.cos(pitch) * math.sin(yaw),
+            self.distance * math.sin(pitch),
         ], dtype=np.float32)
 
-    def _upload_data(self):
-        if self.data is None:
-            return
-        self.makeCurrent()
-        glBindVertexArray(self.vao)
-        
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
-        # Ensure data is 32-bit floats
-        glBufferData(GL_ARRAY_BUFFER, self.data.nbytes, self.data, GL_STATIC_DRAW)
+    def mvp(self, width, height):
+        far = self.distance + 4.0 + self.store.depth() * self.layer_height()
+        proj = perspective(self.fov, width / max(height, 1), 0.01, far)
+        return proj @ look_at(self.camera(), (0.0, 0.0, 0.0))
+
+    def _visible(self, key, mvp):
+        origin, size = self.brick_box(key)
+        corners = np.array([[*(origin + size * (x, y, z)), 1.0] for x in (0, 1) for y in (0, 1) for z in (0, 1)])
+        clip = corners @ mvp.T
+        w = clip[:, 3]
+        if (w <= 0).any():
+            # partly behind the camera, kept to be safe
+            return True
+        for axis in range(3):
+            if (clip[:, axis] < -w).all() or (clip[:, axis] > w).all():
+                return False
+        return True
+
+    def _error(self, key, camera, pixels_per_unit):
+        """Pixels one voxel of the brick covers on screen"""
+        origin, size = self.brick_box(key)
+        distance = max(float(np.linalg.norm(origin + size / 2 - camera)), 1e-3)
+        voxel = float(size.max()) / volume.BRICK
+        return voxel / distance * pixels_per_unit
+
+    def _children(self, key):
+        level, bz, by, bx = key
+        counts = self.store.brick_counts(level - 1)
+        return [
+            (level - 1, 2 * bz + dz, 2 * by + dy, 2 * bx + dx)
+            for dz in (0, 1) for dy in (0, 1) for dx in (0, 1)
+            if 2 * bz + dz < counts[0] and 2 * by + dy < counts[1] and 2 * bx + dx < counts[2]
+        ]
 
-        # Stride is 12 bytes: [x(4), y(4), val(4)]
-        # Location 0: x, y
-        glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 12, ctypes.c_void_p(0))
+    def select_bricks(self, width, height):
+        """The bricks to draw: in view, refined from the coarsest level while the budget allows"""
+        if self.store is None or self.store.depth() == 0:
+            return []
+        mvp = self.mvp(width, height)
+        camera = self.camera()
+        pixels_per_unit = height / (2 * math.tan(math.radians(self.fov) / 2))
+        limit = max(1, self.gpu_budget // (volume.BRICK ** 3 * 2))
+
+        top = volume.VOLUME_LEVELS - 1
+        counts = self.store.brick_counts(top)
+        start = [(top, bz, by, bx) for bz in range(counts[0]) for by in range(counts[1]) for bx in range(counts[2])]
+        # largest error first
+        queue = [(-self._error(k, camera, pixels_per_unit), k) for k in start if self._visible(k, mvp)]
+        heapq.heapify(queue)
+        chosen = []
+        while queue:
+            error, key = heapq.heappop(queue)
+            children = []
+            if key[0] > 0 and -error > LOD_PIXELS:
+                children = [k for k in self._children(key) if self._visible(k, mvp)]
+            # the children replace their parent, what is still queued needs its place too
+            if children and len(chosen) + len(queue) + len(children) <= limit:
+                for k in children:
+                    heapq.heappush(queue, (-self._error(k, camera, pixels_per_unit), k))
+            else:
+                chosen.append(key)
+        return chosen
+
+    # ---------- OpenGL ----------
+
+    def initialize(self):
+        self.brick_program = self._create_program(BRICK_VERTEX_SHADER, BRICK_FRAGMENT_SHADER)
+        glUseProgram(self.brick_program)
+        glUniform1i(glGetUniformLocation(self.brick_program, "brick"), 0)
+        self._brick_uniforms = {
+            name: glGetUniformLocation(self.brick_program, name)
+            for name in ("u_mvp", "u_origin", "u_size", "u_camera", "u_samples", "vmin", "vmax")
+        }
+
+        self.composite_program = self._create_program(COMPOSITE_VERTEX_SHADER, COMPOSITE_FRAGMENT_SHADER)
+        glUseProgram(self.composite_program)
+        glUniform1i(glGetUniformLocation(self.composite_program, "projection"), 0)
+        glUniform1i(glGetUniformLocation(self.composite_program, "colormap"), 1)
+
+        cube = unit_cube()
+        self.cube_vao = glGenVertexArrays(1)
+        self.cube_vbo = glGenBuffers(1)
+        glBindVertexArray(self.cube_vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.cube_vbo)
+        glBufferData(GL_ARRAY_BUFFER, cube.nbytes, cube, GL_STATIC_DRAW)
+        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 12, ctypes.c_void_p(0))
         glEnableVertexAttribArray(0)
-
-        # Location 1: value
-        glVertexAttribPointer(1, 1, GL_FLOAT, GL_FALSE, 12, ctypes.c_void_p(8))
-        glEnableVertexAttribArray(1)
-        
         glBindBuffer(GL_ARRAY_BUFFER, 0)
         glBindVertexArray(0)
+        # the core profile wants a vertex array bound even without attributes
+        self.empty_vao = glGenVertexArrays(1)
 
-    def _create_colormap(self):
         self.cmap_tex = glGenTextures(1)
         glBindTexture(GL_TEXTURE_1D, self.cmap_tex)
-
-        cmap = viridis_colormap(256)
-
-        glTexImage1D(
-            GL_TEXTURE_1D, 0, GL_RGBA32F,
-            256, 0, GL_RGBA, GL_FLOAT, cmap
-        )
-
+        glTexImage1D(GL_TEXTURE_1D, 0, GL_RGBA32F, 256, 0, GL_RGBA, GL_FLOAT, viridis_colormap(256))
         glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
         glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
 
-        glUseProgram(self.program)
-        glUniform1i(glGetUniformLocation(self.program, "colormap"), 0)
+        self.fbo = glGenFramebuffers(1)
+        self.projection_tex = glGenTextures(1)
+        self.fbo_size = (0, 0)
+        self.textures = OrderedDict()
+        self.initialized = True
+
+    def paint(self, width, height, target_fbo=0):
+        """Draws the projection into target_fbo (the widget's own framebuffer) at width x height pixels"""
+        width, height = int(width), int(height)
+        glDisable(GL_DEPTH_TEST)
+        glDepthMask(GL_FALSE)
+        glDisable(GL_SCISSOR_TEST)
+        glViewport(0, 0, width, height)
+
+        self._ensure_fbo(width, height)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glClearColor(0, 0, 0, 1)
+        glClear(GL_COLOR_BUFFER_BIT)
+        chosen = self.select_bricks(width, height)
+        if chosen:
+            self._draw_bricks(chosen, width, height)
 
-    def _create_program(self):
+        glBindFramebuffer(GL_FRAMEBUFFER, target_fbo)
+        glClear(GL_COLOR_BUFFER_BIT)
+        glUseProgram(self.composite_program)
+        glBindVertexArray(self.empty_vao)
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_2D, self.projection_tex)
+        glActiveTexture(GL_TEXTURE1)
+        glBindTexture(GL_TEXTURE_1D, self.cmap_tex)
+        glDrawArrays(GL_TRIANGLES, 0, 3)
+        glActiveTexture(GL_TEXTURE0)
+        glBindVertexArray(0)
 
-        vs = helpers.compile_shader(VERTEX_SHADER, GL_VERTEX_SHADER)
-        fs = helpers.compile_shader(FRAGMENT_SHADER, GL_FRAGMENT_SHADER)
+    def _draw_bricks(self, chosen, width, height):
+        uploads = 0
+        self.incomplete = False
+        ready = []
+        for key in chosen:
+            version = self.store.version(key)
+            resident = self.textures.get(key)
+            if resident is None or resident[1] != version:
+                if uploads >= BRICK_UPLOADS_PER_FRAME:
+                    self.incomplete = True
+                    continue
+                uploads += 1
+                if not self._upload_brick(key, version):
+                    continue
+            self.textures.move_to_end(key)
+            ready.append(key)
+        self._evict(set(chosen))
+
+        mvp = self.mvp(width, height)
+        camera = self.camera()
+        u = self._brick_uniforms
+        glUseProgram(self.brick_program)
+        glUniformMatrix4fv(u["u_mvp"], 1, GL_TRUE, mvp)
+        glUniform1f(u["u_samples"], volume.BRICK * 1.5)
+        glUniform1f(u["vmin"], self.vmin)
+        glUniform1f(u["vmax"], self.vmax)
+
+        glEnable(GL_BLEND)
+        glBlendEquation(GL_MAX)
+        glBindVertexArray(self.cube_vao)
+        glActiveTexture(GL_TEXTURE0)
+        for key in ready:
+            origin, size = self.brick_box(key)
+            glUniform3f(u["u_origin"], *origin)
+            glUniform3f(u["u_size"], *size)
+            glUniform3f(u["u_camera"], *((camera - origin) / size))
+            glBindTexture(GL_TEXTURE_3D, self.textures[key][0])
+            glDrawArrays(GL_TRIANGLES, 0, 36)
+        glBindVertexArray(0)
+        glDisable(GL_BLEND)
+        self.drawn = len(ready)
+
+    def _upload_brick(self, key, version):
+        brick = self.store.get(key)
+        if brick is None:
+            # nothing measured there, nothing to draw
+            return False
+        # empty voxels far below any range, so linear filtering doesn't spread NaN
+        data = np.ascontiguousarray(np.nan_to_num(brick, nan=-65504.0))
+        resident = self.textures.get(key)
+        tex = resident[0] if resident is not None else glGenTextures(1)
+        glBindTexture(GL_TEXTURE_3D, tex)
+        glTexImage3D(GL_TEXTURE_3D, 0, GL_R16F, volume.BRICK, volume.BRICK, volume.BRICK, 0,
+                     GL_RED, GL_HALF_FLOAT, data)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        for wrap in (GL_TEXTURE_WRAP_S, GL_TEXTURE_WRAP_T, GL_TEXTURE_WRAP_R):
+            glTexParameteri(GL_TEXTURE_3D, wrap, GL_CLAMP_TO_EDGE)
+        glBindTexture(GL_TEXTURE_3D, 0)
+        self.textures[key] = (tex, version)
+        return True
+
+    def _evict(self, keep):
+        """Deletes the least recently drawn bricks beyond the budget, never the ones of this frame"""
+        limit = max(1, self.gpu_budget // (volume.BRICK ** 3 * 2))
+        for key in list(self.textures):
+            if len(self.textures) <= limit:
+                break
+            if key not in keep:
+                glDeleteTextures([self.textures.pop(key)[0]])
+
+    def _drop_textures(self):
+        if self.initialized and self.textures:
+            glDeleteTextures([tex for tex, _ in self.textures.values()])
+        self.textures = OrderedDict()
+
+    def _ensure_fbo(self, width, height):
+        if self.fbo_size == (width, height):
+            return
+        glBindTexture(GL_TEXTURE_2D, self.projection_tex)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_R32F, width, height, 0, GL_RED, GL_FLOAT, None)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.projection_tex, 0)
+        self.fbo_size = (width, height)
+
+    def _create_program(self, vertex_src, fragment_src):
+        vs = helpers.compile_shader(vertex_src, GL_VERTEX_SHADER)
+        fs = helpers.compile_shader(fragment_src, GL_FRAGMENT_SHADER)
         prog = glCreateProgram()
         glAttachShader(prog, vs)
         glAttachShader(prog, fs)
@@ -284,31 +1449,116 @@ class PointCloud2D(QOpenGLWidget):
 
         glDeleteShader(vs)
         glDeleteShader(fs)
-
         return prog
 
-    def _get_uniforms(self):
-        self.u_transform = glGetUniformLocation(self.program, "u_transform")
-        self.u_pointSize = glGetUniformLocation(self.program, "u_pointSize")
-        self.u_vmin = glGetUniformLocation(self.program, "vmin")
-        self.u_vmax = glGetUniformLocation(self.program, "vmax")
+    def cleanup(self):
+        self.initialized = False
+        self.brick_program = 0
+        self.composite_program = 0
+        self.cube_vao = 0
+        self.cube_vbo = 0
+        self.empty_vao = 0
+        self.fbo = 0
+        self.projection_tex = 0
+        self.fbo_size = (0, 0)
+        self.textures = OrderedDict()
+
+
+class VolumeWidget(QOpenGLWidget):
+    """
+    The layer stack in 3D as a maximum intensity projection. Drag to turn it,
+    wheel to move closer. set_volume points it at the bricks of a volume folder,
+    volume_changed() after the build task added layers.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.renderer = VolumeRenderer()
+        self.last_pos = None
+        self.show_timing = False
+        self.frame_cpu_ms = None
+
+    # ---------- public API ----------
+
+    def set_volume(self, folder):
+        with profiling.stage("VolumeWidget.set_volume", folder=str(folder)):
+            store = volume.BrickStore.open(folder)
+        if self.isValid():
+            self.makeCurrent()
+        self.renderer.set_store(store)
+        self.update()
+
+    def volume_changed(self):
+        # changed bricks carry a new version and are uploaded again on the next frame
+        self.update()
+
+    def set_value_range(self, value_range):
+        self.renderer.vmin = float(value_range[0])
+        self.renderer.vmax = float(value_range[1])
+        self.update()
+
+    def set_z_scale(self, z_scale):
+        self.renderer.z_scale = float(z_scale)
+        self.update()
+
+    def set_show_timing(self, on: bool):
+        self.show_timing = bool(on)
+        self.update()
+
+    # ---------- Qt / OpenGL ----------
+
+    def initializeGL(self):
+        self.context().aboutToBeDestroyed.connect(self.cleanup)
+        self.makeCurrent()
+        self.renderer.initialize()
+
+    def paintGL(self):
+        ratio = self.devicePixelRatio()
+        start = time.perf_counter()
+        with profiling.stage("VolumeWidget.paintGL") as st:
+            self.renderer.paint(self.width() * ratio, self.height() * ratio, self.defaultFramebufferObject())
+            st.set(bricks=self.renderer.drawn, resident=len(self.renderer.textures))
+        self.frame_cpu_ms = (time.perf_counter() - start) * 1000
+
+        if self.show_timing:
+            painter = QPainter(self)
+            painter.setPen(QColor("white"))
+            painter.drawText(8, 16, f"cpu {self.frame_cpu_ms:.2f} ms   bricks {self.renderer.drawn} "
+                                    f"of {len(self.renderer.textures)} resident")
+            painter.end()
+
+        # bricks left over for the next frame
+        if self.renderer.incomplete:
+            QTimer.singleShot(0, self.update)
+
+    # ---------- mouse interaction ----------
+
+    def wheelEvent(self, event):
+        step = 0.9 if event.angleDelta().y() > 0 else 1.1
+        self.renderer.distance = float(np.clip(self.renderer.distance * step, 0.05, 50.0))
+        self.update()
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.last_pos = event.position()
+
+    def mouseMoveEvent(self, event):
+        if self.last_pos is None:
+            return
+        dx = event.position().x() - self.last_pos.x()
+        dy = event.position().y() - self.last_pos.y()
+        self.renderer.yaw -= 0.4 * dx
+        self.renderer.pitch = float(np.clip(self.renderer.pitch + 0.4 * dy, -89.0, 89.0))
+        self.last_pos = event.position()
+        self.update()
+
+    def mouseReleaseEvent(self, event):
+        self.last_pos = None
+
     def __del__(self):
-        # This "empty" destructor prevents PyOpenGL from 
-        # trying to call glDelete* during Python shutdown.
         pass
 
-
     def cleanup(self):
-        """Call this manually or on the aboutToQuit signal."""
         self.makeCurrent()
-        if self.program:
-            # glDeleteProgram(self.program) # Optional, but safer to just nullify
-            self.program = 0
-        if self.vbo:
-            # glDeleteBuffers(1, [self.vbo])
-            self.vbo = 0
-        if self.vao:
-            # glDeleteVertexArrays(1, [self.vao])
-            self.vao = 0
+        self.renderer.cleanup()
         self.doneCurrent()
-
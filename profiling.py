@@ -0,0 +1,157 @@
+
+"""
+Per stage instrumentation of the pipeline. A stage records wall time, current
+and peak RSS, row counts, the size of its input files and optionally the
+polars query plan.
+Every record is appended as one json line to the profile log and emitted
+through signals.stageFinished for the sidebar panel.
+
+    with profiling.stage("DataWorker.aggregate", files=len(files)) as st:
+        df = ldf.collect()
+        st.set(rows=len(df))
+
+Off by default, switch it on with set_enabled or EBM_PROFILE=1.
+EBM_PROFILE_PLANS=1 also stores the optimized query plans.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from PySide6.QtCore import QObject, Signal
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak rss is left out there
+    resource = None
+
+
+LOG_FILE = Path(os.environ.get("EBM_PROFILE_LOG", "profile_log.jsonl"))
+
+enabled = os.environ.get("EBM_PROFILE", "0") == "1"
+include_plans = os.environ.get("EBM_PROFILE_PLANS", "0") == "1"
+
+_lock = threading.Lock()
+
+
+class ProfilerSignals(QObject):
+    stageFinished = Signal(object)
+
+signals = ProfilerSignals()
+
+
+def set_enabled(on, plans=None):
+    global enabled, include_plans
+    enabled = bool(on)
+    if plans is not None:
+        include_plans = bool(plans)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    if sys.platform == "darwin":
+        return peak / 2**20
+    return peak / 2**10
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def bytes_on_disk(files):
+    """
+    Size of files, not what a stage reads of them, pruned columns and batches
+    never leave the disk. None while profiling is off, the stat calls are skipped.
+    """
+    if not enabled:
+        return None
+    return sum(os.path.getsize(f) for f in files if os.path.exists(f))
+
+
+class Stage:
+    def __init__(self, name, fields):
+        self.record = dict(stage=name, **fields)
+
+    def set(self, **fields):
+        self.record.update(fields)
+
+    def plan(self, ldf):
+        if include_plans:
+            self.record["plan"] = ldf.explain()
+
+
+class _NoStage:
+    """Handed out while profiling is off, so the call sites don't need their own checks"""
+    def set(self, **fields):
+        pass
+
+    def plan(self, ldf):
+        pass
+
+_no_stage = _NoStage()
+
+
+@contextmanager
+def stage(name, **fields):
+    if not enabled:
+        yield _no_stage
+        return
+
+    st = Stage(name, fields)
+    start = time.perf_counter()
+    try:
+        yield st
+    finally:
+        st.record["wall_s"] = time.perf_counter() - start
+        st.record["rss_mb"] = rss_mb()
+        st.record["peak_rss_mb"] = peak_rss_mb()
+        st.record["thread"] = threading.current_thread().name
+        st.record["time"] = time.time()
+        _write(st.record)
+        signals.stageFinished.emit(st.record)
+
+
+def record(name, wall_s, **fields):
+    """A stage that was timed elsewhere, like the startup of the app"""
+    if not enabled:
+        return
+    rec = dict(stage=name, **fields)
+    rec["wall_s"] = wall_s
+    rec["rss_mb"] = rss_mb()
+    rec["peak_rss_mb"] = peak_rss_mb()
+    rec["thread"] = threading.current_thread().name
+    rec["time"] = time.time()
+    _write(rec)
+    signals.stageFinished.emit(rec)
+
+
+def _write(record):
+    line = json.dumps(record, default=str)
+    with _lock:
+        with open(LOG_FILE, "a") as f:
+            f.write(line + "\n")
+
+
+def format_record(record):
+    """One line summary for the sidebar"""
+    text = f"{record['stage']}: {record['wall_s'] * 1000:.1f} ms"
+    if record.get("rows") is not None:
+        text += f", {record['rows']:,} rows"
+    if record.get("bytes_read") is not None:
+        text += f", {record['bytes_read'] / 2**20:.1f} MB read"
+    if record.get("bytes_on_disk") is not None:
+        text += f", {record['bytes_on_disk'] / 2**20:.1f} MB on disk"
+    if record.get("peak_rss_mb") is not None:
+        text += f", peak {record['peak_rss_mb']:.0f} MB"
+    return text
@@ -0,0 +1,148 @@
+
+"""
+Headless batch rendering of layer ranges to png, for post build reports on a
+machine without a display. Every build folder is cut into windows of --window
+layers, each window runs through DataWorker and is drawn with the PointCloud2D
+shaders on an offscreen surface. Windows are spread over a process pool.
+
+    python render_cli.py build_a/arrow_files build_b/arrow_files --out reports --window 10 --processes 4
+"""
+import argparse
+import hashlib
+import os
+import sys
+import multiprocessing
+from pathlib import Path
+
+
+# set per process by _init_process
+_app = None
+_offscreen = None
+
+
+def _init_process(width, height, platform, polars_threads):
+    global _app, _offscreen
+    # without a display qt needs the offscreen (or eglfs) platform before the app exists
+    os.environ["QT_QPA_PLATFORM"] = platform
+    # every process gets its share of the cores instead of a full polars pool each
+    os.environ.setdefault("POLARS_MAX_THREADS", str(polars_threads))
+
+    from PySide6.QtGui import QGuiApplication, QSurfaceFormat
+    import offscreen
+
+    QSurfaceFormat.setDefaultFormat(offscreen.default_format())
+    _app = QGuiApplication([])
+    _offscreen = offscreen.OffscreenRenderer(width, height)
+
+
+def aggregate(files, ch, nth, strategy, grid_size=None):
+    """Runs DataWorker synchronously and returns what it emitted"""
+    import helperfunctions as helpers
+
+    result = dict()
+    worker = helpers.DataWorker(nth, ch, files, strategy, grid_size=grid_size)
+    worker.carrier.finished.connect(lambda arr, channels: result.update(points=(arr, channels)))
+    worker.carrier.grid_finished.connect(lambda grid, channels: result.update(grid=(grid, channels)))
+    worker.carrier.histogram_finished.connect(lambda hist: result.update(histogram=hist))
+    worker.run()
+    return result
+
+
+def render_job(job):
+    import numpy as np
+    import offscreen
+
+    result = aggregate(job["files"], job["ch"], job["nth"], job["strategy"], job["grid_size"])
+
+    renderer = _offscreen.renderer
+    renderer.point_size = job["point_size"]
+    renderer.vmin, renderer.vmax = job["value_range"]
+    _offscreen.make_current()
+    if "grid" in result:
+        renderer.set_grid(*result["grid"])
+    elif "points" in result:
+        renderer.set_points(np.ascontiguousarray(result["points"][0]), result["points"][1])
+    else:
+        return job["out"], False
+
+    image = offscreen.image_from_array(_offscreen.render())
+    return job["out"], image.save(job["out"], "PNG")
+
+
+def layer_windows(count, window, step):
+    """1 based inclusive (first, last) layer ranges"""
+    return [(first, min(first + window - 1, count)) for first in range(1, count + 1, step)]
+
+
+def build_folder(out, folder):
+    """
+    Subfolder of out for an arrow folder: the build's name and a short hash of
+    the full path, two builds whose folders share a name don't overwrite each other
+    """
+    folder = Path(folder).resolve()
+    digest = hashlib.sha1(str(folder).encode()).hexdigest()[:8]
+    return Path(out) / f"{folder.parent.name}_{digest}"
+
+
+def build_jobs(args):
+    import helperfunctions as helpers
+
+    jobs = []
+    for folder in args.folders:
+        files = helpers.get_arrow_files(folder)
+        out_dir = build_folder(args.out, folder)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for first, last in layer_windows(len(files), args.window, args.step or args.window):
+            jobs.append(dict(
+                files=files[first - 1:last],
+                ch=args.channel,
+                nth=args.nth,
+                strategy=args.strategy,
+                grid_size=args.grid_size,
+                point_size=args.point_size,
+                value_range=(args.vmin, args.vmax),
+                out=str(out_dir / f"layers_{first}-{last}_{args.channel}.png"),
+            ))
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render layer ranges of arrow folders to png without a display")
+    parser.add_argument("folders", nargs="+", help="arrow folders, one per build")
+    parser.add_argument("--out", default="renders", help="output folder, one subfolder per build")
+    parser.add_argument("--window", type=int, default=10, help="layers aggregated per image")
+    parser.add_argument("--step", type=int, default=None, help="layers between two windows, defaults to --window")
+    parser.add_argument("--channel", default="mean")
+    parser.add_argument("--strategy", default="mean", choices=["mean", "max", "median", "p90", "p95", "p99"])
+    parser.add_argument("--nth", type=int, default=1, help="only take every nth sample")
+    parser.add_argument("--grid-size", type=int, default=None, help="draw as image with this many cells instead of points")
+    # the value range the viewer starts with, before the energy slider is moved
+    parser.add_argument("--vmin", type=float, default=0, help="value shown with the lowest color")
+    parser.add_argument("--vmax", type=float, default=2**15, help="value shown with the highest color")
+    parser.add_argument("--point-size", type=float, default=3.0)
+    parser.add_argument("--width", type=int, default=2048)
+    parser.add_argument("--height", type=int, default=2048)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--platform", default="offscreen", help="QT_QPA_PLATFORM for the render processes")
+    args = parser.parse_args(argv)
+
+    jobs = build_jobs(args)
+    print(f"{len(jobs)} images to render")
+
+    failed = 0
+    polars_threads = max(1, (os.cpu_count() or 1) // args.processes)
+    # spawn, forking a process that already runs the polars thread pool can deadlock
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(args.processes, initializer=_init_process,
+                      initargs=(args.width, args.height, args.platform, polars_threads)) as pool:
+        for out, success in pool.imap_unordered(render_job, jobs):
+            if success:
+                print(f"Rendered {out}")
+            else:
+                failed += 1
+                print(f"Rendering {out} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
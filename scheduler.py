@@ -0,0 +1,173 @@
+
+"""
+One place where every background task of the app is started. Tasks come in
+priority classes:
+
+    interactive   recalculations the user waits for (view, zoomed region)
+    ingest        wav files of the running melt turned into arrow files
+    background    short jobs the user started or waits on: exports, histogram
+                  filters, the session, prefetching
+    backfill      work on whole folders: converting a build, the volume
+    service       long running loops that hardly use the cpu (the watchdog)
+
+Every class has its own thread pool and concurrency limit. Background and
+backfill tasks are held back while an interactive one runs and ingest drops
+to one task at a time, so a recalculation doesn't compete with a folder
+conversion for the cores. Backfill has its own queue, an export doesn't wait
+for a build of 500 layers to be converted. Tasks submitted with a key replace a queued task with the same key,
+a new view request doesn't wait behind an outdated one.
+
+Polars sizes its thread pool once per process when it is imported, that pool is
+shared by all tasks. Import this module before polars so it leaves a core for
+the GUI and OpenGL thread (POLARS_MAX_THREADS in the environment still wins).
+"""
+import os
+import sys
+
+CORES = os.cpu_count() or 1
+
+if "polars" in sys.modules:
+    print("scheduler imported after polars, POLARS_MAX_THREADS has no effect anymore")
+os.environ.setdefault("POLARS_MAX_THREADS", str(max(1, CORES - 1)))
+POLARS_THREADS = int(os.environ["POLARS_MAX_THREADS"])
+
+from collections import deque
+
+from PySide6.QtCore import QObject, QRunnable, QThread, QThreadPool, Signal
+
+
+INTERACTIVE = "interactive"
+INGEST = "ingest"
+BACKGROUND = "background"
+BACKFILL = "backfill"
+SERVICE = "service"
+
+# highest first, pending tasks are started in this order
+PRIORITIES = [INTERACTIVE, INGEST, BACKGROUND, BACKFILL]
+
+LIMITS = {
+    # the view and the zoomed region recompute
+    INTERACTIVE: 2,
+    INGEST: 2,
+    BACKGROUND: 1,
+    # one layer conversion per core, like the old arrow pool
+    BACKFILL: CORES,
+    SERVICE: 8,
+}
+# ingest limit while an interactive task runs
+INGEST_LIMIT_BUSY = 1
+
+THREAD_PRIORITIES = {
+    INTERACTIVE: QThread.HighPriority,
+    INGEST: QThread.NormalPriority,
+    BACKGROUND: QThread.LowPriority,
+    BACKFILL: QThread.LowestPriority,
+    SERVICE: QThread.LowPriority,
+}
+
+
+class SchedulerSignals(QObject):
+    jobFinished = Signal(object)
+
+
+class _Job(QRunnable):
+    """Runs the submitted task and reports back to the scheduler in the GUI thread"""
+    def __init__(self, task, priority, key, signals):
+        super().__init__()
+        self.task = task
+        self.priority = priority
+        self.key = key
+        self.signals = signals
+
+    def run(self):
+        try:
+            self.task.run()
+        finally:
+            self.signals.jobFinished.emit(self)
+
+
+class TaskScheduler(QObject):
+    """Use the shared instance(), submit() is meant to be called from the GUI thread"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pools = dict()
+        for priority, limit in LIMITS.items():
+            pool = QThreadPool(self)
+            pool.setMaxThreadCount(limit)
+            pool.setThreadPriority(THREAD_PRIORITIES[priority])
+            self.pools[priority] = pool
+
+        self.pending = {priority: deque() for priority in PRIORITIES}
+        self.running = {priority: set() for priority in LIMITS}
+
+        self.signals = SchedulerSignals()
+        self.signals.jobFinished.connect(self._on_finished)
+
+    def submit(self, task, priority=BACKGROUND, key=None):
+        """
+        Queues a QRunnable (or anything with run()) in a priority class. With a key
+        a queued task with the same key is dropped, a running one is not touched.
+        """
+        job = _Job(task, priority, key, self.signals)
+        if priority == SERVICE:
+            self.running[SERVICE].add(job)
+            self.pools[SERVICE].start(job)
+            return
+
+        queue = self.pending[priority]
+        if key is not None:
+            for old in [j for j in queue if j.key == key]:
+                queue.remove(old)
+        queue.append(job)
+        self._dispatch()
+
+    def busy(self, priority=None):
+        if priority is not None:
+            return bool(self.running[priority] or self.pending.get(priority))
+        return any(self.busy(p) for p in PRIORITIES)
+
+    def limit(self, priority):
+        if priority == INGEST and self.running[INTERACTIVE]:
+            return INGEST_LIMIT_BUSY
+        if priority in (BACKGROUND, BACKFILL) and (self.running[INTERACTIVE] or self.pending[INTERACTIVE]):
+            return 0
+        return LIMITS[priority]
+
+    def _dispatch(self):
+        for priority in PRIORITIES:
+            queue = self.pending[priority]
+            while queue and len(self.running[priority]) < self.limit(priority):
+                self._start(queue.popleft())
+
+    def _start(self, job):
+        self.running[job.priority].add(job)
+        self.pools[job.priority].start(job)
+
+    def _on_finished(self, job):
+        self.running[job.priority].discard(job)
+        self._dispatch()
+
+    def wait_for_done(self):
+        """
+        Blocks until the cpu classes are done, pending ingest included so no
+        layer of the melt gets lost. Queued interactive, background and backfill
+        tasks are dropped, service tasks have to be stopped by their owner.
+        """
+        self.pending[INTERACTIVE].clear()
+        self.pending[BACKGROUND].clear()
+        self.pending[BACKFILL].clear()
+        # the GUI thread is blocked here, so finished jobs can't start the next one
+        while self.pending[INGEST]:
+            self._start(self.pending[INGEST].popleft())
+        for priority in PRIORITIES:
+            self.pools[priority].waitForDone()
+
+
+_instance = None
+
+def instance():
+    global _instance
+    if _instance is None:
+        _instance = TaskScheduler()
+    return _instance
@@ -0,0 +1,367 @@
+
+"""
+Optional aggregation service: a separate process that runs DataWorker for the
+viewers. A large aggregation can't take the GUI down with it anymore, and
+viewers on the same machine share one warm cache of results.
+
+    python service.py
+    python service.py --address 127.0.0.1:49000 --cache-mb 4096 --jobs 2
+
+Viewers use it through RemoteDataWorker. Tick "aggregate in a separate service"
+in the sidebar; EBM_SERVICE=host:port picks another address on both sides.
+Requests and the small results (histograms, extent) go over a multiprocessing
+connection. The point and grid buffers, and the kept aggregate as arrow ipc
+bytes, go through shared memory, which the client copies once and then
+releases. The service never writes into the client's session. If no service answers, RemoteDataWorker
+aggregates in the GUI process like DataWorker does.
+"""
+import argparse
+import hashlib
+import io
+import os
+import secrets
+import subprocess
+import sys
+import threading
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+
+import numpy as np
+from PySide6.QtCore import QRunnable
+
+import helperfunctions as helpers
+import startup
+
+pl = startup.lazy("polars")
+
+
+DEFAULT_ADDRESS = "127.0.0.1:48917"
+# requests are unpickled, so only processes of this user may talk to the service:
+# a random key made on first use in a file only the user can read
+KEY_FILE = Path(os.environ.get("EBM_SERVICE_KEY_FILE", Path.home() / ".ebm_visualizer" / "service.key"))
+# results kept for the next viewer asking the same
+CACHE_BYTES = 1 << 30
+# seconds a viewer waits for a result, a hung service doesn't hold the slot forever
+REQUEST_TIMEOUT = float(os.environ.get("EBM_SERVICE_TIMEOUT", "600"))
+
+
+def auth_key(path=KEY_FILE):
+    """The key of this user, service and viewers read the same file"""
+    path = Path(path)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+            # link fails if another process made its key first, then that one counts
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            tmp.unlink(missing_ok=True)
+    if os.name == "posix" and path.stat().st_mode & 0o077:
+        raise PermissionError(f"{path} can be read by other users, it has to be 0600")
+    return path.read_text().strip().encode()
+
+
+def service_address(address=None):
+    """"host:port" -> (host, port), EBM_SERVICE or DEFAULT_ADDRESS without one"""
+    address = address or os.environ.get("EBM_SERVICE", DEFAULT_ADDRESS)
+    host, port = address.rsplit(":", 1)
+    return (host, int(port))
+
+
+def _key_part(value):
+    # repr shortens long arrays with "...", the histogram of a merge request goes in by its bytes
+    if isinstance(value, np.ndarray):
+        return ("array", value.shape, value.dtype.str, hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest())
+    if isinstance(value, dict):
+        return tuple(sorted((k, _key_part(v)) for k, v in value.items()))
+    return repr(value)
+
+
+def request_key(args):
+    """Cache key of a request, a rewritten layer gives a new one"""
+    files = tuple((str(f), os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in args["files"])
+    # whether the aggregate is kept doesn't change it
+    rest = tuple(sorted((k, _key_part(v)) for k, v in args.items() if k not in ("files", "keep")))
+    return (files, rest)
+
+
+def run_worker(args):
+    """Runs DataWorker synchronously and returns what it emitted"""
+    result = dict()
+    worker = helpers.DataWorker(**args)
+    carrier = worker.carrier
+    carrier.histogram_finished.connect(lambda hist: result.update(histogram=hist))
+    carrier.channel_histograms_finished.connect(lambda hists: result.update(channel_histograms=hists))
+    carrier.extent_finished.connect(lambda extent: result.update(extent=extent))
+    carrier.finished.connect(lambda arr, values: result.update(points=(np.ascontiguousarray(arr), values)))
+    carrier.grid_finished.connect(lambda grid, values: result.update(grid=(np.ascontiguousarray(grid), values)))
+    carrier.kept.connect(lambda df, sketches: result.update(aggregate=df, sketches=sketches))
+    worker.run()
+    return result
+
+
+def result_bytes(result):
+    size = 0
+    for value in result.values():
+        if isinstance(value, tuple) and isinstance(value[0], np.ndarray):
+            size += value[0].nbytes
+        elif isinstance(value, np.ndarray):
+            size += value.nbytes
+        elif isinstance(value, dict):
+            size += sum(v.estimated_size() if isinstance(v, pl.DataFrame) else getattr(v, "nbytes", 0)
+                        for v in value.values())
+        elif isinstance(value, pl.DataFrame):
+            size += value.estimated_size()
+    return size
+
+
+class AggregationService:
+    """
+    Accepts connections on address, one thread each. At most jobs aggregations
+    run at the same time, finished results stay in an LRU cache of cache_bytes.
+    """
+
+    def __init__(self, address, cache_bytes=CACHE_BYTES, jobs=1):
+        self.listener = Listener(address, authkey=auth_key())
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached = 0
+        self.lock = threading.Lock()
+        self.jobs = threading.Semaphore(jobs)
+
+    def serve_forever(self):
+        print(f"Aggregation service listening on {self.listener.address}")
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (OSError, AuthenticationError) as e:
+                print(f"Refused a connection: {e}")
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                op = request.get("op")
+                if op == "ping":
+                    conn.send(dict(ok=True, pid=os.getpid()))
+                elif op == "aggregate":
+                    try:
+                        result = self.aggregate(request["args"])
+                    except Exception as e:
+                        conn.send(dict(ok=False, error=f"{type(e).__name__}: {e}"))
+                        continue
+                    self._send_result(conn, result, request["args"].get("keep", False))
+                else:
+                    conn.send(dict(ok=False, error=f"unknown request {op!r}"))
+
+    def aggregate(self, args):
+        key = request_key(args)
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+        # a result without the aggregate can't answer a request that keeps it
+        if cached is not None and (not args.get("keep") or "aggregate" in cached):
+            return cached
+
+        with self.jobs:
+            result = run_worker(args)
+
+        size = result_bytes(result)
+        with self.lock:
+            self.cache[key] = result
+            self.cached += size
+            while self.cached > self.cache_bytes and len(self.cache) > 1:
+                self.cached -= result_bytes(self.cache.popitem(last=False)[1])
+        return result
+
+    def _send_result(self, conn, result, keep=False):
+        reply = dict(ok=True, **{k: v for k, v in result.items() if k not in ("points", "grid", "aggregate", "sketches")})
+        blocks = []
+
+        def share(arr, **extra):
+            shm = SharedMemory(create=True, size=max(arr.nbytes, 1))
+            blocks.append(shm)
+            view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+            view[...] = arr
+            # the buffer can't be closed while an array still points into it
+            del view
+            return dict(shm=shm.name, shape=arr.shape, dtype=arr.dtype.str, **extra)
+
+        try:
+            for name in ("points", "grid"):
+                if name in result:
+                    arr, values = result[name]
+                    reply[name] = share(arr, values=values)
+            if keep and "aggregate" in result:
+                reply["aggregate"] = share(frame_bytes(result["aggregate"]))
+                reply["sketches"] = {v: share(frame_bytes(sketch)) for v, sketch in result["sketches"].items()}
+            conn.send(reply)
+            if blocks:
+                # the client copied the buffers
+                conn.recv()
+        except (EOFError, OSError) as e:
+            print(f"Client went away while receiving: {e}")
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+
+def frame_bytes(df):
+    """A DataFrame as arrow ipc bytes in a uint8 array, read back with read_frame"""
+    buffer = io.BytesIO()
+    df.write_ipc(buffer)
+    return np.frombuffer(buffer.getbuffer(), dtype=np.uint8)
+
+
+def read_frame(arr):
+    return pl.read_ipc(io.BytesIO(arr.tobytes()))
+
+
+# ---------- client side ----------
+
+def _read_shared(block):
+    """Copies an array out of the shared memory the service described in block"""
+    shm = SharedMemory(name=block["shm"])
+    try:
+        if os.name == "posix":
+            # the service unlinks it, the tracker of this process would try again at exit
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        view = np.ndarray(block["shape"], dtype=np.dtype(block["dtype"]), buffer=shm.buf)
+        arr = view.copy()
+        del view
+    finally:
+        shm.close()
+    return arr
+
+
+def request_aggregate(args, address=None, timeout=REQUEST_TIMEOUT):
+    """
+    Sends one aggregation to the service and returns the result as run_worker does.
+    ConnectionRefusedError if no service listens, TimeoutError if it doesn't answer in time.
+    """
+    with Client(service_address(address), authkey=auth_key()) as conn:
+        conn.send(dict(op="aggregate", args=args))
+        if not conn.poll(timeout):
+            raise TimeoutError(f"no result after {timeout:.0f} s")
+        reply = conn.recv()
+        if not reply.pop("ok"):
+            raise RuntimeError(reply["error"])
+        shared = [name for name in ("points", "grid", "aggregate") if name in reply]
+        for name in ("points", "grid"):
+            if name in reply:
+                block = reply[name]
+                reply[name] = (_read_shared(block), block["values"])
+        if "aggregate" in reply:
+            reply["aggregate"] = read_frame(_read_shared(reply["aggregate"]))
+            reply["sketches"] = {v: read_frame(_read_shared(block)) for v, block in reply["sketches"].items()}
+        if shared:
+            conn.send("done")
+    return reply
+
+
+def ping(address=None):
+    try:
+        with Client(service_address(address), authkey=auth_key()) as conn:
+            conn.send(dict(op="ping"))
+            return conn.recv().get("ok", False)
+    except (OSError, EOFError, AuthenticationError):
+        return False
+
+
+def start_service(address=None):
+    """Starts a service in its own process unless one answers already, it outlives the viewer"""
+    if ping(address):
+        return False
+    command = [sys.executable, str(Path(__file__).resolve()), "--address", "%s:%d" % service_address(address)]
+    if os.name == "nt":
+        flags = subprocess.CREATE_NEW_PROCESS_GROUP | subprocess.DETACHED_PROCESS
+        subprocess.Popen(command, creationflags=flags, close_fds=True)
+    else:
+        subprocess.Popen(command, start_new_session=True, close_fds=True)
+    return True
+
+
+class RemoteDataWorker(QRunnable):
+    """
+    Takes the arguments of helpers.DataWorker and emits the same carrier signals,
+    the aggregation runs in the service. Falls back to a local DataWorker only if
+    no service listens, a service that goes down during the request fails it
+    (carrier.failed).
+    """
+
+    def __init__(self, nth, ch, files, strategy="mean", all_channels=False, grid_size=None, roi=None, extent=None,
+                 energy=None, histogram=True, noise=None, keep=False, base=None, known_histogram=None, address=None):
+        super().__init__()
+        self.args = dict(nth=nth, ch=ch, files=[str(f) for f in files], strategy=strategy,
+                         all_channels=all_channels, grid_size=grid_size, roi=roi, extent=extent,
+                         energy=energy, histogram=histogram, noise=noise,
+                         keep=keep, base=base, known_histogram=known_histogram)
+        self.address = address
+        self.carrier = helpers.DataCarriage()
+
+    def run(self):
+        if len(self.args["files"]) < 1:
+            return
+        try:
+            result = request_aggregate(self.args, self.address)
+        except ConnectionRefusedError as e:
+            # nothing listens, aggregating here is what the viewer did without the service
+            print(f"Aggregation service not reachable ({e}), aggregating here")
+            worker = helpers.DataWorker(**self.args)
+            worker.carrier = self.carrier
+            worker.run()
+            return
+        except (OSError, EOFError, AuthenticationError, RuntimeError) as e:
+            # most likely the service ran out of memory on it, the same job here would take the viewer down
+            print(f"Aggregation service failed: {e}")
+            self.carrier.failed.emit(f"The aggregation service failed: {e}")
+            return
+
+        # same order as DataWorker emits them
+        if "histogram" in result:
+            self.carrier.histogram_finished.emit(result["histogram"])
+        if "channel_histograms" in result:
+            self.carrier.channel_histograms_finished.emit(result["channel_histograms"])
+        if "extent" in result:
+            self.carrier.extent_finished.emit(result["extent"])
+        if "grid" in result:
+            self.carrier.grid_finished.emit(*result["grid"])
+        if "points" in result:
+            self.carrier.finished.emit(*result["points"])
+        if "aggregate" in result:
+            self.carrier.kept.emit(result["aggregate"], result["sketches"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Aggregation service for the EBM visualizer")
+    parser.add_argument("--address", default=None, help=f"host:port, defaults to EBM_SERVICE or {DEFAULT_ADDRESS}")
+    parser.add_argument("--cache-mb", type=int, default=CACHE_BYTES >> 20, help="results kept in memory")
+    parser.add_argument("--jobs", type=int, default=1, help="aggregations running at the same time")
+    args = parser.parse_args(argv)
+
+    service = AggregationService(service_address(args.address), args.cache_mb << 20, args.jobs)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
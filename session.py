@@ -0,0 +1,180 @@
+
+"""
+Snapshot of the current view, so a viewer that is started again mid melt shows
+the last picture right away instead of after a full recalculation. The session
+folder (EBM_SESSION, default ~/.ebm_visualizer/session) holds
+
+    session.json         folders and sidebar settings, extent, view and the files
+                         the picture was calculated from with their mtimes
+    aggregate_*.arrow    the points before normalizing: x, y, values and count,
+                         emitted by DataWorker (keep), the quantile sketches next to it
+    histogram.npy        (value, amount) of the shown channel
+    grid.npy             the picture in image mode, (C, H, W)
+
+The binary files are memory mapped when they are restored. A points view that
+follows the newest layer is brought up to date by aggregating only the layers
+written since and merging them into the snapshot (DataWorker base), for the
+quantile strategies through the sketches kept next to the aggregate.
+"""
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+import helperfunctions as helpers
+import profiling
+import startup
+
+pl = startup.lazy("polars")
+
+
+SESSION_DIR = Path(os.environ.get("EBM_SESSION", Path.home() / ".ebm_visualizer" / "session"))
+SESSION_NAME = "session.json"
+SESSION_VERSION = 1
+
+# strategies whose aggregates can be merged with the ones of further layers,
+# the quantiles through the sketches kept next to the aggregate
+MERGEABLE = ("mean", "max", *helpers.QUANTILES)
+
+
+def new_aggregate_path():
+    """Every view gets its own file, the one of the snapshot may still be mapped"""
+    SESSION_DIR.mkdir(parents=True, exist_ok=True)
+    return SESSION_DIR / f"aggregate_{time.time_ns()}.arrow"
+
+
+def file_state(files):
+    return [[str(f), os.stat(f).st_mtime_ns] for f in files]
+
+
+def write_aggregate(path, aggregate, sketches=None):
+    """The aggregate DataWorker kept and its sketches (value -> frame) next to it"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with profiling.stage("session.write_aggregate", rows=len(aggregate)):
+        with helpers.replace_when_done(path) as tmp:
+            aggregate.write_ipc(tmp)
+        for v, sketch in (sketches or dict()).items():
+            with helpers.replace_when_done(helpers.sketch_path(path, v)) as tmp:
+                sketch.write_ipc(tmp)
+
+
+def save(settings, histogram=None, grid=None):
+    """Writes the snapshot, session.json last so it only ever points at complete files"""
+    SESSION_DIR.mkdir(parents=True, exist_ok=True)
+    for name, array in (("histogram.npy", histogram), ("grid.npy", grid)):
+        path = SESSION_DIR / name
+        if array is None:
+            path.unlink(missing_ok=True)
+            continue
+        with helpers.replace_when_done(path) as tmp:
+            with open(tmp, "wb") as f:
+                np.save(f, np.asarray(array))
+
+    with helpers.replace_when_done(SESSION_DIR / SESSION_NAME) as tmp:
+        tmp.write_text(json.dumps(dict(settings, version=SESSION_VERSION), default=float))
+
+    # aggregates of earlier views and their sketches, one that is still mapped goes next time
+    keep = Path(settings["aggregate"]).stem if settings.get("aggregate") else None
+    for path in SESSION_DIR.glob("aggregate_*.arrow"):
+        if path.name.split(".")[0] != keep:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def load():
+    """The snapshot as dict(settings, aggregate, histogram, grid), None without a usable one"""
+    path = SESSION_DIR / SESSION_NAME
+    if not path.exists():
+        return None
+    try:
+        settings = json.loads(path.read_text())
+    except ValueError as e:
+        print(f"Ignoring broken {path}: {e}")
+        return None
+    if settings.get("version") != SESSION_VERSION:
+        return None
+
+    snapshot = dict(settings=settings, aggregate=None, histogram=None, grid=None)
+    if settings.get("aggregate") and (SESSION_DIR / settings["aggregate"]).exists():
+        snapshot["aggregate"] = SESSION_DIR / settings["aggregate"]
+    for name in ("histogram", "grid"):
+        file = SESSION_DIR / f"{name}.npy"
+        if file.exists():
+            snapshot[name] = np.load(file, mmap_mode="r")
+    return snapshot
+
+
+def load_points(snapshot):
+    """Points of the snapshot normalized like DataWorker emits them, None if it has none"""
+    if snapshot["aggregate"] is None:
+        return None
+    settings = snapshot["settings"]
+    ldf = pl.read_ipc(snapshot["aggregate"], memory_map=True).lazy()
+    return helpers.normalize_data(ldf, settings["values"], tuple(settings["extent"])).collect().to_numpy()
+
+
+def unchanged(settings):
+    """Whether every file of the snapshot is still there as it was"""
+    try:
+        return all(os.stat(f).st_mtime_ns == mtime for f, mtime in settings["files"])
+    except OSError:
+        return False
+
+
+def can_merge(settings):
+    """Whether further layers can be merged into the snapshot instead of calculating it again"""
+    if not (settings["strategy"] in MERGEABLE and not settings["all_channels"]
+            and settings["render_mode"] == "points" and settings["energy_filter"] is None
+            and settings["noise"] is None and settings.get("aggregate") is not None):
+        return False
+    # snapshots from before the sketches were kept can't take further quantiles
+    return (settings["strategy"] not in helpers.QUANTILES
+            or all(helpers.sketch_path(SESSION_DIR / settings["aggregate"], v).exists() for v in settings["values"]))
+
+
+class SessionSaveTask(QRunnable):
+    """Writes the kept aggregate to settings["aggregate"] first, then the snapshot"""
+
+    def __init__(self, settings, histogram=None, grid=None, aggregate=None, sketches=None):
+        super().__init__()
+        self.settings = settings
+        self.histogram = histogram
+        self.grid = grid
+        self.aggregate = aggregate
+        self.sketches = sketches
+
+    def run(self):
+        try:
+            if self.aggregate is not None:
+                write_aggregate(SESSION_DIR / self.settings["aggregate"], self.aggregate, self.sketches)
+            save(self.settings, self.histogram, self.grid)
+        except OSError as e:
+            print(f"Could not save the session: {e}")
+
+
+class SessionSignals(QObject):
+    loaded = Signal(object)
+
+class SessionLoadTask(QRunnable):
+    """Reads the snapshot and normalizes its points off the GUI thread, the window is up meanwhile"""
+
+    def __init__(self):
+        super().__init__()
+        self.signals = SessionSignals()
+
+    def run(self):
+        snapshot = load()
+        if snapshot is None:
+            return
+        snapshot["points"] = None
+        if snapshot["settings"]["render_mode"] != "image" or snapshot["grid"] is None:
+            try:
+                snapshot["points"] = load_points(snapshot)
+            except Exception as e:
+                print(f"Could not read the points of the session: {e}")
+        self.signals.loaded.emit(snapshot)
@@ -5,26 +5,97 @@
 from __future__ import annotations
 
 import sys
-from PySide6.QtCore import Qt, Signal, QThread, QDir, QPoint, QPointF, QMargins, QRunnable, QThreadPool
+from PySide6.QtCore import Qt, Signal, QThread, QDir, QPoint, QPointF, QMargins, QRunnable
 
 from PySide6.QtGui import QSurfaceFormat, QMovie, QPainter, QColor, QGradient, QLinearGradient, QPen
 
-from PySide6.QtWidgets import QApplication,QSlider, QHBoxLayout, QVBoxLayout, QGridLayout, QWidget, QLabel, QPushButton, QSpinBox, QComboBox, QFileDialog, QStackedLayout
-from PySide6.QtCharts import QChart, QChartView, QBarSet, QAreaSeries, QLineSeries, QBarCategoryAxis, QValueAxis, QScatterSeries
+from PySide6.QtWidgets import QApplication,QSlider, QHBoxLayout, QVBoxLayout, QGridLayout, QWidget, QLabel, QPushButton, QSpinBox, QDoubleSpinBox, QComboBox, QFileDialog, QStackedLayout, QCheckBox
 
-from PySide6.QtSvgWidgets import QSvgWidget
 from PySide6.QtOpenGLWidgets import QOpenGLWidget
 
 from superqt import QRangeSlider
 from pathlib import Path
+import scheduler
 import helperfunctions as helpers
+import dataexport
+import profiling
 import numpy as np
 import openglwidget as glw
-import polars as pl
 import os
 from natsort import natsorted
 
 
+# colors of lines that weren't given one
+SERIES_COLORS = ["#3498db", "#e63946", "#2a9d8f", "#f4a261", "#9b5de5"]
+
+class LayerSeriesPlot(QWidget):
+    """Line chart of values over the layer number, one line per name. The chart is built with the first data"""
+    def __init__(self, names=(), colors=(), parent=None):
+        super().__init__(parent)
+        self.layout = QVBoxLayout(self)
+        self.layout.setContentsMargins(0, 0, 0, 0)
+        self.names = names
+        self.colors = colors
+        self.chart = None
+
+    def _build_chart(self):
+        # QtCharts is loaded here, not while the window comes up
+        from PySide6.QtCharts import QChart, QChartView, QValueAxis
+        self.chart = QChart()
+        self.chart.layout().setContentsMargins(0, 0, 0, 0)
+        self.chart.legend().setAlignment(Qt.AlignBottom)
+
+        self.axis_x = QValueAxis()
+        self.axis_x.setLabelFormat("%d")
+        self.axis_y = QValueAxis()
+        self.chart.addAxis(self.axis_x, Qt.AlignBottom)
+        self.chart.addAxis(self.axis_y, Qt.AlignLeft)
+
+        self.series = dict()
+        for name, color in zip(self.names, self.colors):
+            self._add_series(name, color)
+
+        self.view = QChartView(self.chart)
+        self.view.setRenderHint(QPainter.Antialiasing)
+        self.layout.addWidget(self.view)
+
+    def _add_series(self, name, color=None):
+        from PySide6.QtCharts import QLineSeries
+        series = QLineSeries()
+        series.setName(name)
+        series.setColor(QColor(color or SERIES_COLORS[len(self.series) % len(SERIES_COLORS)]))
+        self.chart.addSeries(series)
+        series.attachAxis(self.axis_x)
+        series.attachAxis(self.axis_y)
+        self.series[name] = series
+        return series
+
+    def set_data(self, layers, values):
+        """values: name -> one value per layer, NaN leaves a layer out. Lines not in values are hidden"""
+        if self.chart is None:
+            self._build_chart()
+        layers = np.asarray(layers)
+        for name in values:
+            if name not in self.series:
+                self._add_series(name)
+        for name, series in self.series.items():
+            ys = np.asarray(values.get(name, []), dtype=float)
+            keep = np.isfinite(ys)
+            series.replace([QPointF(x, y) for x, y in zip(layers[keep], ys[keep])])
+            series.setVisible(name in values)
+        self._update_ranges()
+
+    def _update_ranges(self):
+        points = [p for series in self.series.values() if series.isVisible() for p in series.points()]
+        if not points:
+            return
+        xs = [p.x() for p in points]
+        ys = [p.y() for p in points]
+        self.axis_x.setRange(min(xs), max(xs) if max(xs) > min(xs) else min(xs) + 1)
+        pad = (max(ys) - min(ys)) * 0.05 or 1.0
+        self.axis_y.setRange(min(ys) - pad, max(ys) + pad)
+
+
 class LoadingButton(QPushButton):
     def __init__(self, text, parent=None):
         super().__init__(text, parent)
@@ -110,6 +181,8 @@ class SliderWidget(QWidget):
     valueChanged = Signal()
     rangeAdjusted = Signal(object)
     released = Signal()
+    # only when the user let go of the slider or finished typing
+    committed = Signal()
     """A single slider with a name above and value spin box below. If double = True it will be a range slider instead"""
     def __init__(self, name, val_range, init_val,double = False):
         super().__init__()
@@ -144,10 +217,12 @@ class SliderWidget(QWidget):
         self.value_label.valueChanged.connect(self.update_slider)
         self.value_label.valueChanged.connect(self.finishedEditing)
         self.value_label.editingFinished.connect(self.finishedEditing)
+        self.value_label.editingFinished.connect(self.committed.emit)
 
         self.slider.valueChanged.connect(self.update_label)
         self.slider.valueChanged.connect(self.sendValue)
         self.slider.sliderReleased.connect(self.finishedEditing)
+        self.slider.sliderReleased.connect(self.committed.emit)
 
 
     def getValue(self):
@@ -178,11 +253,17 @@ class SliderWidget(QWidget):
 
 
 class HistogramPlot(QWidget):
+    """The chart is built with the first histogram"""
     rangeChanged = Signal(object)
     def __init__(self, parent=None):
         super().__init__(parent)
         self.layout = QVBoxLayout(self)
         self.layout.setContentsMargins(0, 0, 0, 0)
+        self.chart = None
+
+    def _build_chart(self):
+        # QtCharts is loaded here, not while the window comes up
+        from PySide6.QtCharts import QChart, QChartView, QAreaSeries, QLineSeries, QValueAxis
 
         # 1. Use QLineSeries for the "outline"
         self.line_series = QLineSeries()
@@ -237,6 +318,8 @@ class HistogramPlot(QWidget):
         """Expects 2D numpy array [[energy, count], ...]"""
         if data_array is None or len(data_array) == 0:
             return
+        if self.chart is None:
+            self._build_chart()
 
         self.current_data = data_array
 
@@ -252,6 +335,8 @@ class HistogramPlot(QWidget):
     def RangeChanged(self,vmin,vmax):
         self.rangeChanged.emit((vmin,vmax))
     def updateRedBorderLines(self,points):
+        if self.chart is None:
+            return
         x_left = float(points[0])
         x_right = float(points[1]) 
         y_value_left = self.get_y_from_x(x_left)
@@ -274,7 +359,19 @@ class Sidebar(QWidget):
     begincalculation = Signal()
     energyChanged = Signal(object)
     pointsizeChanged = Signal(object)
+    channelChanged = Signal(str)
+    timingToggled = Signal(bool)
+    adaptiveToggled = Signal(bool)
+    packedToggled = Signal(bool)
+    serviceToggled = Signal(bool)
+    # path, aggregated rows and value columns of the layer that is being written
+    liveChunk = Signal(str, object, object)
+    # the layer is written as arrow file, the next recalculation shows it
+    liveFinished = Signal(str)
+    # the arrow folder got new layers or another folder was chosen
+    layersChanged = Signal()
     export = Signal()
+    exportData = Signal()
     """Vertical sidebar with multiple sliders"""
     def __init__(self):
         super().__init__()
@@ -287,12 +384,17 @@ class Sidebar(QWidget):
         self.pointsize = 3
         self.channel = "mean"
         self.strategy = "mean"
+        self.all_channels = False
+        self.render_mode = "points"
+        self.grid_size = 2048
+        # histograms of every channel from the last all channel calculation
+        self.channel_histograms = dict()
         self.widgets = dict()
         self.wav_folder = QDir()
         self.arrow_folder = QDir("arrow_files")
-        self.arrowpool = QThreadPool(self)
-        self.histopool = QThreadPool(self)
-        self.watchdog_file_counter = 0
+        self.scheduler = scheduler.instance()
+        # wav path -> WavTailTask of the layers that are still being written
+        self.tail_tasks = dict()
 
 
 
@@ -303,6 +405,9 @@ class Sidebar(QWidget):
         
         self.arrow_button = LoadingButton(parent=self,text="create arrow Files")
 
+        self.zorderwidget = QCheckBox("write spatially sorted arrow files")
+        self.tailwidget = QCheckBox("show the layer while it is written")
+
         self.watchdog = LoadingButton(parent=self,text="deploy watchdog")
         self.histoFilter = LoadingButton(parent=self,text="calculate interesting frequencies")
 
@@ -313,7 +418,29 @@ class Sidebar(QWidget):
         self.channelwidget.addItems(["mean"])
 
         self.aggregationWidget = QComboBox()
-        self.aggregationWidget.addItems(["mean","max"])
+        self.aggregationWidget.addItems(helpers.STRATEGIES)
+
+        self.allchannelswidget = QCheckBox("aggregate all channels at once")
+
+        self.roiwidget = QCheckBox("recalculate zoomed area at full resolution")
+
+        self.filterwidget = QCheckBox("filter energy range at source")
+        # set while a recalculation only narrows the energy range, the histogram stays
+        self.keep_histogram = False
+
+        # noise filter, rare values in samples per million and the trimmed percent at both ends
+        self.noisewidget = QSpinBox()
+        self.noisewidget.setRange(0, 10000)
+        self.trimwidget = QDoubleSpinBox()
+        self.trimwidget.setRange(0, 25)
+        self.trimwidget.setSingleStep(0.5)
+
+        self.renderwidget = QComboBox()
+        self.renderwidget.addItems(["points","image"])
+
+        self.gridsizewidget = QSpinBox()
+        self.gridsizewidget.setRange(64,8192)
+        self.gridsizewidget.setValue(2048)
 
         self.resolutionwidget = QSpinBox()
         self.resolutionwidget.setMinimum(1)
@@ -335,9 +462,48 @@ class Sidebar(QWidget):
 
         self.layer_display = QLabel()
         self.layer_display.setText("")
+
+        self.profilewidget = QCheckBox("profile the pipeline")
+        self.profilewidget.setChecked(profiling.enabled)
+        # last record of every stage, one line each
+        self.profile_records = dict()
+        self.profile_display = QLabel()
+        self.profile_display.setWordWrap(True)
+        self.profile_display.setVisible(profiling.enabled)
         
-        self.export_button = QPushButton()
-        self.export_button.setText("Export to Png")
+        self.export_button = LoadingButton(parent=self,text="Export to Png")
+
+        self.exportwidthwidget = QSpinBox()
+        self.exportwidthwidget.setRange(256,2**16)
+        self.exportwidthwidget.setValue(4096)
+
+        # the aggregated values of the view as file, for analysis elsewhere
+        self.export_data_button = LoadingButton(parent=self,text="Export values")
+        self.exportformatwidget = QComboBox()
+        self.exportformatwidget.addItems(dataexport.FORMATS)
+
+        # right click in the view, how one spot changed over the layers
+        self.probe_label = QLabel("right click the picture to probe a spot over all layers")
+        self.probe_label.setWordWrap(True)
+        self.probeplot = LayerSeriesPlot(["mean", "max"], ["#3498db", "#e63946"], self)
+        self.probeplot.setMinimumSize(200, 180)
+        self.probeplot.setVisible(False)
+        self.proberadiuswidget = QSpinBox()
+        self.proberadiuswidget.setRange(0, 8)
+        self.last_probe = None
+
+        # statistics of every layer of the build, layer number -> dict from the stats sidecar
+        self.layer_stats = dict()
+        self.timelinewidget = QComboBox()
+        self.timelinewidget.addItems(["energy", "samples", "coverage"])
+        self.timelineplot = LayerSeriesPlot(parent=self)
+        self.timelineplot.setMinimumSize(200, 180)
+
+        self.timingwidget = QCheckBox("show frame timing")
+        self.adaptivewidget = QCheckBox("draw fewer points while moving slow views")
+        self.adaptivewidget.setChecked(True)
+        self.packedwidget = QCheckBox("compact GPU format (half the memory, coarser values)")
+        self.servicewidget = QCheckBox("aggregate in a separate service process")
 
 
 
@@ -348,20 +514,37 @@ class Sidebar(QWidget):
 
         self.recalculate.released.connect(self.beginRecalculation)
         self.histoFilter.released.connect(self.filterHistogram)
-        self.channelwidget.activated.connect(self.beginRecalculation)
+        self.channelwidget.activated.connect(self.changeChannel)
+        self.allchannelswidget.toggled.connect(self.beginRecalculation)
         self.aggregationWidget.activated.connect(self.beginRecalculation)
+        self.renderwidget.activated.connect(self.beginRecalculation)
+        self.gridsizewidget.editingFinished.connect(self.beginRecalculation)
+        self.noisewidget.editingFinished.connect(self.beginRecalculation)
+        self.trimwidget.editingFinished.connect(self.beginRecalculation)
         self.pointsizewidget.valueChanged.connect(self.get_pointsize)
         self.energywidget.valueChanged.connect(self.get_energy_range)
+        self.energywidget.committed.connect(self.refilterEnergy)
+        self.filterwidget.toggled.connect(self.beginRecalculation)
         self.energywidget.rangeAdjusted.connect(self.histogramWidget.updateRedBorderLines)
         self.histogramWidget.rangeChanged.connect(self.energywidget.setRange)
         self.layerwidget.released.connect(self.beginRecalculation)
         self.resolutionwidget.valueChanged.connect(self.beginRecalculation)
         self.export_button.released.connect(self.export.emit)
+        self.export_data_button.released.connect(self.exportData.emit)
+        self.profilewidget.toggled.connect(self.toggleProfiling)
+        self.timelinewidget.activated.connect(self.drawTimeline)
+        self.timingwidget.toggled.connect(self.timingToggled.emit)
+        self.adaptivewidget.toggled.connect(self.adaptiveToggled.emit)
+        self.packedwidget.toggled.connect(self.packedToggled.emit)
+        self.servicewidget.toggled.connect(self.serviceToggled.emit)
+        profiling.signals.stageFinished.connect(self.showProfileRecord)
 
         layout.addWidget(self.wav_folder_button)
         layout.addWidget(self.arrow_folder_button)
         layout.addWidget(self.watchdog)
         layout.addWidget(self.arrow_button)
+        layout.addWidget(self.zorderwidget)
+        layout.addWidget(self.tailwidget)
         layout.addWidget(self.histoFilter)
 
         energyLayout = QVBoxLayout()
@@ -379,6 +562,29 @@ class Sidebar(QWidget):
         optionsLayout.addWidget(QLabel("which channel should be shown"),2,1)
         optionsLayout.addWidget(self.aggregationWidget,3,0)
         optionsLayout.addWidget(QLabel("which aggregation strategy to use"),3,1)
+        optionsLayout.addWidget(self.allchannelswidget,4,0,1,2)
+        optionsLayout.addWidget(self.renderwidget,5,0)
+        optionsLayout.addWidget(QLabel("draw points or one image"),5,1)
+        optionsLayout.addWidget(self.gridsizewidget,6,0)
+        optionsLayout.addWidget(QLabel("image resolution in cells"),6,1)
+        optionsLayout.addWidget(self.roiwidget,7,0,1,2)
+        optionsLayout.addWidget(self.filterwidget,8,0,1,2)
+        optionsLayout.addWidget(self.exportwidthwidget,9,0)
+        optionsLayout.addWidget(QLabel("width of the exported png in pixels"),9,1)
+        optionsLayout.addWidget(self.adaptivewidget,10,0,1,2)
+        optionsLayout.addWidget(self.timingwidget,11,0,1,2)
+        optionsLayout.addWidget(self.packedwidget,14,0,1,2)
+        optionsLayout.addWidget(self.servicewidget,17,0,1,2)
+        optionsLayout.addWidget(self.proberadiuswidget,12,0)
+        optionsLayout.addWidget(QLabel("probe neighbourhood in cells"),12,1)
+        optionsLayout.addWidget(self.timelinewidget,13,0)
+        optionsLayout.addWidget(QLabel("what the build timeline shows"),13,1)
+        optionsLayout.addWidget(self.noisewidget,15,0)
+        optionsLayout.addWidget(QLabel("drop values rarer than this per million samples"),15,1)
+        optionsLayout.addWidget(self.trimwidget,16,0)
+        optionsLayout.addWidget(QLabel("drop this percent of the lowest and highest values"),16,1)
+        optionsLayout.addWidget(self.exportformatwidget,18,0)
+        optionsLayout.addWidget(QLabel("file format of the exported values"),18,1)
 
         
         layout.addWidget(self.layerwidget)
@@ -387,6 +593,12 @@ class Sidebar(QWidget):
         layout.addLayout(lowest_layout)
         lowest_layout.addWidget(self.recalculate)
         lowest_layout.addWidget(self.export_button)
+        lowest_layout.addWidget(self.export_data_button)
+        layout.addWidget(self.timelineplot)
+        layout.addWidget(self.probe_label)
+        layout.addWidget(self.probeplot)
+        layout.addWidget(self.profilewidget)
+        layout.addWidget(self.profile_display)
 
         self.histoFilter.setVisible(False)
 
@@ -408,53 +620,103 @@ class Sidebar(QWidget):
         folder = QFileDialog.getExistingDirectory(self, "Select Directory")
 
         if folder:  
-            self.arrow_folder = QDir(folder)
-            self.arrow_folder_button.setText(self.arrow_folder.absolutePath())
-
-            files = self.arrow_folder.entryInfoList(filters=QDir.Filter.Files,sort=QDir.SortFlag.Name)
-            if files:
-                self.channelwidget.clear()
-                file = files[0].absolutePath()
-                column_names = pl.scan_ipc(file).collect_schema().names()
-                self.channelwidget.addItems(column_names[2:])
+            self.setArrowFolder(folder)
             self.updateLayers()
         else:
             self.arrow_folder_button.setText("Choose Arrow File Folder")
+
+    def setArrowFolder(self,folder):
+        self.arrow_folder = QDir(folder)
+        self.arrow_folder_button.setText(self.arrow_folder.absolutePath())
+        self.layer_stats = dict()
+
+        # only the layers, the folder also holds their index and statistics files
+        files = helpers.get_arrow_files(self.arrow_folder.absolutePath())
+        if files:
+            # the sensor columns right away, derived ones once the schema was read in the background
+            self.channelwidget.clear()
+            self.channelwidget.addItems(helpers.CHANNELS)
+            task = helpers.ColumnsTask(files[0])
+            task.signals.finished.connect(self.setChannels)
+            self.scheduler.submit(task, scheduler.INTERACTIVE, key="columns")
+
+    def setChannels(self,file,column_names):
+        # another folder was chosen in the meantime
+        if Path(file).parent != Path(self.arrow_folder.absolutePath()):
+            return
+        channel = self.channelwidget.currentText()
+        self.channelwidget.clear()
+        self.channelwidget.addItems(column_names[2:])
+        if channel in column_names[2:]:
+            self.channelwidget.setCurrentText(channel)
     
     def create_arrow_file(self,file):
+        # the file is closed, the tail reads the rest and the arrow layer takes over
+        tailed = file in self.tail_tasks
+        if tailed:
+            self.tail_tasks[file].stop()
         if os.path.isfile(file) and file.endswith(".wav"):
-            self.watchdog_file_counter += 1
-            task = helpers.CreateArrowFile(file,self.watchdog_file_counter,self.arrow_folder.absolutePath())
+            manifest = helpers.IngestManifest.open(self.arrow_folder.absolutePath())
+            # same numbering as the batch conversion, a rewritten file keeps its layer
+            number = manifest.layer_for(file)
+            task = helpers.CreateArrowFile(file,number,self.arrow_folder.absolutePath(),self.getArrowLayout())
+            if tailed:
+                # before updateLayers, its recalculation already contains the layer
+                task.signal.finishedTask.connect(lambda: self.liveFinished.emit(file))
             task.signal.finishedTask.connect(self.updateLayers)
-            self.arrowpool.start(task)
+            # layers of the running melt go before any backfill
+            self.scheduler.submit(task, scheduler.INGEST)
             
 
     def create_arrow_files(self):
         wav_files = helpers.get_wav_files(self.wav_folder.absolutePath())
-        counter = 0
         self.layerwidget.setRange((1,len(wav_files)))
+        manifest = helpers.IngestManifest.open(self.arrow_folder.absolutePath())
+        layout = self.getArrowLayout()
 
+        skipped = 0
         for file in wav_files:
-            counter += 1
-            task = helpers.CreateArrowFile(file,counter,self.arrow_folder.absolutePath())
-            self.arrowpool.start(task)
+            number = manifest.layer_for(file)
+            # converted before and unchanged since
+            if not manifest.needs_conversion(file, layout):
+                skipped += 1
+                continue
+            # the layer gets rewritten, so do its statistics
+            self.layer_stats.pop(number, None)
+            task = helpers.CreateArrowFile(file,number,self.arrow_folder.absolutePath(),layout)
+            task.signal.finishedTask.connect(lambda: self.refreshTimeline(build=False))
+            self.scheduler.submit(task, scheduler.BACKFILL)
+        print(f"{len(wav_files) - skipped} wav files to convert, {skipped} already up to date")
 
 
     def flip_watchdog(self):
         if self.watchdog.isRunning():
             self.watchdog_task.stop()
+            for task in self.tail_tasks.values():
+                task.stop()
             self.watchdog.stop_loading()
-            self.watchdog_file_counter = 0
         else:
-            amount = len(helpers.get_wav_files(self.wav_folder.absolutePath()))
-            self.watchdog_file_counter = amount
+            # files already in the folder keep their order, new ones are numbered after them
+            manifest = helpers.IngestManifest.open(self.arrow_folder.absolutePath())
+            for file in helpers.get_wav_files(self.wav_folder.absolutePath()):
+                manifest.layer_for(file)
             self.watchdog.start_non_blocking_loading()
-            self.watchpool = QThreadPool(self)
             self.watchdog_task = helpers.AsyncWatchdogTask(self.wav_folder.absolutePath())
             self.watchdog_task.signals.file_ready.connect(self.create_arrow_file)
+            self.watchdog_task.signals.file_growing.connect(self.tailFile)
             self.watchdog_task.signals.error.connect(lambda e: print(f"Error: {e}"))
 
-            self.watchpool.start(self.watchdog_task)
+            self.scheduler.submit(self.watchdog_task, scheduler.SERVICE)
+
+    def tailFile(self,file):
+        if not self.tailwidget.isChecked() or file in self.tail_tasks:
+            return
+        task = helpers.WavTailTask(file, self.channel, self.all_channels, self.strategy)
+        task.signals.chunk.connect(self.liveChunk)
+        task.signals.finished.connect(lambda path: self.tail_tasks.pop(path, None))
+        self.tail_tasks[file] = task
+        # mostly sleeps between reads, it doesn't take one of the cpu slots
+        self.scheduler.submit(task, scheduler.SERVICE)
 
     def get_energy_range(self):
         self.energy_range = self.energywidget.getValue()
@@ -472,23 +734,191 @@ class Sidebar(QWidget):
         return self.arrow_folder
     def getStrategy(self):
         return self.strategy
+    def getArrowLayout(self):
+        return "zorder" if self.zorderwidget.isChecked() else "raw"
+    def getAllChannels(self):
+        return self.all_channels
+    def getRenderMode(self):
+        return self.render_mode
+    def getGridSize(self):
+        return self.grid_size
+    def getRoiMode(self):
+        return self.roiwidget.isChecked()
+    def getEnergyFilter(self):
+        """energy window for the query, None if it only clamps the colors"""
+        if self.filterwidget.isChecked():
+            return self.energy_range
+        return None
+    def getNoiseFilter(self):
+        """(min_share, trim) for DataWorker, None if nothing is filtered"""
+        min_share = self.noisewidget.value() / 1e6
+        trim = self.trimwidget.value() / 100
+        if min_share == 0 and trim == 0:
+            return None
+        return (min_share, trim)
+    def getUseService(self):
+        return self.servicewidget.isChecked()
+    def getKeepHistogram(self):
+        return self.keep_histogram
+
+    def refilterEnergy(self):
+        if not self.filterwidget.isChecked():
+            return
+        self.keep_histogram = True
+        self.beginRecalculation()
     def updateHistogram(self,hist):
-        self.histogramWidget.update_data(hist)
-        self.energywidget.setRange((hist[:,0].min(),hist[:,0].max()))
+        with profiling.stage("Sidebar.updateHistogram", rows=len(hist)):
+            self.histogramWidget.update_data(hist)
+            self.energywidget.setRange((hist[:,0].min(),hist[:,0].max()))
+    def setChannelHistograms(self,hists):
+        self.channel_histograms = hists
+
+    def changeChannel(self):
+        channel = self.channelwidget.currentText()
+        # the last calculation already holds every channel, only the view has to switch
+        if self.all_channels and channel in self.channel_histograms:
+            self.channel = channel
+            self.updateHistogram(self.channel_histograms[channel])
+            self.channelChanged.emit(channel)
+            if self.last_probe is not None:
+                self.showProbe(self.last_probe)
+            self.drawTimeline()
+        else:
+            self.beginRecalculation()
    
+    def refreshTimeline(self,build=True):
+        """
+        Loads the statistics of layers the timeline doesn't have yet, usually just the newest one.
+        With build the layers lacking a statistics file get one afterwards, at backfill priority.
+        """
+        files = helpers.get_arrow_files(self.arrow_folder.absolutePath())
+        missing = [f for f in files if helpers.layer_number(f) not in self.layer_stats]
+        if not missing:
+            self.drawTimeline()
+            return
+        task = helpers.LayerStatsTask(missing, build=False)
+        task.signals.finished.connect(self.addLayerStats)
+        if build:
+            task.signals.finished.connect(self.buildLayerStats)
+        self.scheduler.submit(task, scheduler.BACKGROUND, key=f"layer stats {build}")
+
+    def buildLayerStats(self,stats):
+        files = helpers.get_arrow_files(self.arrow_folder.absolutePath())
+        missing = [f for f in files if helpers.layer_number(f) not in self.layer_stats]
+        if not missing:
+            return
+        task = helpers.LayerStatsTask(missing, build=True)
+        task.signals.finished.connect(self.addLayerStats)
+        self.scheduler.submit(task, scheduler.BACKFILL, key="layer stats build")
+
+    def addLayerStats(self,stats):
+        self.layer_stats.update(stats)
+        self.drawTimeline()
+
+    def drawTimeline(self):
+        if not self.layer_stats:
+            return
+        layers = sorted(self.layer_stats)
+        stats = [self.layer_stats[l] for l in layers]
+        mode = self.timelinewidget.currentText()
+        if mode == "samples":
+            values = dict(samples=[s["rows"] for s in stats])
+        elif mode == "coverage":
+            values = {"coverage %": [100 * s["coverage"] for s in stats]}
+        else:
+            # the layer statistics cover the sensor columns, anything else shows their mean
+            channel = self.channel if self.channel in helpers.CHANNELS else "mean"
+            values = {
+                f"{channel} {stat}": [s["channels"][channel][stat] for s in stats]
+                for stat in ["p5", "mean", "p95"]
+            }
+        self.timelineplot.set_data(layers, {k: [np.nan if v is None else v for v in vs] for k, vs in values.items()})
+
     def updateLayers(self):
+        self.refreshTimeline()
         layers = len(helpers.get_arrow_files(self.arrow_folder.absolutePath()))
         self.layerwidget.setRange((1,layers))
         lowerbound = layers - 10 if layers - 10 >= 1 else 1 
         self.layerwidget.setValue((lowerbound,layers))
+        self.layersChanged.emit()
         
 
+    def showLayers(self,layer):
+        """Moves the layer slider without starting a recalculation, the caller has one running"""
+        layers = len(helpers.get_arrow_files(self.arrow_folder.absolutePath()))
+        self.layerwidget.blockSignals(True)
+        self.layerwidget.setRange((1,max(layers,1)))
+        self.layerwidget.setValue(tuple(layer))
+        self.layerwidget.blockSignals(False)
+        self.layer = tuple(layer)
+
+    def getSessionSettings(self):
+        """What the session snapshot needs to bring the sidebar back, the query settings come from the request"""
+        return dict(
+            wav_folder=self.wav_folder.absolutePath(),
+            arrow_folder=self.arrow_folder.absolutePath(),
+            energy_range=list(self.energy_range),
+            point_size=self.pointsize,
+            render_mode=self.render_mode,
+            grid_size=self.grid_size,
+            watchdog=self.watchdog.isRunning(),
+        )
+
+    def applySessionSettings(self,settings):
+        """Puts the sidebar back into the state of a session snapshot, without recalculating"""
+        widgets = [self.layerwidget, self.energywidget, self.channelwidget, self.aggregationWidget,
+                   self.resolutionwidget, self.allchannelswidget, self.renderwidget, self.gridsizewidget,
+                   self.filterwidget, self.noisewidget, self.trimwidget, self.pointsizewidget]
+        for widget in widgets:
+            widget.blockSignals(True)
+        try:
+            if settings["wav_folder"] and QDir(settings["wav_folder"]).exists():
+                self.wav_folder = QDir(settings["wav_folder"])
+                self.wav_folder_button.setText(self.wav_folder.absolutePath())
+            if QDir(settings["arrow_folder"]).exists():
+                self.setArrowFolder(settings["arrow_folder"])
+            self.showLayers(settings["layer"])
+            self.energywidget.setValue(tuple(settings["energy_range"]))
+            if self.channelwidget.findText(settings["channel"]) < 0:
+                # a derived column, the schema of the folder is still being read
+                self.channelwidget.addItem(settings["channel"])
+            self.channelwidget.setCurrentText(settings["channel"])
+            self.aggregationWidget.setCurrentText(settings["strategy"])
+            self.resolutionwidget.setValue(settings["nth"])
+            self.allchannelswidget.setChecked(settings["all_channels"])
+            self.renderwidget.setCurrentText(settings["render_mode"])
+            self.gridsizewidget.setValue(settings["grid_size"])
+            self.filterwidget.setChecked(settings["energy_filter"] is not None)
+            noise = settings["noise"] or (0, 0)
+            self.noisewidget.setValue(round(noise[0] * 1e6))
+            self.trimwidget.setValue(noise[1] * 100)
+            self.pointsizewidget.setValue(settings["point_size"])
+        finally:
+            for widget in widgets:
+                widget.blockSignals(False)
+
+        # as beginRecalculation leaves it
+        self.resolution = settings["nth"]
+        self.channel = settings["channel"]
+        self.strategy = settings["strategy"]
+        self.all_channels = settings["all_channels"]
+        self.render_mode = settings["render_mode"]
+        self.grid_size = settings["grid_size"]
+        self.energy_range = tuple(settings["energy_range"])
+        self.pointsize = settings["point_size"]
+        self.energyChanged.emit(self.energy_range)
+        self.pointsizeChanged.emit(self.pointsize)
+
+        # it was watching the melt when the viewer went down
+        if settings["watchdog"] and self.wav_folder.exists() and not self.watchdog.isRunning():
+            self.flip_watchdog()
+
     def filterHistogram(self):
         self.histoFilter.start_loading()
         files = helpers.get_arrow_files(self.arrow_folder.absolutePath())
         task = helpers.HistogramFilterTask(self.channel,natsorted(files))
         task.signals.filteredHistogram.connect(self.histoFilter.stop_loading)
-        self.histopool.start(task)
+        self.scheduler.submit(task, scheduler.BACKGROUND, key="histogram filter")
 
     def beginRecalculation(self):
         self.layer = self.layerwidget.getValue()
@@ -499,7 +929,54 @@ class Sidebar(QWidget):
         self.resolution = self.resolutionwidget.value()
         self.channel = self.channelwidget.currentText()
         self.strategy = self.aggregationWidget.currentText()
+        self.all_channels = self.allchannelswidget.isChecked()
+        self.render_mode = self.renderwidget.currentText()
+        self.grid_size = self.gridsizewidget.value()
+        if not self.all_channels:
+            self.channel_histograms = dict()
         self.begincalculation.emit()
+        self.keep_histogram = False
+    def toggleProfiling(self,on):
+        profiling.set_enabled(on)
+        self.profile_display.setVisible(on)
+        if not on:
+            self.profile_records = dict()
+            self.profile_display.setText("")
+
+    def showProfileRecord(self,record):
+        self.profile_records[record["stage"]] = profiling.format_record(record)
+        self.profile_display.setText("\n".join(self.profile_records.values()))
+
+    def getProbeRadius(self):
+        return self.proberadiuswidget.value()
+    def startProbe(self,x,y):
+        self.probe_label.setText(f"probing x {x:.0f}, y {y:.0f} ...")
+    def showProbe(self,probe):
+        self.last_probe = probe
+        # the profile covers the sensor columns, anything else falls back to their mean
+        channel = self.channel if self.channel in probe["channels"] else "mean"
+        values = probe["values"][:, probe["channels"].index(channel)]
+        x, y = probe["position"]
+        samples = int(np.nansum(values[:, 2]))
+        text = f"{channel} at x {x:.0f}, y {y:.0f} (±{probe['radius']} cells), {samples:,} samples"
+        if probe.get("missing"):
+            text += f", {len(probe['missing'])} layers still being profiled"
+        self.probe_label.setText(text)
+        self.probeplot.set_data(probe["layers"], dict(mean=values[:, 0], max=values[:, 1]))
+        self.probeplot.setVisible(True)
+
+    def getExportWidth(self):
+        return self.exportwidthwidget.value()
+    def startExport(self):
+        self.export_button.start_loading()
+    def finishExport(self):
+        self.export_button.stop_loading()
+    def getExportFormat(self):
+        return self.exportformatwidget.currentText()
+    def startDataExport(self):
+        self.export_data_button.start_loading()
+    def finishDataExport(self):
+        self.export_data_button.stop_loading()
     def startCalculation(self):
         self.recalculate.start_loading()
     def finishCalculation(self):
@@ -0,0 +1,120 @@
+
+"""
+Keeps the heavy modules out of the way until the window is up. Polars and
+scipy's wav reader are bound through lazy(...) and imported on the first
+attribute that is read. Pyarrow, watchdog and QtCharts are imported inside
+the functions that need them. Once the window shows, WarmUpTask imports them
+in the background, so the first recalculation usually finds them loaded.
+
+main.py imports this module first and calls profile_imports(), every import
+of the GUI thread is timed until window_shown(). If the window took longer
+than STARTUP_BUDGET_MS (EBM_STARTUP_BUDGET_MS) the slowest imports are
+printed, with profiling on they also go to the profile log as "startup".
+"""
+import builtins
+import importlib
+import os
+import sys
+import threading
+import time
+import types
+
+from PySide6.QtCore import QRunnable
+
+import profiling
+import scheduler
+
+# as early as the interpreter gets to it, main.py imports this module first
+START = time.perf_counter()
+
+STARTUP_BUDGET_MS = float(os.environ.get("EBM_STARTUP_BUDGET_MS", "800"))
+
+# imported by WarmUpTask once the window is shown, in this order
+WARM_UP = ["polars", "pyarrow.ipc", "scipy.io.wavfile", "watchdog.observers", "PySide6.QtCharts"]
+
+# module -> seconds, outermost imports of the GUI thread and every lazy load
+import_times = dict()
+
+_original_import = builtins.__import__
+_local = threading.local()
+
+
+def load(name):
+    """Imports name once and remembers how long it took"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    import_times.setdefault(name, time.perf_counter() - start)
+    return module
+
+
+class LazyModule(types.ModuleType):
+    """Stands in for a module until the first attribute is read, then imports it"""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self._lazy_name = name
+
+    def __getattr__(self, attr):
+        module = load(self._lazy_name)
+        # later lookups find everything in this module right away
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy(name):
+    """The module if it is loaded already, else a LazyModule for it"""
+    return sys.modules.get(name) or LazyModule(name)
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules or threading.current_thread() is not threading.main_thread():
+        return _original_import(name, globals, locals, fromlist, level)
+    depth = getattr(_local, "depth", 0)
+    _local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _local.depth = depth
+        # nested imports are part of the one that pulled them in
+        if depth == 0:
+            import_times[name] = import_times.get(name, 0.0) + time.perf_counter() - start
+
+
+def profile_imports():
+    builtins.__import__ = _timed_import
+
+
+def slowest_imports(n=8):
+    return sorted(import_times.items(), key=lambda item: item[1], reverse=True)[:n]
+
+
+def window_shown():
+    """Ends the import timing, reports a blown budget and starts warming up"""
+    builtins.__import__ = _original_import
+    elapsed_ms = (time.perf_counter() - START) * 1000
+
+    slowest = slowest_imports()
+    if elapsed_ms > STARTUP_BUDGET_MS or profiling.enabled:
+        print(f"Window shown after {elapsed_ms:.0f} ms (budget {STARTUP_BUDGET_MS:.0f} ms), slowest imports: "
+              + ", ".join(f"{name} {t * 1000:.0f} ms" for name, t in slowest))
+    profiling.record("startup", elapsed_ms / 1000, budget_ms=STARTUP_BUDGET_MS,
+                     imports={name: round(t * 1000, 1) for name, t in slowest})
+
+    scheduler.instance().submit(WarmUpTask(), scheduler.BACKGROUND, key="warm up")
+
+
+class WarmUpTask(QRunnable):
+    def __init__(self, modules=WARM_UP):
+        super().__init__()
+        self.modules = modules
+
+    def run(self):
+        for name in self.modules:
+            try:
+                load(name)
+            except ImportError as e:
+                print(f"Could not warm up {name}: {e}")
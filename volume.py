@@ -0,0 +1,278 @@
+
+"""
+The layer stack as a voxel volume for the 3D view. Every layer is aggregated
+into a VOLUME_CELLS x VOLUME_CELLS slice over the full dac range (mean of the
+channel per cell) and written into bricks of BRICK^3 voxels, zlib compressed
+float16 files in a volume folder next to the arrow layers. Every coarser level
+of detail halves each axis and keeps the max of the voxels it merges, so hot
+spots still show in the overview of a maximum intensity projection.
+
+Layers are only ever added: new layers go into the bricks of their slab on
+every level, gathered per slab so every brick is written once, and nothing
+else is touched. A rewritten layer (arrow file newer
+than recorded) rebuilds the whole volume, a max can't be taken back.
+
+The view (openglwidget.VolumeWidget) only reads the bricks it draws, through
+an LRU cache of BRICK_CACHE_BYTES, and keeps a fixed budget of them on the GPU.
+"""
+import json
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+import helperfunctions as helpers
+import profiling
+import startup
+
+pl = startup.lazy("polars")
+
+
+# voxels per side of a layer slice, the x, y resolution of the volume
+VOLUME_CELLS = 512
+# voxels per side of a brick
+BRICK = 64
+# level l merges 2^l voxels per axis, the coarsest one holds 1024 layers in one brick
+VOLUME_LEVELS = 5
+# decompressed bricks kept in memory, the GPU budget is set in the view
+BRICK_CACHE_BYTES = 256 << 20
+
+VOLUME_FOLDER = "volume"
+META_NAME = "volume.json"
+
+
+def volume_path(arrow_folder, channel):
+    return Path(arrow_folder) / VOLUME_FOLDER / channel.replace(" ", "_")
+
+
+def layer_slice(file, channel, cells=VOLUME_CELLS):
+    """(cells, cells) float32, mean of channel per cell of the layer, NaN where the beam never was"""
+    cell = lambda c: ((pl.col(c) + 32768) * cells // 65536).clip(0, cells - 1).cast(pl.Int32)
+    agg = (
+        pl.scan_ipc(file)
+        .select(cell("x").alias("cx"), cell("y").alias("cy"), pl.col(channel))
+        .group_by(["cy", "cx"])
+        .agg(pl.col(channel).mean())
+        .collect()
+    )
+    grid = np.full((cells, cells), np.nan, dtype=np.float32)
+    grid[agg["cy"].to_numpy(), agg["cx"].to_numpy()] = agg[channel].to_numpy()
+    return grid
+
+
+def downsample_max(grid, f):
+    """Max over f x f blocks of a 2D grid, NaN only where a whole block is empty"""
+    if f == 1:
+        return grid
+    h, w = -(-grid.shape[0] // f), -(-grid.shape[1] // f)
+    padded = np.full((h * f, w * f), np.nan, dtype=grid.dtype)
+    padded[:grid.shape[0], :grid.shape[1]] = grid
+    blocks = padded.reshape(h, f, w, f)
+    return np.fmax.reduce(np.fmax.reduce(blocks, axis=3), axis=1)
+
+
+class BrickStore:
+    """
+    Bricks of one volume with an LRU cache of the decompressed ones. A key is
+    (level, bz, by, bx), a brick (BRICK, BRICK, BRICK) float16 as z, y, x with
+    NaN for empty voxels, a missing file reads as None.
+    Use BrickStore.open(folder), the build task and the view share the instance.
+    """
+
+    _open = dict()
+    _open_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, folder):
+        key = str(Path(folder).resolve())
+        with cls._open_lock:
+            if key not in cls._open:
+                cls._open[key] = cls(folder)
+            return cls._open[key]
+
+    def __init__(self, folder, budget=BRICK_CACHE_BYTES):
+        self.folder = Path(folder)
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        # bumped on every write, the view uploads a brick again once its version changed
+        self.versions = dict()
+        self.meta = self._load_meta()
+        # kept apart from meta, the view asks for it while the build task adds layers
+        self._depth = max((int(n) for n in self.meta["layers"]), default=0)
+
+    def _load_meta(self):
+        meta = dict(cells=VOLUME_CELLS, brick=BRICK, levels=VOLUME_LEVELS, layers=dict())
+        path = self.folder / META_NAME
+        if path.exists():
+            try:
+                stored = json.loads(path.read_text())
+                # bricks of another layout are useless, they get rebuilt
+                if all(stored.get(k) == meta[k] for k in ("cells", "brick", "levels")):
+                    meta = stored
+            except ValueError as e:
+                print(f"Ignoring broken {path}: {e}")
+        return meta
+
+    def save_meta(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with helpers.replace_when_done(self.folder / META_NAME) as tmp:
+            tmp.write_text(json.dumps(self.meta))
+
+    # ---------- layout ----------
+
+    def depth(self):
+        """Voxels along z on level 0, the highest layer number in the volume"""
+        return self._depth
+
+    def shape(self, level):
+        """(z, y, x) voxels of a level"""
+        f = 2 ** level
+        cells = -(-VOLUME_CELLS // f)
+        return (-(-self.depth() // f), cells, cells)
+
+    def brick_counts(self, level):
+        return tuple(-(-n // BRICK) for n in self.shape(level))
+
+    def brick_path(self, key):
+        level, bz, by, bx = key
+        return self.folder / f"level_{level}" / f"{bz}_{by}_{bx}.brick"
+
+    # ---------- bricks ----------
+
+    def get(self, key):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        path = self.brick_path(key)
+        if not path.exists():
+            return None
+        raw = zlib.decompress(path.read_bytes())
+        brick = np.frombuffer(raw, dtype=np.float16).reshape(BRICK, BRICK, BRICK)
+        self._remember(key, brick)
+        return brick
+
+    def put(self, key, brick):
+        brick = np.ascontiguousarray(brick, dtype=np.float16)
+        path = self.brick_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with helpers.replace_when_done(path) as tmp:
+            # level 1, most of the time goes into writing often rather than into small files
+            tmp.write_bytes(zlib.compress(brick.tobytes(), 1))
+        self._remember(key, brick)
+        with self.lock:
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _remember(self, key, brick):
+        with self.lock:
+            if key in self.cache:
+                self.cached_bytes -= self.cache.pop(key).nbytes
+            self.cache[key] = brick
+            self.cached_bytes += brick.nbytes
+            while self.cached_bytes > self.budget and len(self.cache) > 1:
+                self.cached_bytes -= self.cache.popitem(last=False)[1].nbytes
+
+    def version(self, key):
+        with self.lock:
+            return self.versions.get(key, 0)
+
+    def clear(self):
+        """Drops every brick, the volume is built again from the first layer"""
+        with self.lock:
+            for path in self.folder.glob("level_*/*.brick"):
+                path.unlink()
+            self.cache.clear()
+            self.cached_bytes = 0
+            for key in self.versions:
+                self.versions[key] += 1
+            self._depth = 0
+        self.meta["layers"] = dict()
+
+    # ---------- building ----------
+
+    def add_layers(self, grids):
+        """
+        Writes the slices of {layer number (1 based): grid} into their bricks on
+        every level. Every brick they touch is read and written once per call,
+        so pass the layers of a whole slab of BRICK layers together.
+        """
+        if not grids:
+            return
+        for level in range(VOLUME_LEVELS):
+            f = 2 ** level
+            bricks = dict()
+            for number, grid in grids.items():
+                plane = downsample_max(grid, f)
+                bz, iz = divmod((number - 1) // f, BRICK)
+                rows, cols = -(-plane.shape[0] // BRICK), -(-plane.shape[1] // BRICK)
+                for by in range(rows):
+                    for bx in range(cols):
+                        part = plane[by * BRICK:(by + 1) * BRICK, bx * BRICK:(bx + 1) * BRICK]
+                        key = (level, bz, by, bx)
+                        if key not in bricks:
+                            brick = self.get(key)
+                            bricks[key] = np.full((BRICK, BRICK, BRICK), np.nan, np.float16) \
+                                if brick is None else brick.copy()
+                        h, w = part.shape
+                        # coarse levels merge several layers into one plane
+                        bricks[key][iz, :h, :w] = np.fmax(bricks[key][iz, :h, :w], part.astype(np.float16))
+            for key, brick in bricks.items():
+                self.put(key, brick)
+        with self.lock:
+            self._depth = max(self._depth, max(grids))
+
+
+class VolumeSignals(QObject):
+    # layers in the volume so far, after every added slab
+    progress = Signal(int)
+    finished = Signal(str)
+
+class VolumeBuildTask(QRunnable):
+    """Adds the layers of an arrow folder the volume of channel doesn't have yet"""
+
+    def __init__(self, arrow_folder, channel="mean"):
+        super().__init__()
+        self.arrow_folder = arrow_folder
+        self.channel = channel
+        self.signals = VolumeSignals()
+
+    def run(self):
+        folder = volume_path(self.arrow_folder, self.channel)
+        store = BrickStore.open(folder)
+        files = helpers.get_arrow_files(self.arrow_folder)
+        known = store.meta["layers"]
+
+        mtimes = {str(helpers.layer_number(f)): Path(f).stat().st_mtime for f in files}
+        if any(n in mtimes and mtimes[n] > t for n, t in known.items()):
+            print(f"Layers of {self.arrow_folder} were rewritten, building the volume again")
+            store.clear()
+            known = store.meta["layers"]
+
+        missing = [f for f in files if str(helpers.layer_number(f)) not in known]
+        # the layers of one slab share their bricks, they go in together
+        slabs = dict()
+        for file in missing:
+            slabs.setdefault((helpers.layer_number(file) - 1) // BRICK, []).append(file)
+
+        with profiling.stage("VolumeBuildTask", files=len(missing), channel=self.channel,
+                             bytes_on_disk=profiling.bytes_on_disk(missing)):
+            for slab in sorted(slabs):
+                grids = dict()
+                for file in slabs[slab]:
+                    number = helpers.layer_number(file)
+                    try:
+                        grids[number] = layer_slice(file, self.channel)
+                    except Exception as e:
+                        print(f"Layer {number} left out of the volume: {e}")
+                store.add_layers(grids)
+                for number in grids:
+                    known[str(number)] = mtimes[str(number)]
+                # after every slab, an interrupted build continues where it stopped
+                store.save_meta()
+                self.signals.progress.emit(len(known))
+        self.signals.finished.emit(str(folder))
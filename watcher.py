@@ -0,0 +1,66 @@
+
+"""
+File system events of the wav folder for AsyncWatchdogTask. Apart from
+helperfunctions so watchdog is only imported once the watchdog is deployed.
+"""
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+from PySide6.QtCore import Signal
+
+
+class WatchdogObserver(FileSystemEventHandler):
+    def __init__(self, signals):
+        super().__init__()
+        self.signals = signals
+        # file_growing goes out once per file, not again for late events after the close
+        self.growing = set()
+        self.closed = set()
+
+    def on_created(self, event):
+        self.closed.discard(event.src_path)
+        self.on_modified(event)
+
+    def on_modified(self, event):
+        path = event.src_path
+        if event.is_directory or not path.lower().endswith('.wav'):
+            return
+        if path not in self.growing and path not in self.closed:
+            self.growing.add(path)
+            self.signals.file_growing.emit(path)
+
+    def on_closed(self, event):
+        # IN_CLOSE_WRITE: The file descriptor is released after writing.
+        if not event.is_directory and event.src_path.lower().endswith('.wav'):
+            self.growing.discard(event.src_path)
+            self.closed.add(event.src_path)
+            self.signals.file_ready.emit(event.src_path)
+
+    def on_moved(self, event):
+        # Handle 'Atomic Saves': Temp file is moved to final destination.
+        if not event.is_directory and event.src_path.lower().endswith('.wav'):
+            self.signals.file_ready.emit(event.src_path)
+
+class WavHandler(FileSystemEventHandler):
+    def __init__(self, signal):
+        self.signal = signal
+
+    def on_created(self, event):
+        if not event.is_directory and event.src_path.endswith('.wav'):
+            self.signal.emit(event.src_path)
+
+class FolderWatcher(object):
+    file_detected = Signal(str)
+
+    def __init__(self, folder_path):
+        super().__init__()
+        self.folder_path = folder_path
+        self.observer = Observer()
+
+    def start_watching(self):
+            event_handler = WavHandler(self.file_detected)
+            self.observer.schedule(event_handler, self.folder_path, recursive=False)
+            self.observer.start()
+
+    def stop_watching(self):
+        self.observer.stop()
+        self.observer.join()